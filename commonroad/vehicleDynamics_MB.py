@@ -1,6 +1,7 @@
 import logging
 
 from src.globals import KS_TO_ST_SPEED_M_PER_SEC
+KS_SWITCH_SPEED = KS_TO_ST_SPEED_M_PER_SEC  # used below for lateral slip and kinematic switch, was undefined
 from .steeringConstraints import steeringConstraints
 from .accelerationConstraints import accelerationConstraints
 from .vehicleDynamics_KS import vehicleDynamics_KS
@@ -0,0 +1,501 @@
+# Compiled (numba nopython) counterparts of vehicleDynamics_KS, vehicleDynamics_ST and vehicleDynamics_MB
+# and of the constraint and tire functions they use.
+# The kernels take the state and input as float64 arrays and the parameters as the flat array made by
+# vehicleParametersArray.pack_parameters(), and return the right hand side as a float64 array.
+# They compute the same thing as the pure python functions; see those for the meaning of states and inputs.
+# If numba is not installed, the kernels still work but run as (slow) interpreted python.
+import math
+
+import numpy as np
+
+from src.globals import KS_TO_ST_SPEED_M_PER_SEC
+from src.l2race_utils import my_logger
+from .vehicleParametersArray import *
+
+logger = my_logger(__name__)
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    logger.warning('numba is not available, compiled vehicle dynamics kernels will run as interpreted python. '
+                   'Install it with "pip install numba"')
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+KS_SWITCH_SPEED = KS_TO_ST_SPEED_M_PER_SEC
+G = 9.81  # [m/s^2], same value as in the commonroad models
+
+
+@njit(cache=True)
+def steeringConstraints_jit(steeringAngle, steeringVelocity, P):
+    # steering limit reached?
+    if (steeringAngle <= P[P_STEERING_MIN] and steeringVelocity <= 0) or (steeringAngle >= P[P_STEERING_MAX] and steeringVelocity >= 0):
+        steeringVelocity = 0.
+    elif steeringVelocity <= P[P_STEERING_V_MIN]:
+        steeringVelocity = P[P_STEERING_V_MIN]
+    elif steeringVelocity >= P[P_STEERING_V_MAX]:
+        steeringVelocity = P[P_STEERING_V_MAX]
+    return steeringVelocity
+
+
+@njit(cache=True)
+def accelerationConstraints_jit(velocity, acceleration, P):
+    # positive acceleration limit
+    if velocity > P[P_LONGITUDINAL_V_SWITCH]:
+        posLimit = P[P_LONGITUDINAL_A_MAX] * P[P_LONGITUDINAL_V_SWITCH] / velocity
+    else:
+        posLimit = P[P_LONGITUDINAL_A_MAX]
+
+    # acceleration limit reached?
+    if (velocity <= P[P_LONGITUDINAL_V_MIN] and acceleration <= 0) or (velocity >= P[P_LONGITUDINAL_V_MAX] and acceleration >= 0):
+        acceleration = 0.
+    elif acceleration <= -P[P_LONGITUDINAL_A_MAX]:
+        acceleration = -P[P_LONGITUDINAL_A_MAX]
+    elif acceleration >= posLimit:
+        acceleration = posLimit
+    return acceleration
+
+
+@njit(cache=True)
+def friction_steering_constraint_jit(acceleration, yaw_rate, steering_velocity, velocity, steering_angle, P):
+    if velocity < KS_TO_ST_SPEED_M_PER_SEC:
+        return steering_velocity
+    yaw_rate_max = (P[P_LONGITUDINAL_A_MAX] ** 2 - acceleration ** 2) / (velocity ** 2)
+    if yaw_rate ** 2 >= yaw_rate_max and steering_velocity * steering_angle > 0:
+        steering_velocity = 0.
+    return steering_velocity
+
+
+@njit(cache=True)
+def vehicleDynamics_KS_jit(x, uInit, P):
+    l = P[P_a] + P[P_b]
+    u0 = steeringConstraints_jit(x[2], uInit[0], P)
+    u1 = accelerationConstraints_jit(x[3], uInit[1], P)
+
+    f = np.empty(5)
+    f[0] = x[3] * math.cos(x[4])
+    f[1] = x[3] * math.sin(x[4])
+    f[2] = u0
+    f[3] = u1
+    f[4] = x[3] / l * math.tan(x[2])
+    return f
+
+
+@njit(cache=True)
+def vehicleDynamics_ST_jit(x, uInit, P):
+    g = G
+
+    # create equivalent bicycle parameters
+    mu = P[P_TIRE_p_dy1]
+    C_Sf = -P[P_TIRE_p_ky1] / P[P_TIRE_p_dy1]
+    C_Sr = -P[P_TIRE_p_ky1] / P[P_TIRE_p_dy1]
+    lf = P[P_a]
+    lr = P[P_b]
+    h = P[P_h_s]
+    m = P[P_m]
+    I = P[P_I_z]
+
+    # consider steering constraints
+    u0 = steeringConstraints_jit(x[2], uInit[0], P)
+    u1 = accelerationConstraints_jit(x[3], uInit[1], P)
+    # same arguments as in vehicleDynamics_ST
+    u0 = friction_steering_constraint_jit(u1, x[5], u0, x[3], x[4], P)
+
+    f = np.empty(7)
+    # switch to kinematic model for small velocities
+    if x[3] < KS_TO_ST_SPEED_M_PER_SEC:
+        # wheelbase
+        lwb = P[P_a] + P[P_b]
+        u_ks = np.empty(2)
+        u_ks[0] = u0
+        u_ks[1] = u1
+        f_ks = vehicleDynamics_KS_jit(x, u_ks, P)
+        f[0] = f_ks[0]
+        f[1] = f_ks[1]
+        f[2] = f_ks[2]
+        f[3] = f_ks[3]
+        f[4] = f_ks[4]
+        f[5] = u1 / lwb * math.tan(x[2]) + x[3] / (lwb * math.cos(x[2]) ** 2) * u0
+        f[6] = 0.
+    else:
+        f[0] = x[3] * math.cos(x[6] + x[4])
+        f[1] = x[3] * math.sin(x[6] + x[4])
+        f[2] = u0
+        f[3] = u1
+        f[4] = x[5]
+        f[5] = -mu * m / (x[3] * I * (lr + lf)) * (lf ** 2 * C_Sf * (g * lr - u1 * h) + lr ** 2 * C_Sr * (g * lf + u1 * h)) * x[5] \
+               + mu * m / (I * (lr + lf)) * (lr * C_Sr * (g * lf + u1 * h) - lf * C_Sf * (g * lr - u1 * h)) * x[6] \
+               + mu * m / (I * (lr + lf)) * lf * C_Sf * (g * lr - u1 * h) * x[2]
+        f[6] = (mu / (x[3] ** 2 * (lr + lf)) * (C_Sr * (g * lf + u1 * h) * lr - C_Sf * (g * lr - u1 * h) * lf) - 1) * x[5] \
+               - mu / (x[3] * (lr + lf)) * (C_Sr * (g * lf + u1 * h) + C_Sf * (g * lr - u1 * h)) * x[6] \
+               + mu / (x[3] * (lr + lf)) * (C_Sf * (g * lr - u1 * h)) * x[2]
+    return f
+
+
+@njit(cache=True)
+def sign_jit(x):
+    if x > 0:
+        return 1.
+    elif x < 0:
+        return -1.
+    else:
+        return 0.
+
+
+@njit(cache=True)
+def mFormulaLongitudinal_jit(kappa, gamma, F_z, P):
+    kappa = -kappa
+
+    S_hx = P[P_TIRE_p_hx1]
+    S_vx = F_z * P[P_TIRE_p_vx1]
+
+    kappa_x = kappa + S_hx
+    mu_x = P[P_TIRE_p_dx1] * (1 - P[P_TIRE_p_dx3] * gamma ** 2)
+
+    C_x = P[P_TIRE_p_cx1]
+    D_x = mu_x * F_z
+    E_x = P[P_TIRE_p_ex1]
+    K_x = F_z * P[P_TIRE_p_kx1]
+    B_x = K_x / (C_x * D_x)
+
+    return D_x * math.sin(C_x * math.atan(B_x * kappa_x - E_x * (B_x * kappa_x - math.atan(B_x * kappa_x))) + S_vx)
+
+
+@njit(cache=True)
+def mFormulaLateral_jit(alpha, gamma, F_z, P):
+    """ :returns: (F_y, mu_y) """
+    S_hy = sign_jit(gamma) * (P[P_TIRE_p_hy1] + P[P_TIRE_p_hy3] * math.fabs(gamma))
+    S_vy = sign_jit(gamma) * F_z * (P[P_TIRE_p_vy1] + P[P_TIRE_p_vy3] * math.fabs(gamma))
+
+    alpha_y = alpha + S_hy
+    mu_y = P[P_TIRE_p_dy1] * (1 - P[P_TIRE_p_dy3] * gamma ** 2)
+
+    C_y = P[P_TIRE_p_cy1]
+    D_y = mu_y * F_z
+    E_y = P[P_TIRE_p_ey1]
+    K_y = F_z * P[P_TIRE_p_ky1]
+    B_y = K_y / (C_y * D_y)
+
+    F_y = D_y * math.sin(C_y * math.atan(B_y * alpha_y - E_y * (B_y * alpha_y - math.atan(B_y * alpha_y)))) + S_vy
+    return F_y, mu_y
+
+
+@njit(cache=True)
+def mFormulaLongitudinalComb_jit(kappa, alpha, F0_x, P):
+    S_hxalpha = P[P_TIRE_r_hx1]
+
+    alpha_s = alpha + S_hxalpha
+
+    B_xalpha = P[P_TIRE_r_bx1] * math.cos(math.atan(P[P_TIRE_r_bx2] * kappa))
+    C_xalpha = P[P_TIRE_r_cx1]
+    E_xalpha = P[P_TIRE_r_ex1]
+    D_xalpha = F0_x / (math.cos(C_xalpha * math.atan(B_xalpha * S_hxalpha - E_xalpha * (B_xalpha * S_hxalpha - math.atan(B_xalpha * S_hxalpha)))))
+
+    return D_xalpha * math.cos(C_xalpha * math.atan(B_xalpha * alpha_s - E_xalpha * (B_xalpha * alpha_s - math.atan(B_xalpha * alpha_s))))
+
+
+@njit(cache=True)
+def mFormulaLateralComb_jit(kappa, alpha, gamma, mu_y, F_z, F0_y, P):
+    S_hykappa = P[P_TIRE_r_hy1]
+
+    kappa_s = kappa + S_hykappa
+
+    B_ykappa = P[P_TIRE_r_by1] * math.cos(math.atan(P[P_TIRE_r_by2] * (alpha - P[P_TIRE_r_by3])))
+    C_ykappa = P[P_TIRE_r_cy1]
+    E_ykappa = P[P_TIRE_r_ey1]
+    D_ykappa = F0_y / (math.cos(C_ykappa * math.atan(B_ykappa * S_hykappa - E_ykappa * (B_ykappa * S_hykappa - math.atan(B_ykappa * S_hykappa)))))
+
+    D_vykappa = mu_y * F_z * (P[P_TIRE_r_vy1] + P[P_TIRE_r_vy3] * gamma) * math.cos(math.atan(P[P_TIRE_r_vy4] * alpha))
+    S_vykappa = D_vykappa * math.sin(P[P_TIRE_r_vy5] * math.atan(P[P_TIRE_r_vy6] * kappa))
+
+    return D_ykappa * math.cos(C_ykappa * math.atan(B_ykappa * kappa_s - E_ykappa * (B_ykappa * kappa_s - math.atan(B_ykappa * kappa_s)))) + S_vykappa
+
+
+@njit(cache=True)
+def vehicleDynamics_MB_jit(x, uInit, P):
+    g = G
+
+    a = P[P_a]
+    b = P[P_b]
+    R_w = P[P_R_w]
+    T_f = P[P_T_f]
+    T_r = P[P_T_r]
+    K_zt = P[P_K_zt]
+    h_s = P[P_h_s]
+    h_raf = P[P_h_raf]
+    h_rar = P[P_h_rar]
+
+    # consider steering constraints
+    u0 = steeringConstraints_jit(x[2], uInit[0], P)
+    u1 = accelerationConstraints_jit(x[3], uInit[1], P)
+
+    # compute slip angle at cg
+    # switch to kinematic model for small velocities
+    if abs(x[3]) < KS_TO_ST_SPEED_M_PER_SEC:
+        beta = 0.
+    else:
+        beta = math.atan(x[10] / x[3])
+    vel = math.sqrt(x[3] ** 2 + x[10] ** 2)
+
+    # vertical tire forces
+    F_z_LF = (x[16] + R_w * (math.cos(x[13]) - 1) - 0.5 * T_f * math.sin(x[13])) * K_zt
+    F_z_RF = (x[16] + R_w * (math.cos(x[13]) - 1) + 0.5 * T_f * math.sin(x[13])) * K_zt
+    F_z_LR = (x[21] + R_w * (math.cos(x[18]) - 1) - 0.5 * T_r * math.sin(x[18])) * K_zt
+    F_z_RR = (x[21] + R_w * (math.cos(x[18]) - 1) + 0.5 * T_r * math.sin(x[18])) * K_zt
+
+    # obtain individual tire speeds
+    u_w_lf = (x[3] + 0.5 * T_f * x[5]) * math.cos(x[2]) + (x[10] + a * x[5]) * math.sin(x[2])
+    u_w_rf = (x[3] - 0.5 * T_f * x[5]) * math.cos(x[2]) + (x[10] + a * x[5]) * math.sin(x[2])
+    u_w_lr = x[3] + 0.5 * T_r * x[5]
+    u_w_rr = x[3] - 0.5 * T_r * x[5]
+
+    # compute longitudinal slip
+    # switch to kinematic model for small velocities
+    if x[3] < 0 or abs(x[3]) < 2.0:
+        s_lf = 0.
+        s_rf = 0.
+        s_lr = 0.
+        s_rr = 0.
+    else:
+        s_lf = 1 - R_w * x[23] / u_w_lf
+        s_rf = 1 - R_w * x[24] / u_w_rf
+        s_lr = 1 - R_w * x[25] / u_w_lr
+        s_rr = 1 - R_w * x[26] / u_w_rr
+
+    # lateral slip angles
+    # switch to kinematic model for small velocities
+    if abs(x[3]) < KS_SWITCH_SPEED:
+        alpha_LF = 0.
+        alpha_RF = 0.
+        alpha_LR = 0.
+        alpha_RR = 0.
+    else:
+        alpha_LF = math.atan((x[10] + a * x[5] - x[14] * (R_w - x[16])) / (x[3] + 0.5 * T_f * x[5])) - x[2]
+        alpha_RF = math.atan((x[10] + a * x[5] - x[14] * (R_w - x[16])) / (x[3] - 0.5 * T_f * x[5])) - x[2]
+        alpha_LR = math.atan((x[10] - b * x[5] - x[19] * (R_w - x[21])) / (x[3] + 0.5 * T_r * x[5]))
+        alpha_RR = math.atan((x[10] - b * x[5] - x[19] * (R_w - x[21])) / (x[3] - 0.5 * T_r * x[5]))
+
+    # auxiliary suspension movement
+    z_SLF = (h_s - R_w + x[16] - x[11]) / math.cos(x[6]) - h_s + R_w + a * x[8] + 0.5 * (x[6] - x[13]) * T_f
+    z_SRF = (h_s - R_w + x[16] - x[11]) / math.cos(x[6]) - h_s + R_w + a * x[8] - 0.5 * (x[6] - x[13]) * T_f
+    z_SLR = (h_s - R_w + x[21] - x[11]) / math.cos(x[6]) - h_s + R_w - b * x[8] + 0.5 * (x[6] - x[18]) * T_r
+    z_SRR = (h_s - R_w + x[21] - x[11]) / math.cos(x[6]) - h_s + R_w - b * x[8] - 0.5 * (x[6] - x[18]) * T_r
+
+    dz_SLF = x[17] - x[12] + a * x[9] + 0.5 * (x[7] - x[14]) * T_f
+    dz_SRF = x[17] - x[12] + a * x[9] - 0.5 * (x[7] - x[14]) * T_f
+    dz_SLR = x[22] - x[12] - b * x[9] + 0.5 * (x[7] - x[19]) * T_r
+    dz_SRR = x[22] - x[12] - b * x[9] - 0.5 * (x[7] - x[19]) * T_r
+
+    # camber angles
+    gamma_LF = x[6] + P[P_D_f] * z_SLF + P[P_E_f] * (z_SLF) ** 2
+    gamma_RF = x[6] - P[P_D_f] * z_SRF - P[P_E_f] * (z_SRF) ** 2
+    gamma_LR = x[6] + P[P_D_r] * z_SLR + P[P_E_r] * (z_SLR) ** 2
+    gamma_RR = x[6] - P[P_D_r] * z_SRR - P[P_E_r] * (z_SRR) ** 2
+
+    # compute longitudinal tire forces using the magic formula for pure slip
+    F0_x_LF = mFormulaLongitudinal_jit(s_lf, gamma_LF, F_z_LF, P)
+    F0_x_RF = mFormulaLongitudinal_jit(s_rf, gamma_RF, F_z_RF, P)
+    F0_x_LR = mFormulaLongitudinal_jit(s_lr, gamma_LR, F_z_LR, P)
+    F0_x_RR = mFormulaLongitudinal_jit(s_rr, gamma_RR, F_z_RR, P)
+
+    # compute lateral tire forces using the magic formula for pure slip
+    F0_y_LF, mu_y_LF = mFormulaLateral_jit(alpha_LF, gamma_LF, F_z_LF, P)
+    F0_y_RF, mu_y_RF = mFormulaLateral_jit(alpha_RF, gamma_RF, F_z_RF, P)
+    F0_y_LR, mu_y_LR = mFormulaLateral_jit(alpha_LR, gamma_LR, F_z_LR, P)
+    F0_y_RR, mu_y_RR = mFormulaLateral_jit(alpha_RR, gamma_RR, F_z_RR, P)
+
+    # compute longitudinal tire forces using the magic formula for combined slip
+    F_x_LF = mFormulaLongitudinalComb_jit(s_lf, alpha_LF, F0_x_LF, P)
+    F_x_RF = mFormulaLongitudinalComb_jit(s_rf, alpha_RF, F0_x_RF, P)
+    F_x_LR = mFormulaLongitudinalComb_jit(s_lr, alpha_LR, F0_x_LR, P)
+    F_x_RR = mFormulaLongitudinalComb_jit(s_rr, alpha_RR, F0_x_RR, P)
+
+    # compute lateral tire forces using the magic formula for combined slip
+    F_y_LF = mFormulaLateralComb_jit(s_lf, alpha_LF, gamma_LF, mu_y_LF, F_z_LF, F0_y_LF, P)
+    F_y_RF = mFormulaLateralComb_jit(s_rf, alpha_RF, gamma_RF, mu_y_RF, F_z_RF, F0_y_RF, P)
+    F_y_LR = mFormulaLateralComb_jit(s_lr, alpha_LR, gamma_LR, mu_y_LR, F_z_LR, F0_y_LR, P)
+    F_y_RR = mFormulaLateralComb_jit(s_rr, alpha_RR, gamma_RR, mu_y_RR, F_z_RR, F0_y_RR, P)
+
+    # auxiliary movements for compliant joint equations
+    delta_z_f = h_s - R_w + x[16] - x[11]
+    delta_z_r = h_s - R_w + x[21] - x[11]
+
+    delta_phi_f = x[6] - x[13]
+    delta_phi_r = x[6] - x[18]
+
+    dot_delta_phi_f = x[7] - x[14]
+    dot_delta_phi_r = x[7] - x[19]
+
+    dot_delta_z_f = x[17] - x[12]
+    dot_delta_z_r = x[22] - x[12]
+
+    dot_delta_y_f = x[10] + a * x[5] - x[15]
+    dot_delta_y_r = x[10] - b * x[5] - x[20]
+
+    delta_f = delta_z_f * math.sin(x[6]) - x[27] * math.cos(x[6]) - (h_raf - R_w) * math.sin(delta_phi_f)
+    delta_r = delta_z_r * math.sin(x[6]) - x[28] * math.cos(x[6]) - (h_rar - R_w) * math.sin(delta_phi_r)
+
+    dot_delta_f = (delta_z_f * math.cos(x[6]) + x[27] * math.sin(x[6])) * x[7] + dot_delta_z_f * math.sin(x[6]) - dot_delta_y_f * math.cos(x[6]) - (h_raf - R_w) * math.cos(delta_phi_f) * dot_delta_phi_f
+    dot_delta_r = (delta_z_r * math.cos(x[6]) + x[28] * math.sin(x[6])) * x[7] + dot_delta_z_r * math.sin(x[6]) - dot_delta_y_r * math.cos(x[6]) - (h_rar - R_w) * math.cos(delta_phi_r) * dot_delta_phi_r
+
+    # compliant joint forces
+    F_RAF = delta_f * P[P_K_ras] + dot_delta_f * P[P_K_rad]
+    F_RAR = delta_r * P[P_K_ras] + dot_delta_r * P[P_K_rad]
+
+    # auxiliary suspension forces (bump stop neglected  squat/lift forces neglected)
+    F_SLF = P[P_m_s] * g * b / (2 * (a + b)) - z_SLF * P[P_K_sf] - dz_SLF * P[P_K_sdf] + (x[6] - x[13]) * P[P_K_tsf] / T_f
+    F_SRF = P[P_m_s] * g * b / (2 * (a + b)) - z_SRF * P[P_K_sf] - dz_SRF * P[P_K_sdf] - (x[6] - x[13]) * P[P_K_tsf] / T_f
+    F_SLR = P[P_m_s] * g * a / (2 * (a + b)) - z_SLR * P[P_K_sr] - dz_SLR * P[P_K_sdr] + (x[6] - x[18]) * P[P_K_tsr] / T_r
+    F_SRR = P[P_m_s] * g * a / (2 * (a + b)) - z_SRR * P[P_K_sr] - dz_SRR * P[P_K_sdr] - (x[6] - x[18]) * P[P_K_tsr] / T_r
+
+    # auxiliary variables sprung mass
+    sumX = F_x_LR + F_x_RR + (F_x_LF + F_x_RF) * math.cos(x[2]) - (F_y_LF + F_y_RF) * math.sin(x[2])
+
+    sumN = (F_y_LF + F_y_RF) * a * math.cos(x[2]) + (F_x_LF + F_x_RF) * a * math.sin(x[2]) \
+           + (F_y_RF - F_y_LF) * 0.5 * T_f * math.sin(x[2]) + (F_x_LF - F_x_RF) * 0.5 * T_f * math.cos(x[2]) \
+           + (F_x_LR - F_x_RR) * 0.5 * T_r - (F_y_LR + F_y_RR) * b
+
+    sumY_s = (F_RAF + F_RAR) * math.cos(x[6]) + (F_SLF + F_SLR + F_SRF + F_SRR) * math.sin(x[6])
+
+    sumL = 0.5 * F_SLF * T_f + 0.5 * F_SLR * T_r - 0.5 * F_SRF * T_f - 0.5 * F_SRR * T_r \
+           - F_RAF / math.cos(x[6]) * (h_s - x[11] - R_w + x[16] - (h_raf - R_w) * math.cos(x[13])) \
+           - F_RAR / math.cos(x[6]) * (h_s - x[11] - R_w + x[21] - (h_rar - R_w) * math.cos(x[18]))
+
+    sumZ_s = (F_SLF + F_SLR + F_SRF + F_SRR) * math.cos(x[6]) - (F_RAF + F_RAR) * math.sin(x[6])
+
+    sumM_s = a * (F_SLF + F_SRF) - b * (F_SLR + F_SRR) + ((F_x_LF + F_x_RF) * math.cos(x[2])
+                                                        - (F_y_LF + F_y_RF) * math.sin(x[2]) + F_x_LR + F_x_RR) * (h_s - x[11])
+
+    # auxiliary variables unsprung mass
+    sumL_uf = 0.5 * F_SRF * T_f - 0.5 * F_SLF * T_f - F_RAF * (h_raf - R_w) \
+              + F_z_LF * (R_w * math.sin(x[13]) + 0.5 * T_f * math.cos(x[13]) - P[P_K_lt] * F_y_LF) \
+              - F_z_RF * (-R_w * math.sin(x[13]) + 0.5 * T_f * math.cos(x[13]) + P[P_K_lt] * F_y_RF) \
+              - ((F_y_LF + F_y_RF) * math.cos(x[2]) + (F_x_LF + F_x_RF) * math.sin(x[2])) * (R_w - x[16])
+
+    sumL_ur = 0.5 * F_SRR * T_r - 0.5 * F_SLR * T_r - F_RAR * (h_rar - R_w) \
+              + F_z_LR * (R_w * math.sin(x[18]) + 0.5 * T_r * math.cos(x[18]) - P[P_K_lt] * F_y_LR) \
+              - F_z_RR * (-R_w * math.sin(x[18]) + 0.5 * T_r * math.cos(x[18]) + P[P_K_lt] * F_y_RR) \
+              - (F_y_LR + F_y_RR) * (R_w - x[21])
+
+    sumZ_uf = F_z_LF + F_z_RF + F_RAF * math.sin(x[6]) - (F_SLF + F_SRF) * math.cos(x[6])
+
+    sumZ_ur = F_z_LR + F_z_RR + F_RAR * math.sin(x[6]) - (F_SLR + F_SRR) * math.cos(x[6])
+
+    sumY_uf = (F_y_LF + F_y_RF) * math.cos(x[2]) + (F_x_LF + F_x_RF) * math.sin(x[2]) \
+              - F_RAF * math.cos(x[6]) - (F_SLF + F_SRF) * math.sin(x[6])
+
+    sumY_ur = (F_y_LR + F_y_RR) \
+              - F_RAR * math.cos(x[6]) - (F_SLR + F_SRR) * math.sin(x[6])
+
+    I_z = P[P_I_z]
+    I_xz_s = P[P_I_xz_s]
+    I_Phi_s = P[P_I_Phi_s]
+    m = P[P_m]
+
+    f = np.empty(29)
+    # dynamics common with single-track model
+    # switch to kinematic model for small velocities
+    if abs(x[3]) < KS_SWITCH_SPEED:
+        # wheelbase
+        lwb = a + b
+        u_ks = np.empty(2)
+        u_ks[0] = u0
+        u_ks[1] = u1
+        f_ks = vehicleDynamics_KS_jit(x, u_ks, P)
+        f[0] = f_ks[0]
+        f[1] = f_ks[1]
+        f[2] = f_ks[2]
+        f[3] = f_ks[3]
+        f[4] = f_ks[4]
+        f[5] = u1 * lwb * math.tan(x[2]) + x[3] / (lwb * math.cos(x[2]) ** 2) * u0
+    else:
+        f[0] = math.cos(beta + x[4]) * vel
+        f[1] = math.sin(beta + x[4]) * vel
+        f[2] = u0
+        f[3] = 1 / m * sumX + x[5] * x[10]
+        f[4] = x[5]
+        f[5] = 1 / (I_z - (I_xz_s) ** 2 / I_Phi_s) * (sumN + I_xz_s / I_Phi_s * sumL)
+
+    # remaining sprung mass dynamics
+    f[6] = x[7]
+    f[7] = 1 / (I_Phi_s - (I_xz_s) ** 2 / I_z) * (I_xz_s / I_z * sumN + sumL)
+    f[8] = x[9]
+    f[9] = 1 / P[P_I_y_s] * sumM_s
+    f[10] = 1 / P[P_m_s] * sumY_s - x[5] * x[3]
+    f[11] = x[12]
+    f[12] = g - 1 / P[P_m_s] * sumZ_s
+
+    # unsprung mass dynamics (front)
+    f[13] = x[14]
+    f[14] = 1 / P[P_I_uf] * sumL_uf
+    f[15] = 1 / P[P_m_uf] * sumY_uf - x[5] * x[3]
+    f[16] = x[17]
+    f[17] = g - 1 / P[P_m_uf] * sumZ_uf
+
+    # unsprung mass dynamics (rear)
+    f[18] = x[19]
+    f[19] = 1 / P[P_I_ur] * sumL_ur
+    f[20] = 1 / P[P_m_ur] * sumY_ur - x[5] * x[3]
+    f[21] = x[22]
+    f[22] = g - 1 / P[P_m_ur] * sumZ_ur
+
+    # convert acceleration input to brake and engine torque
+    if u1 > 0:
+        T_B = 0.
+        T_E = m * R_w * u1
+    else:
+        T_B = m * R_w * u1
+        T_E = 0.
+
+    # wheel dynamics (p.T  new parameter for torque splitting)
+    T_sb = P[P_T_sb]
+    T_se = P[P_T_se]
+    I_y_w = P[P_I_y_w]
+    f[23] = 1 / I_y_w * (-R_w * F_x_LF + 0.5 * T_sb * T_B + 0.5 * T_se * T_E)
+    f[24] = 1 / I_y_w * (-R_w * F_x_RF + 0.5 * T_sb * T_B + 0.5 * T_se * T_E)
+    f[25] = 1 / I_y_w * (-R_w * F_x_LR + 0.5 * (1 - T_sb) * T_B + 0.5 * (1 - T_se) * T_E)
+    f[26] = 1 / I_y_w * (-R_w * F_x_RR + 0.5 * (1 - T_sb) * T_B + 0.5 * (1 - T_se) * T_E)
+
+    # negative wheel spin forbidden
+    for iState in range(23, 27):
+        if x[iState] < 0:
+            x[iState] = 0.
+            f[iState] = 0.
+
+    # compliant joint equations
+    f[27] = dot_delta_y_f
+    f[28] = dot_delta_y_r
+
+    return f
+
+
+@njit(cache=True)
+def vehicleDynamics_KS_batch_jit(x, u, P):
+    """ right hand side for stacked states x (N,n) and inputs u (N,2) """
+    f = np.empty((x.shape[0], 5))
+    for i in range(x.shape[0]):
+        f[i, :] = vehicleDynamics_KS_jit(x[i], u[i], P)
+    return f
+
+
+@njit(cache=True)
+def vehicleDynamics_ST_batch_jit(x, u, P):
+    """ right hand side for stacked states x (N,7) and inputs u (N,2) """
+    f = np.empty((x.shape[0], 7))
+    for i in range(x.shape[0]):
+        f[i, :] = vehicleDynamics_ST_jit(x[i], u[i], P)
+    return f
+
+
+@njit(cache=True)
+def vehicleDynamics_MB_batch_jit(x, u, P):
+    """ right hand side for stacked states x (N,29) and inputs u (N,2) """
+    f = np.empty((x.shape[0], 29))
+    for i in range(x.shape[0]):
+        f[i, :] = vehicleDynamics_MB_jit(x[i], u[i], P)
+    return f
@@ -0,0 +1,183 @@
+# Packs the VehicleParameters structure (with its nested steering, longitudinal and tire parameters) into a flat,
+# contiguous float64 array so that the compiled kernels in vehicleDynamics_jit do not need attribute lookups.
+# The P_ constants are the indexes of each parameter in the array.
+import numpy as np
+
+# vehicle body, mass, suspension and wheel parameters
+P_l = 0
+P_w = 1
+P_m = 2
+P_m_s = 3
+P_m_uf = 4
+P_m_ur = 5
+P_a = 6
+P_b = 7
+P_I_Phi_s = 8
+P_I_y_s = 9
+P_I_z = 10
+P_I_xz_s = 11
+P_K_sf = 12
+P_K_sdf = 13
+P_K_sr = 14
+P_K_sdr = 15
+P_T_f = 16
+P_T_r = 17
+P_K_ras = 18
+P_K_tsf = 19
+P_K_tsr = 20
+P_K_rad = 21
+P_K_zt = 22
+P_h_cg = 23
+P_h_raf = 24
+P_h_rar = 25
+P_h_s = 26
+P_I_uf = 27
+P_I_ur = 28
+P_I_y_w = 29
+P_K_lt = 30
+P_R_w = 31
+P_T_sb = 32
+P_T_se = 33
+P_D_f = 34
+P_D_r = 35
+P_E_f = 36
+P_E_r = 37
+# steering constraints (p.steering)
+P_STEERING_MIN = 38
+P_STEERING_MAX = 39
+P_STEERING_V_MIN = 40
+P_STEERING_V_MAX = 41
+# longitudinal constraints (p.longitudinal)
+P_LONGITUDINAL_V_MIN = 42
+P_LONGITUDINAL_V_MAX = 43
+P_LONGITUDINAL_V_SWITCH = 44
+P_LONGITUDINAL_A_MAX = 45
+# tire parameters (p.tire)
+P_TIRE_p_cx1 = 46
+P_TIRE_p_dx1 = 47
+P_TIRE_p_dx3 = 48
+P_TIRE_p_ex1 = 49
+P_TIRE_p_kx1 = 50
+P_TIRE_p_hx1 = 51
+P_TIRE_p_vx1 = 52
+P_TIRE_r_bx1 = 53
+P_TIRE_r_bx2 = 54
+P_TIRE_r_cx1 = 55
+P_TIRE_r_ex1 = 56
+P_TIRE_r_hx1 = 57
+P_TIRE_p_cy1 = 58
+P_TIRE_p_dy1 = 59
+P_TIRE_p_dy3 = 60
+P_TIRE_p_ey1 = 61
+P_TIRE_p_ky1 = 62
+P_TIRE_p_hy1 = 63
+P_TIRE_p_hy3 = 64
+P_TIRE_p_vy1 = 65
+P_TIRE_p_vy3 = 66
+P_TIRE_r_by1 = 67
+P_TIRE_r_by2 = 68
+P_TIRE_r_by3 = 69
+P_TIRE_r_cy1 = 70
+P_TIRE_r_ey1 = 71
+P_TIRE_r_hy1 = 72
+P_TIRE_r_vy1 = 73
+P_TIRE_r_vy3 = 74
+P_TIRE_r_vy4 = 75
+P_TIRE_r_vy5 = 76
+P_TIRE_r_vy6 = 77
+
+NUM_PARAMETERS = 78
+
+
+def pack_parameters(p):
+    # pack_parameters - packs a parameter structure into a flat array
+    #
+    # Syntax:
+    #    P = pack_parameters(p)
+    #
+    # Inputs:
+    #    p - VehicleParameters, e.g. from parameters_vehicle2()
+    #
+    # Outputs:
+    #    P - float64 array of length NUM_PARAMETERS, index it with the P_ constants
+
+    P = np.zeros(NUM_PARAMETERS, dtype=np.float64)
+    P[P_l] = p.l
+    P[P_w] = p.w
+    P[P_m] = p.m
+    P[P_m_s] = p.m_s
+    P[P_m_uf] = p.m_uf
+    P[P_m_ur] = p.m_ur
+    P[P_a] = p.a
+    P[P_b] = p.b
+    P[P_I_Phi_s] = p.I_Phi_s
+    P[P_I_y_s] = p.I_y_s
+    P[P_I_z] = p.I_z
+    P[P_I_xz_s] = p.I_xz_s
+    P[P_K_sf] = p.K_sf
+    P[P_K_sdf] = p.K_sdf
+    P[P_K_sr] = p.K_sr
+    P[P_K_sdr] = p.K_sdr
+    P[P_T_f] = p.T_f
+    P[P_T_r] = p.T_r
+    P[P_K_ras] = p.K_ras
+    P[P_K_tsf] = p.K_tsf
+    P[P_K_tsr] = p.K_tsr
+    P[P_K_rad] = p.K_rad
+    P[P_K_zt] = p.K_zt
+    P[P_h_cg] = p.h_cg
+    P[P_h_raf] = p.h_raf
+    P[P_h_rar] = p.h_rar
+    P[P_h_s] = p.h_s
+    P[P_I_uf] = p.I_uf
+    P[P_I_ur] = p.I_ur
+    P[P_I_y_w] = p.I_y_w
+    P[P_K_lt] = p.K_lt
+    P[P_R_w] = p.R_w
+    P[P_T_sb] = p.T_sb
+    P[P_T_se] = p.T_se
+    P[P_D_f] = p.D_f
+    P[P_D_r] = p.D_r
+    P[P_E_f] = p.E_f
+    P[P_E_r] = p.E_r
+    P[P_STEERING_MIN] = p.steering.min
+    P[P_STEERING_MAX] = p.steering.max
+    P[P_STEERING_V_MIN] = p.steering.v_min
+    P[P_STEERING_V_MAX] = p.steering.v_max
+    P[P_LONGITUDINAL_V_MIN] = p.longitudinal.v_min
+    P[P_LONGITUDINAL_V_MAX] = p.longitudinal.v_max
+    P[P_LONGITUDINAL_V_SWITCH] = p.longitudinal.v_switch
+    P[P_LONGITUDINAL_A_MAX] = p.longitudinal.a_max
+    P[P_TIRE_p_cx1] = p.tire.p_cx1
+    P[P_TIRE_p_dx1] = p.tire.p_dx1
+    P[P_TIRE_p_dx3] = p.tire.p_dx3
+    P[P_TIRE_p_ex1] = p.tire.p_ex1
+    P[P_TIRE_p_kx1] = p.tire.p_kx1
+    P[P_TIRE_p_hx1] = p.tire.p_hx1
+    P[P_TIRE_p_vx1] = p.tire.p_vx1
+    P[P_TIRE_r_bx1] = p.tire.r_bx1
+    P[P_TIRE_r_bx2] = p.tire.r_bx2
+    P[P_TIRE_r_cx1] = p.tire.r_cx1
+    P[P_TIRE_r_ex1] = p.tire.r_ex1
+    P[P_TIRE_r_hx1] = p.tire.r_hx1
+    P[P_TIRE_p_cy1] = p.tire.p_cy1
+    P[P_TIRE_p_dy1] = p.tire.p_dy1
+    P[P_TIRE_p_dy3] = p.tire.p_dy3
+    P[P_TIRE_p_ey1] = p.tire.p_ey1
+    P[P_TIRE_p_ky1] = p.tire.p_ky1
+    P[P_TIRE_p_hy1] = p.tire.p_hy1
+    P[P_TIRE_p_hy3] = p.tire.p_hy3
+    P[P_TIRE_p_vy1] = p.tire.p_vy1
+    P[P_TIRE_p_vy3] = p.tire.p_vy3
+    P[P_TIRE_r_by1] = p.tire.r_by1
+    P[P_TIRE_r_by2] = p.tire.r_by2
+    P[P_TIRE_r_by3] = p.tire.r_by3
+    P[P_TIRE_r_cy1] = p.tire.r_cy1
+    P[P_TIRE_r_ey1] = p.tire.r_ey1
+    P[P_TIRE_r_hy1] = p.tire.r_hy1
+    P[P_TIRE_r_vy1] = p.tire.r_vy1
+    P[P_TIRE_r_vy3] = p.tire.r_vy3
+    P[P_TIRE_r_vy4] = p.tire.r_vy4
+    P[P_TIRE_r_vy5] = p.tire.r_vy5
+    P[P_TIRE_r_vy6] = p.tire.r_vy6
+    return P
@@ -7,10 +7,39 @@ from random import randrange
 from scipy.interpolate import interp1d
 import matplotlib.pyplot as plt
 
+
+def load_trajectory(filename):
+    """
+    loads the time, commands, features and derivatives of one recording
+    CSV recordings are read with pandas alone, so this script also runs from the modeling folder;
+    binary .rec recordings need src.recording, i.e. the repository root on the python path
+    ...
+
+    Parameters
+    ----------
+    filename: str
+        path of a .csv or .rec recording
+
+    Returns
+    -------
+    t, u, x, x_dot: np.arrays
+        timestamps, COMMANDS, FEATURES and PRECALCULATED_DERIVATIVES of the recording
+    """
+    if filename.endswith('.rec'):
+        from src.recording import load_recording, recording_columns, drop_duplicate_times
+        data, info = load_recording(filename)
+        data = drop_duplicate_times(data) # removes "duplicate" timestamps
+        return (np.asarray(data['time'], dtype=float), recording_columns(data, COMMANDS),
+                recording_columns(data, FEATURES), recording_columns(data, PRECALCULATED_DERIVATIVES))
+    data = pd.read_csv(filename, comment='#')
+    data = data.drop_duplicates('time') # removes "duplicate" timestamps
+    return data['time'].values, data[COMMANDS].values, data[FEATURES].values, data[PRECALCULATED_DERIVATIVES].values
+
+
 class Data:
     """
     A class for simplified loading of simulator data for use with pysindy
-    Supports loading data from single or multiple .csv files
+    Supports loading data from single or multiple .csv or binary .rec recordings
     ...
 
     Attributes
@@ -33,10 +62,10 @@ class Data:
         Parameters
         ----------
         data_dir: str
-            directory containing .csv files
+            directory containing .csv or .rec recordings
         """
 
-        file_list = glob.glob(data_dir + '/*.csv')
+        file_list = glob.glob(data_dir + '/*.csv') + glob.glob(data_dir + '/*.rec')
 
         if len(file_list) == 0:
             raise Exception("Data directory is empty!")
@@ -44,14 +73,7 @@ class Data:
         elif len(file_list) == 1:
             multiple_trajectories = False
 
-            full_path = data_dir + '/' + file_list[0]
-            data = pd.read_csv(full_path, comment='#')
-            data = data.drop_duplicates('time')
-            
-            t = data['time'].values
-            u = data[COMMANDS].values
-            x = data[FEATURES].values
-            x_dot = data[PRECALCULATED_DERIVATIVES].values
+            t, u, x, x_dot = load_trajectory(file_list[0])
 
         else:
             multiple_trajectories = True
@@ -61,19 +83,11 @@ class Data:
             x_dot = []
             u = []
             for filename in file_list:
-                full_path = data_dir + '/' + filename
-                data = pd.read_csv(full_path, comment='#')
-                data = data.drop_duplicates('time') # removes "duplicate" timestamps 
-
-                t_single = data['time']
-                u_single = data[COMMANDS]
-                x_single = data[FEATURES]
-                x_dot_single = data[PRECALCULATED_DERIVATIVES]
-
-                t.append(t_single.values)
-                x.append(x_single.values)
-                x_dot.append(x_dot_single.values)
-                u.append(u_single.values) 
+                t_i, u_i, x_i, x_dot_i = load_trajectory(filename)
+                t.append(t_i)
+                x.append(x_i)
+                x_dot.append(x_dot_i)
+                u.append(u_i)
 
         self.x = x
         self.x_dot = x_dot
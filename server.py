@@ -2,10 +2,11 @@
 
 import argparse
 import atexit
-import copy
-import socket, pickle
+import random
+import selectors
+import socket
 from queue import Empty
-from typing import Dict, Tuple, List, Optional
+from typing import Dict, Tuple, List, Optional, Set
 
 import argcomplete
 from timeit import default_timer as timer
@@ -17,13 +18,25 @@ from src.l2race_utils import set_logging_level, loop_timer, become_daemon, \
     find_unbound_port_in_range
 from src.my_args import server_args
 from src.car_model import car_model
+from src.car_model_batch import car_model_batch
 from src.globals import *
-from src.track import track, list_tracks
+from src.track_geometry import track_geometry, list_tracks
 from src.l2race_utils import my_logger
+from src.protocol import encode_message, decode_message, protocol_error, car_info, state_encoder, \
+    split_message, reassembler, RECV_BUFFER_BYTES, car_states_to_records
+from src.state_ring import state_ring_writer
+from src.model_state_recorder import model_state_recorder
+from src.tick_stats import tick_stats, is_local_client
 
 logger = my_logger(__name__)
 SKIP_CHECK_SERVER_QUEUE = 0  # use to reduce checking queue, but causes timeout problems with adding car if too big. 0 to disable
 MAX_TIMESTEP = 0.1  # Max timestep of car model simulation. We limit it to avoid instability
+BATCH_INTEGRATOR = True  # True to advance all cars on a track together with car_model_batch, using car_model.INTEGRATOR or rk4 in place of solve_ivp; False to call car_model.update for each car
+EVENT_LOOP = True  # True to wake the track loop on client messages and tick deadlines (run_event_loop), False to poll and sleep (run_polling_loop)
+STATE_RING = True  # True to write the car states and tick statistics of each track to its src.state_ring for other processes on this host
+SERVER_MSG_INTERVAL_S = 1.0  # interval for sending each car's car_state.server_msg to its client, it is not part of 'state'
+LOCKSTEP_DT = 1. / MODEL_UPDATE_RATE_HZ  # fixed simulation time step of each tick in --lockstep mode
+SERVER_LOOP_TIMEOUT_S = 0.05  # the main server loop wakes at least this often to handle worker results and clients waiting for their track
 
 def get_args():
     parser = argparse.ArgumentParser(
@@ -37,159 +50,235 @@ def get_args():
 
 
 def send_message(socket: socket, lock: mp.Lock, client_addr: Tuple[str, int], msg: object):
+    logger.debug('sending msg {} to client {}'.format(msg, client_addr))
+    datagrams = split_message(encode_message(*msg))  # before taking the lock, so an encoding error does not release a lock we do not hold
+    if lock: lock.acquire()
     try:
-        logger.debug('sending msg {} to client {}'.format(msg, client_addr))
-        p = pickle.dumps(msg)
-        if lock: lock.acquire()
-        try:
+        for p in datagrams:
             socket.sendto(p, client_addr)
-        except OSError as e:
-            logger.error('failed sending msg {} to client {}: {}'.format(msg, client_addr, e))
+    except OSError as e:
+        logger.error('failed sending msg {} to client {}: {}'.format(msg, client_addr, e))
     finally:
         if lock: lock.release()
 
 
-class track_server_process(mp.Process):
-    ''' The main process that runs each track.'''
+def check_server_payload(cmd: str, payload: object) -> None:
+    """
+    Checks the payload of a client message to the server port, which comes from untrusted clients.
+
+    :param cmd: the cmd of the message
+    :param payload: its decoded payload
+    :raises protocol_error: if the payload of an 'add_car' is not a [track_name, car_name] pair of str, or that of an
+        'add_spectator' is not a track_name str
+    """
+    if cmd == 'add_car':
+        if not (isinstance(payload, (list, tuple)) and len(payload) == 2 and all(isinstance(p, str) for p in payload)):
+            raise protocol_error('add_car payload {!r} is not [track_name, car_name]'.format(payload))
+    elif cmd == 'add_spectator':
+        if not isinstance(payload, str):
+            raise protocol_error('add_spectator payload {!r} is not a track_name'.format(payload))
+
+
+class track_server:
+    ''' The simulation of one track, with its cars, spectators and the socket its clients talk to. Runs in a track_worker_process.'''
     def __init__(self,
-                 queue_from_server: mp.Queue,
-                 server_port_lock: mp.Lock(),
-                 server_socket: socket,
                  track_name=None,
                  port: int = None,
-                 allow_off_track=False):
-        super(track_server_process, self).__init__(name='track_server_process-{}'.format(track_name))
-        self.server_queue = queue_from_server
-        self.server_port_lock = server_port_lock
-        self.server_socket = server_socket  # used for initial communication to client who has not yet sent anything to us on the new port
+                 allow_off_track=False,
+                 keep_alive=False,
+                 record_folder: Optional[str] = None,
+                 lockstep: bool = False,
+                 seed: Optional[int] = None,
+                 server_port: int = SERVER_PORT):
         self.track_name = track_name
-        self.track = None  # create after start since Process.spawn cannot pickle it
+        self.server_port = server_port  # port of the main server, names our state ring apart from those of other servers on this host
+        self.track = None  # created in start() since Process.spawn cannot pickle it
         self.car_dict: Dict[Tuple[str, int], car_model] = None  # maps from client_addr to car_model (or None if a spectator)
         # each client process should bind it's own unique local port (on remote client) so should be unique in dict
         self.car_states_list: List[car_state] = None  # list of all car states, to send to clients and put in each car's state
+        self.state_encoder: Optional[state_encoder] = None  # encodes car_states_list as 'state', once per tick and baseline
+        self.state_requests: Set[Tuple[str, int]] = None  # clients that asked for the state since the last broadcast
+        self.client_acks: Dict[Tuple[str, int], Optional[int]] = None  # seq of the last 'state' each client decoded
+        self.reassembler: Optional[reassembler] = None  # puts together messages that clients sent in chunks
         self.spectator_list: List[Tuple[str, int]] = None  # maps from client_addr to car_model (or None if a spectator)
         self.track_socket: Optional[socket] = None  # make a new datagram socket
         self.local_port_number = port
         self.track_socket_address = None  # get the port info for our local port
         self.exit = False
         self.last_message_time = timer()  # used to terminate ourselves if no messages for some time
-        self.skip_checking_server_queue_count = 0
+        self.next_car_id = 0  # static_info.car_id of the next car added, clients know cars by this id
+        self.last_server_msg_time = timer()
 
         self.allow_off_track = allow_off_track
-
-        atexit.register(self.cleanup)
-
-    def cleanup(self):
-        logger.info('cleaning up {} process'.format(self.track_name))
-        self.send_all_clients_string_message('track has shut down')
-        if self.car_dict:
-            for c in self.car_dict.keys():
-                self.send_client_msg(c,'track_shutdown', 'track server has shut down')
-        if self.spectator_list:
-            for s in self.spectator_list:
-                self.send_client_msg(s, 'track_shutdown', 'track server has shut down')
-        # empty queue
-        if self.server_queue and not self.server_queue.empty:
-            item = self.server_queue.get(block=False)
-            while item:
-                try:
-                    self.server_queue.get(block=False)
-                except Empty:
-                    break
-        try:
-            sleep(1)
-        except Exception:
-            pass
-        self.server_queue.close()
-        if self.track_socket:
-            self.track_socket.close()
-
-    def run(self):
-        # logger.setLevel(logging.DEBUG)
-        logger.info("Starting track process track {}".format(self.track_name))
-        self.track = track(self.track_name)
+        self.keep_alive = keep_alive  # True for tracks preloaded by the server, which keep running without clients
+        self.batch = None  # car_model_batch used to update all the cars together, made in start()
+        self.state_ring: Optional[state_ring_writer] = None  # shares the states of each tick with other processes, made in start()
+        self.record_folder = record_folder  # folder for recording the model states of all cars, None to not record
+        self.recorder: Optional[model_state_recorder] = None  # made in start() if record_folder is set
+        # In lockstep mode the models advance by LOCKSTEP_DT only on ticks for which every car sent a command after it got
+        # the state of the previous tick, so a run depends only on the commands and the seed, not on timing or latency.
+        self.lockstep = lockstep
+        self.commanded: Set[Tuple[str, int]] = set()  # cars that sent their command for the next lockstep tick
+        self.rng = random.Random(seed) if seed is not None else None  # start positions of the cars, seeded for reproducible runs
+        self.stats: Optional[tick_stats] = None  # timing statistics of each tick, made in start(), see src.tick_stats
+
+    def start(self):
+        """ loads the track and binds the track socket
+        :raises OSError: if the socket could not be bound to the port that the server told us to use """
+        logger.info("Starting track {}".format(self.track_name))
+        self.track = track_geometry(self.track_name)  # headless, the server never draws the track
         self.car_dict = dict()  # maps from client_addr to car_model (or None if a spectator)
         self.car_states_list = list()  # list of all car states, to send to clients and put in each car's state
         self.spectator_list = list()  # maps from client_addr to car_model (or None if a spectator)
+        self.state_requests = set()
+        self.client_acks = dict()
+        self.reassembler = reassembler()
+        self.state_encoder = state_encoder()
+        self.batch = car_model_batch() if BATCH_INTEGRATOR else None
+        self.stats = tick_stats()
+        self.last_message_time = timer()
         self.track_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # make a new datagram socket
         self.track_socket.settimeout(0)  # put track socket in nonblocking mode to just poll for client messages
         # find range of ports we can try to open for client to connect to
         try:
             self.track_socket.bind(('0.0.0.0', self.local_port_number))
         except Exception as e:
-            logger.error('track process aborting: could not bind to the local port {} that server told us to use: got {}'.format(self.local_port_number, e))
+            logger.error('track {} aborting: could not bind to the local port {} that server told us to use: got {}'.format(self.track_name, self.local_port_number, e))
             raise e
         self.track_socket_address = self.track_socket.getsockname()  # get the port info for our local port
         logger.info('for track {} bound free local UDP port address {}'.format(self.track_name, self.local_port_number))
-        last_time = timer()
+        if STATE_RING:
+            try:
+                self.state_ring = state_ring_writer(self.track_name, self.server_port)
+            except OSError as e:
+                logger.warning('track {} could not make its state ring, it will not be shared: {}'.format(self.track_name, e))
+        if self.record_folder:
+            try:
+                self.recorder = model_state_recorder(self.track_name, self.record_folder)
+            except OSError as e:
+                logger.warning('track {} could not open its model state recording: {}'.format(self.track_name, e))
 
-        # Track process makes a single socket bound to a single port for all the clients (cars and spectators).
+        # Track makes a single socket bound to a single port for all the clients (cars and spectators).
         # To handle multiple clients, when it gets a message from a client, it responds to the client using the client address.
 
-        looper = loop_timer(MODEL_UPDATE_RATE_HZ)
-        looper.LOG_INTERVAL_SEC=60
-        while not self.exit:
-            now = timer()
-            dt = now - last_time
-            last_time = now
-            if now - self.last_message_time > KILL_ZOMBIE_TRACK_TIMEOUT_S:
-                logger.warning('track process {} got no input for {}s, terminating'.format(self.track_name, KILL_ZOMBIE_TRACK_TIMEOUT_S))
-                self.exit = True
-                self.cleanup()
-                continue
-            self.process_server_queue()  # 'add_car' 'add_spectator'
-
-            # Here we make the constrained real time from real time
-            # If requested timestep bigger than maximal timestep, make the update for maximal allowed timestep
-            # We limit timestep to avoid instability
-            if dt > MAX_TIMESTEP:
-                s = 'bounded real dt_sec={:.1f}ms to {:.2f}ms'.format(dt * 1000, MAX_TIMESTEP * 1000)
-                logger.info(s)
-                dt = MAX_TIMESTEP
-
-            # now we do main simulation/response
-            # update all the car models
-            for client, model in self.car_dict.items():
-                if isinstance(model, car_model):
-                    model.update(dt)  # car_state time updates already here
-                    model.time += dt  # car_model time updates here
-                    # poll for UDP messages
-            # update the global list of car states that cars share
-            self.car_states_list.clear()
-            for model in self.car_dict.values():
-                # put copy of each state in list but strip off the contained list of other car states
-                model_copy: car_state = copy.copy(model.car_state)
-                self.car_states_list.append(model_copy)
+    def cleanup(self):
+        logger.info('cleaning up track {}'.format(self.track_name))
+        if self.track_socket:
+            self.send_all_clients_string_message('track has shut down')
+            if self.car_dict:
+                for c in self.car_dict.keys():
+                    self.send_client_msg(c,'track_shutdown', 'track server has shut down')
+            if self.spectator_list:
+                for s in self.spectator_list:
+                    self.send_client_msg(s, 'track_shutdown', 'track server has shut down')
+            self.track_socket.close()
+            self.track_socket = None
+        if self.state_ring:
+            self.state_ring.close()
+            self.state_ring = None
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def load(self) -> int:
+        """ :returns: the load of this track used to place tracks on workers, the track itself counts as one car """
+        return 1 + (len(self.car_dict) if self.car_dict else 0)
+
+    def tick(self, now, dt):
+        """
+        One simulation step: checks for a zombie track, then updates all the car models by dt.
 
+        :param now: the current timer() time
+        :param dt: the real time since the last tick in seconds
+        """
+        if not self.keep_alive and now - self.last_message_time > KILL_ZOMBIE_TRACK_TIMEOUT_S:
+            logger.warning('track {} got no input for {}s, terminating'.format(self.track_name, KILL_ZOMBIE_TRACK_TIMEOUT_S))
+            self.exit = True  # the worker cleans up
+            return
 
-            # process incoming UDP messages from clients, e.g. to update command
-            while True:
-                try:
-                    msg, payload, client = self.receive_msg()
-                    self.handle_client_msg(msg, payload, client)
-                except socket.timeout:
-                    break
-                except BlockingIOError:
-                    break
-                except Exception as e:
-                    logger.warning('caught Exception {} while processing UDP messages from client'.format(e))
-                    break
+        if self.lockstep:
+            if not self.lockstep_ready():
+                return  # wait for the commands of all cars
+            self.commanded.clear()
+            dt = LOCKSTEP_DT
+        # Here we make the constrained real time from real time
+        # If requested timestep bigger than maximal timestep, make the update for maximal allowed timestep
+        # We limit timestep to avoid instability
+        elif dt > MAX_TIMESTEP:
+            s = 'bounded real dt_sec={:.1f}ms to {:.2f}ms'.format(dt * 1000, MAX_TIMESTEP * 1000)
+            logger.info(s)
+            dt = MAX_TIMESTEP
+
+        # now we do main simulation/response
+        # update all the car models
+        update_start_time = timer()
+        models = [model for model in self.car_dict.values() if isinstance(model, car_model)]
+        if self.batch:
+            self.batch.update(models, dt)  # car_state time updates already here
+        else:
+            for model in models:
+                model.update(dt)  # car_state time updates already here
+        for model in models:
+            model.time += dt  # car_model time updates here
+        update_time = timer() - update_start_time
+        if self.recorder:
+            self.recorder.record(models, dt)
+        # update the global list of car states that cars share
+        self.car_states_list.clear()
+        for model in self.car_dict.values():
+            self.car_states_list.append(model.car_state)
+        encode_start_time = timer()
+        records = car_states_to_records(self.car_states_list) if self.state_ring else None
+        self.state_encoder.new_tick(self.car_states_list, records)
+        self.stats.add_send(timer() - encode_start_time)
+        if self.state_ring:
+            self.state_ring.write(self.car_states_list, now, dt, timer() - update_start_time,
+                                  len(self.car_dict) + len(self.spectator_list), records=records)
+        if self.lockstep:
+            self.state_requests.update(self.car_dict.keys())  # every car needs this state to send its next command
+        if now - self.last_server_msg_time > SERVER_MSG_INTERVAL_S:
+            self.last_server_msg_time = now
+            self.send_server_msgs()
+        self.stats.end_tick(now, dt, models, update_time, timer() - update_start_time, self.track.query_count)
+
+    def lockstep_ready(self) -> bool:
+        """ :returns: True if all cars sent their command for the next lockstep tick, or there was no tick yet """
+        if self.state_encoder.seq < 0:
+            return True
+        return all(client in self.commanded for client in self.car_dict)
+
+    def receive_client_msgs(self):
+        """ handles all the client messages waiting on the track socket """
+        start_time = timer()
+        n_msgs = 0
+        while True:
             try:
-                looper.sleep_leftover_time()
-            except KeyboardInterrupt:
-                logger.info('KeyboardInterrupt, stopping server')
-                self.exit = True
+                msg, payload, client = self.receive_msg()
+                if msg is not None:
+                    n_msgs += 1
+                    self.handle_client_msg(msg, payload, client)
+            except socket.timeout:
+                break
+            except BlockingIOError:
+                break
+            except protocol_error as e:
+                logger.warning('ignoring invalid message from client: {}'.format(e))
                 continue
-
-        self.cleanup()
-        logger.info('ended track {}'.format(self.track_name))
+            except Exception as e:
+                logger.warning('caught Exception {} while processing UDP messages from client'.format(e))
+                break
+        self.stats.add_receive(n_msgs, timer() - start_time)
 
     def receive_msg(self) -> (str, object, Tuple[str, int]):
         """
         receives a message from client using track's socket
-        :returns msg, payload, client - msg is a str, payload is an object, and client is Tuple[str,int] """
-        p, client = self.track_socket.recvfrom(2048)
-        (msg, payload) = pickle.loads(p)
+        :returns msg, payload, client - msg is a str, payload is an object, and client is Tuple[str,int].
+            msg and payload are None if the datagram was a chunk of a message that is not complete yet """
+        p, client = self.track_socket.recvfrom(RECV_BUFFER_BYTES)
+        p = self.reassembler.add(p, client)
+        if p is None:
+            return None, None, client
+        (msg, payload) = decode_message(p)
         logger.debug('got msg={} with payload={} from client {}'.format(msg, payload, client))
         return msg, payload, client
 
@@ -220,11 +309,22 @@ class track_server_process(mp.Process):
             if car_model is None:
                 logger.warning('car model=None for client {}'.format(client))
                 return
-            car_model.car_state.command = payload  # update our car_state command input
+            command, self.client_acks[client] = payload
+            if self.lockstep:
+                if self.client_acks[client] != self.state_encoder.seq:
+                    self.send_states(client)
+                    return  # the car did not see the last tick yet, its command is for an earlier tick
+                self.commanded.add(client)
+                car_model.car_state.command = command
+                return  # the state after the tick this command is for goes to all cars at the end of the tick
+            car_model.car_state.command = command  # update our car_state command input
             # respond with complete state of all cars
             self.send_states(client)
         elif msg == 'send_states':
+            self.client_acks[client] = payload if isinstance(payload, int) else None
             self.send_states(client)
+        elif msg == 'send_car_info':
+            self.send_car_info(client, payload)
         elif msg == 'restart_car':
              self.restart_car(client, payload)
         elif msg == 'remove_car':
@@ -232,16 +332,76 @@ class track_server_process(mp.Process):
             if not car_model is None:
                 logger.info('removing car {} from track {}'.format(car_model.car_state.static_info.name, self.track_name))
                 del self.car_dict[client]
+            self.state_requests.discard(client)
+            self.commanded.discard(client)
+            self.client_acks.pop(client, None)
+            self.state_encoder.remove_client(client)
         elif msg == 'remove_spectator':
             logger.info('removing spectator {} from track {}'.format(client, self.track_name))
             self.spectator_list.remove(client)
+            self.state_requests.discard(client)
+            self.client_acks.pop(client, None)
+            self.state_encoder.remove_client(client)
+        elif msg == 'get_stats':
+            self.send_stats(client, payload)
         else:
             logger.warning('unknown cmd {} received; ignoring'.format(msg))
 
+    def send_stats(self, client, payload):
+        """ answers a 'get_stats' message of a local client with the summary of our tick statistics, see src.tick_stats.query_tick_stats """
+        if not is_local_client(client):
+            logger.warning('ignoring get_stats from client {} that is not on this host'.format(client))
+            return
+        stats = self.stats.summary()
+        stats['track_name'] = self.track_name
+        stats['n_cars'] = len(self.car_dict)
+        if isinstance(payload, dict) and payload.get('dump'):
+            try:
+                stats['dump'] = self.stats.dump(self.track_name)
+                logger.info('track {} dumped its tick statistics to {}'.format(self.track_name, stats['dump']))
+            except OSError as e:
+                logger.warning('track {} could not dump its tick statistics: {}'.format(self.track_name, e))
+        self.send_client_msg(client, 'stats', stats)
+
     def send_states(self, client):
-        msg = 'state'
-        payload = self.car_states_list  # client works out which one belongs to it from the client_ip
-        self.send_client_msg(client, msg, payload)
+        """ subscribes client to the next broadcast of the state of all cars """
+        self.state_requests.add(client)
+
+    def broadcast_states(self):
+        """
+        Sends the state of all cars to the clients that asked for it since the last broadcast.
+        The state is a delta against the state each client acknowledged; it is encoded only once per tick for each
+        distinct acknowledged state, however many clients there are.
+        """
+        if not self.state_requests or self.state_encoder.seq < 0:
+            return  # nothing asked, or no tick yet
+        start_time = timer()
+        for client in self.state_requests:
+            datagrams = self.state_encoder.datagrams_for(self.client_acks.get(client), client)  # clients work out which car belongs to them from the car_info
+            try:
+                for d in datagrams:
+                    self.track_socket.sendto(d, client)
+            except OSError as e:
+                logger.error('failed sending state to client {}: {}'.format(client, e))
+        self.state_requests.clear()
+        self.stats.add_send(timer() - start_time)
+
+    def send_car_info(self, client, car_id):
+        """ sends the static_info of car car_id, for a client that got a 'state' with a car it does not know yet """
+        for model in self.car_dict.values():
+            if model.car_state.static_info.car_id == car_id:
+                self.send_client_msg(client, 'car_info', car_info(model.car_state))
+                return
+        logger.debug('client {} asked for info of unknown car_id {}'.format(client, car_id))
+
+    def send_all_clients_car_info(self, model: car_model):
+        for c in list(self.car_dict.keys()) + self.spectator_list:
+            self.send_client_msg(c, 'car_info', car_info(model.car_state))
+
+    def send_server_msgs(self):
+        """ sends each car its server_msg (timing and laps), which is free text and so not part of 'state' """
+        for client, model in self.car_dict.items():
+            self.send_client_msg(client, 'server_msg', model.car_state.server_msg)
 
     def add_car_to_track(self, car_name, client_addr):
         """ adds a car to this track """
@@ -251,8 +411,12 @@ class track_server_process(mp.Process):
         if self.car_dict.get(client_addr):
             logger.warning('client at {} already has a car model, replacing it with a new model'.format(client_addr))
         logger.info('adding car model for car named {} from client {} to track {}'.format(car_name, client_addr, self.track_name))
-        mod = car_model(track=self.track, car_name=car_name, client_ip=client_addr, allow_off_track=self.allow_off_track)
+        mod = car_model(track=self.track, car_name=car_name, client_ip=client_addr, allow_off_track=self.allow_off_track,
+                        rng=self.rng)
+        mod.car_state.static_info.car_id = self.next_car_id
+        self.next_car_id = (self.next_car_id + 1) % 65536
         self.car_dict[client_addr] = mod
+        self.send_all_clients_car_info(mod)
 
     def add_spectator_to_track(self, client_addr):
         """ adds a spectator to this track """
@@ -262,22 +426,12 @@ class track_server_process(mp.Process):
         logger.debug('adding spectator from client {} to track {}'.format(client_addr, self.track_name))
         self.spectator_list.append(client_addr)
 
-    def process_server_queue(self):
-        if SKIP_CHECK_SERVER_QUEUE > 0:
-            self.skip_checking_server_queue_count += 1
-            if self.skip_checking_server_queue_count % SKIP_CHECK_SERVER_QUEUE != 0: return
-        while not self.server_queue.empty():
-            (cmd, payload) = self.server_queue.get_nowait()
-            self.handle_server_msg(cmd, payload)
-        pass
-
     def handle_server_msg(self, cmd, payload):
         logger.debug('got queue message from server manager cmd={} payload={}'.format(cmd, payload))
         self.last_message_time = timer()
         if cmd == 'stop':
             logger.info('track {} stopping'.format(self.track_name))
-            self.cleanup()
-            self.exit = True
+            self.exit = True  # the worker cleans up
         elif cmd == 'add_car':
             (car_name, client_addr) = payload
             self.add_car_to_track(car_name, client_addr)
@@ -299,6 +453,215 @@ class track_server_process(mp.Process):
             return
 
 
+class track_worker_process(mp.Process):
+    ''' A worker process that runs the track_server of one or more tracks in a single loop.
+    The main process places tracks on the workers by load and sends them messages on queue_from_server;
+    the worker reports 'load', 'track_ready' and 'track_stopped' back on queue_to_server.'''
+    def __init__(self,
+                 worker_id: int,
+                 queue_from_server: mp.Queue,
+                 queue_to_server: mp.Queue,
+                 record_folder: Optional[str] = None,
+                 lockstep: bool = False,
+                 seed: Optional[int] = None,
+                 server_port: int = SERVER_PORT):
+        super(track_worker_process, self).__init__(name='track_worker_process-{}'.format(worker_id))
+        self.server_port = server_port  # port of the main server, see track_server
+        self.worker_id = worker_id
+        self.record_folder = record_folder  # folder for the model state recordings of the tracks, None to not record
+        self.lockstep = lockstep  # run the tracks in lockstep mode, see track_server
+        self.seed = seed  # seed of the random start positions on each track, None for unseeded
+        self.server_queue = queue_from_server
+        self.result_queue = queue_to_server
+        self.tracks: Dict[str, track_server] = None  # maps from track name to its track_server, made in run()
+        self.selector: Optional[selectors.BaseSelector] = None  # waits on the sockets of all our tracks
+        self.exit = False
+        self.skip_checking_server_queue_count = 0
+        self.last_load = None  # last load reported to the server
+
+    def run(self):
+        logger.info('Starting track worker process {}'.format(self.worker_id))
+        self.tracks = dict()
+        self.selector = selectors.DefaultSelector()
+        atexit.register(self.cleanup)
+
+        if EVENT_LOOP:
+            self.run_event_loop()
+        else:
+            self.run_polling_loop()
+
+        self.cleanup()
+        logger.info('ended track worker {}'.format(self.worker_id))
+
+    def cleanup(self):
+        logger.info('cleaning up track worker {}'.format(self.worker_id))
+        if self.tracks:
+            for track_name in list(self.tracks.keys()):
+                self.stop_track(track_name)
+        # empty queue
+        while True:
+            try:
+                self.server_queue.get(block=False)
+            except (Empty, OSError, ValueError):
+                break
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+
+    def run_polling_loop(self):
+        """
+        Worker loop that updates the models of all tracks, then polls their sockets for client messages and sleeps for the rest of the tick.
+        """
+        looper = loop_timer(MODEL_UPDATE_RATE_HZ)
+        looper.LOG_INTERVAL_SEC=60
+        last_time = timer()
+        while not self.exit:
+            now = timer()
+            dt = now - last_time
+            last_time = now
+            self.tick(now, dt)
+            if self.exit:
+                continue
+
+            # process incoming UDP messages from clients, e.g. to update command
+            for t in self.tracks.values():
+                t.receive_client_msgs()
+                t.broadcast_states()
+            try:
+                wait_start_time = timer()
+                looper.sleep_leftover_time()
+                self.add_slack(timer() - wait_start_time)
+            except KeyboardInterrupt:
+                logger.info('KeyboardInterrupt, stopping worker')
+                self.exit = True
+                continue
+
+    def run_event_loop(self):
+        """
+        Worker loop that waits on the sockets of all tracks until a client message arrives or the next tick is due, whichever comes first.
+        Client messages are handled as soon as they arrive: a command is applied at the next model update and
+        a state request is answered right away with the latest state. The models of all tracks are updated together on a fixed schedule.
+        """
+        period = 1. / MODEL_UPDATE_RATE_HZ
+        last_time = timer()
+        next_tick = last_time
+        try:
+            while not self.exit:
+                timeout = max(0., next_tick - timer())
+                wait_start_time = timer()
+                if self.tracks:
+                    events = self.selector.select(timeout)
+                else:
+                    sleep(timeout)  # select() without any socket is an error on some platforms
+                    events = []
+                self.add_slack(timer() - wait_start_time)
+                for key, mask in events:
+                    t = key.data
+                    t.receive_client_msgs()
+                    t.broadcast_states()
+                now = timer()
+                if now >= next_tick:
+                    self.tick(now, now - last_time)
+                    for t in self.tracks.values():
+                        t.broadcast_states()  # requests that came before the first tick; in lockstep mode the new state to all cars
+                    last_time = now
+                    next_tick += period
+                    if next_tick < now:  # fell behind, e.g. slow model update; skip the missed ticks instead of bursting
+                        next_tick = now + period
+        except KeyboardInterrupt:
+            logger.info('KeyboardInterrupt, stopping worker')
+            self.exit = True
+
+    def tick(self, now, dt):
+        """
+        One step of the worker: handles the server queue messages, then ticks all the tracks and stops the ones that exited.
+
+        :param now: the current timer() time
+        :param dt: the real time since the last tick in seconds
+        """
+        self.process_server_queue()  # 'start_track' 'add_car' 'add_spectator' 'stop'
+        if self.exit:
+            return
+        for track_name, t in list(self.tracks.items()):
+            t.tick(now, dt)
+            if t.exit:
+                self.stop_track(track_name)
+        self.report_load()
+
+    def add_slack(self, seconds):
+        """ adds the time the worker waited to the tick statistics of all its tracks """
+        for t in self.tracks.values():
+            t.stats.add_slack(seconds)
+
+    def report_load(self):
+        """ tells the server our load when it changed, for placing new tracks """
+        load = sum(t.load() for t in self.tracks.values())
+        if load != self.last_load:
+            self.last_load = load
+            self.result_queue.put(('load', (self.worker_id, load)))
+
+    def start_track(self, track_name, port, allow_off_track, keep_alive):
+        """ starts running track_name on port, unless we already run it, and tells the server when its clients can connect """
+        if track_name in self.tracks:
+            self.result_queue.put(('track_ready', (self.worker_id, track_name)))
+            return
+        t = track_server(track_name=track_name, port=port, allow_off_track=allow_off_track, keep_alive=keep_alive,
+                         record_folder=self.record_folder, lockstep=self.lockstep, seed=self.seed,
+                         server_port=self.server_port)
+        try:
+            t.start()
+        except Exception as e:
+            logger.error('worker {} could not start track {}: {}'.format(self.worker_id, track_name, e))
+            t.cleanup()
+            self.result_queue.put(('track_stopped', (self.worker_id, track_name)))
+            return
+        self.tracks[track_name] = t
+        self.selector.register(t.track_socket, selectors.EVENT_READ, t)
+        self.result_queue.put(('track_ready', (self.worker_id, track_name)))
+
+    def stop_track(self, track_name):
+        """ stops running track_name and tells the server """
+        t = self.tracks.pop(track_name, None)
+        if t is None:
+            return
+        if t.track_socket and self.selector:
+            self.selector.unregister(t.track_socket)
+        t.cleanup()
+        try:
+            self.result_queue.put(('track_stopped', (self.worker_id, track_name)))
+        except (OSError, ValueError):
+            pass  # server already closed the queue
+
+    def process_server_queue(self):
+        if SKIP_CHECK_SERVER_QUEUE > 0:
+            self.skip_checking_server_queue_count += 1
+            if self.skip_checking_server_queue_count % SKIP_CHECK_SERVER_QUEUE != 0: return
+        while not self.exit:
+            try:
+                (cmd, payload) = self.server_queue.get_nowait()
+            except Empty:
+                break
+            self.handle_server_msg(cmd, payload)
+
+    def handle_server_msg(self, cmd, payload):
+        """ handles a queue message from the server; messages for a track have payload (track_name, track_payload) """
+        logger.debug('worker {} got queue message from server manager cmd={} payload={}'.format(self.worker_id, cmd, payload))
+        if cmd == 'stop':
+            logger.info('track worker {} stopping'.format(self.worker_id))
+            self.exit = True
+        elif cmd == 'start_track':
+            (track_name, port, allow_off_track, keep_alive) = payload
+            self.start_track(track_name, port, allow_off_track, keep_alive)
+        elif cmd == 'add_car' or cmd == 'add_spectator':
+            (track_name, track_payload) = payload
+            t = self.tracks.get(track_name)
+            if t is None:
+                logger.warning('worker {} got {} for track {} that it does not run; ignoring'.format(self.worker_id, cmd, track_name))
+                return
+            t.handle_server_msg(cmd, track_payload)
+        else:
+            raise RuntimeWarning('unknown cmd {}'.format(cmd))
+
 
 if __name__ == '__main__':
     try:
@@ -321,36 +684,117 @@ if __name__ == '__main__':
     server_socket.bind(('', args.port))  # bind to empty host, so we can receive from anyone on this port
     logger.info("waiting on {}".format(str(server_socket)))
     server_port_lock = mp.Lock()  # processes get passed this lock to initiate connections using it (but only once, at start)
-
-    track_names = list_tracks()
-    track_processes: Dict[str, track_server_process] = {k: None for k in track_names}  # each entry holds the track objects for each track name
-    track_queues: Dict[str, mp.Queue] = {k: None for k in track_names}  # each entry is the queue to send to track process
+    server_reassembler = reassembler()
+
+    result_queue = mp.Queue()  # workers report 'load', 'track_ready' and 'track_stopped' to us on this queue
+    workers: List[track_worker_process] = []  # the pool of track worker processes, started before any client connects
+    worker_queues: List[mp.Queue] = []  # each entry is the queue to send to the worker with the same index
+    worker_loads: List[int] = []  # load of each worker, the number of its tracks and cars
+    track_workers: Dict[str, int] = dict()  # maps track name to the index of the worker that runs it
+    track_ports: Dict[str, int] = dict()  # maps track name to the local port its clients use
+    ready_tracks: Set[str] = set()  # tracks whose worker told us that they are running, so clients can connect
+    pending_connects: Dict[str, List[Tuple[Tuple[str, int], tuple, float]]] = dict()  # clients waiting for their track to start, by track name: (client_addr, message for the worker once the track runs, timer() when they asked)
+
+
+    def start_worker(i=None) -> int:
+        """ starts a new worker, or restarts worker i if it died
+        :returns: the index of the worker """
+        if i is None:
+            i = len(workers)
+            workers.append(None)
+            worker_queues.append(None)
+            worker_loads.append(0)
+        else:
+            for t in [t for t, w in track_workers.items() if w == i]:
+                del track_workers[t]  # they died with the worker
+                ready_tracks.discard(t)
+            if worker_queues[i]:
+                worker_queues[i].close()
+        logger.info('starting track worker process {}'.format(i))
+        q = mp.Queue()
+        worker_queues[i] = q
+        worker_loads[i] = 0
+        workers[i] = track_worker_process(worker_id=i, queue_from_server=q, queue_to_server=result_queue,
+                                          record_folder=args.record_model_state, lockstep=args.lockstep,
+                                          seed=args.seed, server_port=args.port)
+        workers[i].start()
+        return i
+
+
+    def handle_worker_result(cmd, payload):
+        """ handles a message from a worker """
+        if cmd == 'load':
+            (i, load) = payload
+            worker_loads[i] = load
+        elif cmd == 'track_ready':
+            (i, track_name) = payload
+            if track_workers.get(track_name) == i:
+                ready_tracks.add(track_name)
+                for (client_addr, worker_msg, _) in pending_connects.pop(track_name, []):
+                    finish_connect(i, track_name, client_addr, worker_msg)
+        elif cmd == 'track_stopped':
+            (i, track_name) = payload
+            logger.info('track {} stopped on worker {}'.format(track_name, i))
+            if track_workers.get(track_name) == i:
+                del track_workers[track_name]
+                ready_tracks.discard(track_name)
+        else:
+            logger.warning('unknown message {} from worker'.format(cmd))
 
 
-    def make_track_process(track_name, client_addr, allow_off_track=False) -> mp.Process:
-        p = track_processes.get(track_name)
-        if not (p is None) \
-                and p.is_alive():
-            track_port_number = p.local_port_number
-            send_game_port_to_client(client_addr, track_port_number)
-            logger.info('track process {} already exists already and is alive'.format(p.name))
-            return track_processes.get(track_name)
-        else:
-            track_port_number = find_unbound_port_in_range(CLIENT_PORT_RANGE)
-            send_game_port_to_client(client_addr, track_port_number)
-            logger.info('starting a new track_server_process for track {} for client at {} using local port {}'
-                        .format(track_name, client_addr, track_port_number))
-            q = mp.Queue()
-            track_queues[track_name] = q
-            track_process = track_server_process(queue_from_server=q,
-                                                 server_port_lock=server_port_lock,
-                                                 server_socket=server_socket,
-                                                 track_name=track_name,
-                                                 port=track_port_number,
-                                                 allow_off_track=allow_off_track)
-            track_processes[track_name] = track_process
-            track_processes[track_name].start()
-            return track_process
+    def process_worker_results():
+        """ handles the messages from the workers that are waiting """
+        while True:
+            try:
+                (cmd, payload) = result_queue.get_nowait()
+            except Empty:
+                break
+            handle_worker_result(cmd, payload)
+        expire_pending_connects()
+
+
+    def expire_pending_connects():
+        """ tells the clients whose track did not start within TRACK_START_TIMEOUT_S, or whose worker lost it, that it could not be started """
+        now = timer()
+        for track_name in list(pending_connects.keys()):
+            running = track_workers.get(track_name) is not None
+            waiting = [p for p in pending_connects[track_name] if running and now - p[2] < TRACK_START_TIMEOUT_S]
+            for p in pending_connects[track_name]:
+                if p not in waiting:
+                    logger.error('track {} could not be started within {}s for client {}'.format(track_name, TRACK_START_TIMEOUT_S, p[0]))
+                    send_message(server_socket, server_port_lock, p[0],
+                                 ('string_message', 'ERROR: server could not start track {}'.format(track_name)))
+            if waiting:
+                pending_connects[track_name] = waiting
+            else:
+                del pending_connects[track_name]
+
+
+    def choose_worker() -> int:
+        """ chooses the worker for a new track: a dead worker is restarted, otherwise the least loaded one is taken """
+        for i, w in enumerate(workers):
+            if not w.is_alive():
+                logger.warning('track worker process {} died, restarting it'.format(i))
+                return start_worker(i)
+        return min(range(len(workers)), key=lambda i: worker_loads[i])
+
+
+    def place_track(track_name, allow_off_track=False, keep_alive=False) -> Tuple[int, int]:
+        """ makes sure that a worker runs track_name
+        :returns: (index of worker, local port of track) """
+        process_worker_results()
+        i = track_workers.get(track_name)
+        if i is None or not workers[i].is_alive():
+            i = choose_worker()
+            track_ports[track_name] = int(find_unbound_port_in_range(CLIENT_PORT_RANGE))  # a numpy int, which JSON cannot encode in game_port
+            track_workers[track_name] = i
+            ready_tracks.discard(track_name)
+            worker_loads[i] += 1  # until the worker reports its load
+            logger.info('placing track {} on worker {} using local port {}'.format(track_name, i, track_ports[track_name]))
+        if not track_name in ready_tracks:
+            # the worker starts the track, or starts it again if it stopped before we heard about it
+            worker_queues[i].put(('start_track', (track_name, track_ports[track_name], allow_off_track, keep_alive)))
+        return i, track_ports[track_name]
 
 
     def send_game_port_to_client(client_addr: Tuple[str, int], port: int):
@@ -362,44 +806,63 @@ if __name__ == '__main__':
                      msg=('game_port', port))
 
 
+    def connect_client_to_track(track_name, client_addr, worker_msg: tuple, allow_off_track=False):
+        """ places track_name on a worker; once the track is running, sends the client the game_port and the worker
+        worker_msg. Does not wait for the track to start, the connect is finished when its worker reports track_ready. """
+        if track_name not in list_tracks():  # before place_track, so a bad name starts no worker and compiles nothing
+            logger.warning('client {} asked for unknown track {}, ignoring'.format(client_addr, track_name))
+            send_message(server_socket, server_port_lock, client_addr,
+                         ('string_message', 'ERROR: server has no track named {}'.format(track_name)))
+            return
+        (i, port) = place_track(track_name=track_name, allow_off_track=allow_off_track)
+        if track_name in ready_tracks:
+            finish_connect(i, track_name, client_addr, worker_msg)
+        else:
+            pending_connects.setdefault(track_name, []).append((client_addr, worker_msg, timer()))
+
+
+    def finish_connect(i, track_name, client_addr, worker_msg: tuple):
+        """ sends the client the game_port of its running track, and its worker i the message that adds the client """
+        send_game_port_to_client(client_addr, track_ports[track_name])
+        logger.info('putting message {} to worker {} for track {} for client {}'.format(worker_msg[0], i, track_name, client_addr))
+        worker_queues[i].put(worker_msg)
+        if worker_msg[0] == 'add_car':
+            worker_loads[i] += 1
+
+
     def add_car_to_track(track_name, car_name, client_addr, allow_off_track=False):
-        make_track_process(track_name=track_name, client_addr=client_addr, allow_off_track=allow_off_track)
-        logger.info('putting message to track process for track {} to add car named {} for client {}'.format(track_name, car_name, client_addr))
-        q = track_queues.get(track_name)
-        if q:
-            q.put(('add_car', (car_name, client_addr)))
+        connect_client_to_track(track_name, client_addr, ('add_car', (track_name, (car_name, client_addr))),
+                                allow_off_track=allow_off_track)
 
 
     def add_spectator_to_track(track_name, client_addr):
-        make_track_process(track_name=track_name, client_addr=client_addr)
-        q = track_queues[track_name]
-        if q:
-            q.put(('add_spectator', client_addr))
+        connect_client_to_track(track_name, client_addr, ('add_spectator', (track_name, client_addr)))
 
 
     def stop_all_track_processes():
-        for t, q in track_queues.items():
+        for i, q in enumerate(worker_queues):
             if q:
-                logger.info('telling track {} to stop'.format(t))
+                logger.info('telling track worker {} to stop'.format(i))
                 try:
-                    q.put('stop')
+                    q.put(('stop', None))
                 except:
                     pass
         sleep(1)
         logger.info('joining processes')
-        for t, p in track_processes.items():
+        for p in workers:
             if p: p.join(1)
-        for t, p in track_processes.items():
+        for p in workers:
             if p and p.is_alive():
-                logger.info('terminating zombie track process {}'.format(p))
+                logger.info('terminating zombie track worker process {}'.format(p))
                 p.terminate()
-        track_processes.clear()
+        workers.clear()
         logger.info('closing queues')
-        for q in track_queues.values():
+        for q in worker_queues:
             if q:
                 q.close()
                 q.join_thread()
-        track_queues.clear()
+        worker_queues.clear()
+        result_queue.close()
 
 
     def cleanup_all():
@@ -409,38 +872,53 @@ if __name__ == '__main__':
 
     atexit.register(cleanup_all)
 
-    # We fork an mp process for each track that might have one or more cars and spectators.
+    # We fork a pool of args.workers worker processes at startup, so they have imported everything before the first client comes.
+    # Each worker runs one or more tracks that might have one or more cars and spectators, and each new track is placed on the least loaded worker.
+    # The tracks in args.preload_tracks are started right away and keep running without clients.
 
     # There is only a single instance of each track. Any clients that want to use that track share it.
 
-    # Each track also gets a Queue which main process uses to tell it when there are new cars for it.
+    # Each worker also gets a Queue which main process uses to tell it when there are new tracks and cars for it.
 
-    # Each track runs single threaded to model all the cars in real time, and responds to commands (or spectate state requests) sent from clients with car states
+    # Each worker runs single threaded to model all the cars of its tracks in real time, and responds to commands (or spectate state requests) sent from clients with car states
     # of all the cars on that track.
 
     # Flow is like this:
     # 1. Server waits on SERVER_PORT
     # 2. Client sends newcar to SERVER_PORT
-    # 3. Server responds to same port on client with ack and new port
-    # 4. Client talks to track process on new port
+    # 3. Server starts the track on a worker if it is not running yet, and once it is running, responds to same port on client with game_port
+    # 4. Client talks to the track on its worker process on new port
     # That way, client initiates communication on new port and should be able to receive on it
 
     # handling processes based on https://www.cloudcity.io/blog/2019/02/27/things-i-wish-they-told-me-about-multiprocessing-in-python/
 
+    for _ in range(max(1, args.workers)):
+        start_worker()
+    for track_name in args.preload_tracks:
+        place_track(track_name, allow_off_track=args.allow_off_track, keep_alive=True)
+
+    server_socket.settimeout(SERVER_LOOP_TIMEOUT_S)
     while True:
+        process_worker_results()  # finishes the connects of clients whose track started
         try:
             server_port_lock.acquire()
-            data, client_addr = server_socket.recvfrom(1024)  # buffer size is 1024 bytes
+            data, client_addr = server_socket.recvfrom(RECV_BUFFER_BYTES)
+        except socket.timeout:
+            continue
         except KeyboardInterrupt:
             logger.info('KeyboardInterrupt, stopping server')
             break
         finally:
             server_port_lock.release()
         try:
-            (cmd, payload) = pickle.loads(data)
-        except pickle.UnpicklingError as ex:
+            data = server_reassembler.add(data, client_addr)
+            if data is None:
+                continue  # wait for the other chunks
+            (cmd, payload) = decode_message(data)
+            check_server_payload(cmd, payload)
+        except protocol_error as ex:
             logger.warning('{}: garbled command, ignoring. \n'
-                           'Client should send pickled 2-tuple (cmd, payload).\n '
+                           'Client should send an src.protocol message (cmd, payload).\n '
                            'cmd="add_car|add_spectator"\n'
                            'payload (for add_car) =(track_name,car_name)\n'
                            'payload (for add_spectator) =(track_name)\n'
@@ -2,7 +2,7 @@
 # TODO move to separate repo to hide from participants
 import logging
 from math import sin, radians, degrees, cos, copysign
-from typing import Tuple
+from typing import Tuple, Optional
 from scipy.integrate import solve_ivp  # Methods tried before, now not uesed anymore: RK23, RK45, LSODA, BDF, DOP853
 from timeit import default_timer as timer
 import random
@@ -11,7 +11,8 @@ import numpy as np
 from src.car_state import car_state
 from src.globals import *
 from src.l2race_utils import my_logger
-from src.track import track
+from src.track_geometry import track_geometry
+from src.integrators import make_integrator
 
 logger = my_logger(__name__)
 
@@ -29,14 +30,19 @@ from commonroad.init_MB import init_MB
 from commonroad.vehicleDynamics_KS import vehicleDynamics_KS  # kinematic single track, no slip
 from commonroad.vehicleDynamics_ST import vehicleDynamics_ST  # single track bicycle with slip
 from commonroad.vehicleDynamics_MB import vehicleDynamics_MB  # fancy multibody model
+from commonroad.vehicleParametersArray import pack_parameters
+from commonroad.vehicleDynamics_jit import vehicleDynamics_KS_jit, vehicleDynamics_ST_jit, vehicleDynamics_MB_jit
 
 
 LOGGING_INTERVAL_CYCLES = 0  # 0 to disable # 1000 # log output only this often
 MODEL = vehicleDynamics_ST  # vehicleDynamics_KS vehicleDynamics_ST vehicleDynamics_MB
 SOLVER = 'RK45'  # DOP853 LSODA BDF RK45 RK23 # faster, no overhead but no checking
 PARAMETERS = parameters_vehicle2
+COMPILED_KERNELS = True  # True to use the numba compiled vehicleDynamics_*_jit kernels with packed parameter array, False for pure python commonroad models
 RTOL = 1e-2
 ATOL = 1e-4
+INTEGRATOR = 'solve_ivp'  # 'solve_ivp' uses SOLVER with RTOL/ATOL; or fixed-step 'rk4', 'heun', 'semi_implicit_euler' (for the stiff MB model) from src.integrators
+INTEGRATOR_SUBSTEPS = 4  # number of fixed steps per model update for the fixed-step integrators
 
 # indexes into model state
 # states
@@ -62,16 +68,39 @@ class car_model:
     Car model, hidden from participants, updated on server
     """
     def __init__(self,
-                 track: track = None,
+                 track: track_geometry = None,
                  car_name: str = None,
                  client_ip: Tuple[str, int] = None,
-                 allow_off_track: bool = False):
+                 allow_off_track: bool = False,
+                 model=None,
+                 parameters=None,
+                 start_position=None,
+                 rng: Optional[random.Random] = None):
+        """
+        Makes a new car at a random starting position of the track.
+
+        :param track: the track the car drives on
+        :param car_name: name of the car
+        :param client_ip: address of the client driving the car
+        :param allow_off_track: True to let the car leave the track without slowing down
+        :param model: vehicle dynamics function, vehicleDynamics_KS, vehicleDynamics_ST or vehicleDynamics_MB; default MODEL
+        :param parameters: function returning the vehicle parameters, e.g. parameters_vehicle2; default PARAMETERS
+        :param start_position: 1 or 2 to start at track.start_position_1 or start_position_2, None to choose one at random
+        :param rng: random generator for the start position, e.g. a seeded random.Random for reproducible runs;
+            default the unseeded random module
+        :raises ValueError: if model is not one of the supported vehicle dynamics
+        """
 
         self.n_eval_total = 0  # Number of simulation steps for this car performed since the program was started/reseted
+        self.last_n_eval = 0  # evaluations of the model function in the last update, for server side recording
+        self.last_calculations_time = 0.  # wall time of the last update in seconds
+        self.last_too_slow = False  # True if the last update could not keep up with real time
         self.track = track # Track of which car is driving
 
-        # Randomly chose initial position
-        x_start, y_start = self.choose_initial_position()
+        # Randomly chose initial position, unless one is given
+        self.rng = rng if rng is not None else random
+        self.start_position = start_position
+        x_start, y_start = self.choose_initial_position(start_position)
         # Create car_state object - object keeping all the information user can access
         self.car_state:car_state = car_state(x=x_start, y=y_start, body_angle_deg=self.track.start_angle,
                                    name=car_name, client_ip=client_ip)
@@ -82,33 +111,38 @@ class car_model:
         self.s_rounds = ''  # String to keep information about completed rounds
 
         # change MODEL_TYPE to select vehicle model type (vehicle dynamics - how car_state is calculated from car parameters)
-        self.model = MODEL  # 'KS' 'ST' 'MB' # model type KS: kinematic single track, ST: single track (with slip), MB: fancy multibody
+        self.model = model if model is not None else MODEL  # 'KS' 'ST' 'MB' # model type KS: kinematic single track, ST: single track (with slip), MB: fancy multibody
+        self.compiled_kernels = COMPILED_KERNELS
         if self.model == vehicleDynamics_KS:
             self.model_init = init_KS
-            self.model_func = self.func_KS
+            self.model_func = self.func_KS_jit if self.compiled_kernels else self.func_KS
         elif self.model == vehicleDynamics_ST:
             self.model_init = init_ST
-            self.model_func = self.func_ST
+            self.model_func = self.func_ST_jit if self.compiled_kernels else self.func_ST
         elif self.model == vehicleDynamics_MB:
             self.model_init = init_MB
-            self.model_func = self.func_MB
+            self.model_func = self.func_MB_jit if self.compiled_kernels else self.func_MB
+        else:
+            raise ValueError('unsupported vehicle model {}'.format(getattr(self.model, '__name__', self.model)))
 
         # select car with next line - determins static parameters of the car: physical dimensions, strength of engine and breaks, etc.
-        self.parameters = PARAMETERS()
+        self.parameters_func = parameters if parameters is not None else PARAMETERS
+        self.parameters = self.parameters_func()
+        self.parameters_array = pack_parameters(self.parameters)  # flat copy of parameters for the compiled kernels
         # Set parameters of this particular car
         self.car_state.static_info.width_m = self.parameters.w
         self.car_state.static_info.length_m = self.parameters.l
         # set car accel and braking based on car type (not in parameters from commonroad-vehicle-models)
         self.accel_max = self.zeroTo60mpsTimeToAccelG(4) * G  # 5 second 0-60 mph, very quick car is default
         self.brake_max = .9 * G
-        if PARAMETERS == parameters_vehicle1:
+        if self.parameters_func == parameters_vehicle1:
             self.accel_max = self.zeroTo60mpsTimeToAccelG(
                 10.6) * G  # 1992 ford escort https://www.automobile-catalog.com/car/1992/879800/ford_escort_gt_automatic.html
             self.brake_max = .9 * G
-        elif PARAMETERS == parameters_vehicle2:  # BMW 320i
+        elif self.parameters_func == parameters_vehicle2:  # BMW 320i
             self.accel_max = self.zeroTo60mpsTimeToAccelG(9.5) * G
             self.brake_max = .95 * G
-        elif PARAMETERS == parameters_vehicle3:  # VW vanagon
+        elif self.parameters_func == parameters_vehicle3:  # VW vanagon
             self.accel_max = self.zeroTo60mpsTimeToAccelG(17.9) * G
             self.brake_max = .8 * G
 
@@ -125,6 +159,7 @@ class car_model:
             self.model_state = self.model_init(initialState, self.parameters)  # initial state for MB needs params too
         else:
             self.model_state = self.model_init(initialState)  # initial state
+        self.model_state = np.array(self.model_state, dtype='double')
         self.cycle_count = 0
         self.time = 0  # "car's clock" - till what time the the simulation was performed
         self.atol = ATOL
@@ -133,6 +168,15 @@ class car_model:
         self.u = [0, 0]
         self.solver = None
         self.first_step = True
+        # fixed-step integrator and the buffer it advances in place, None if using solve_ivp
+        self.integrator_name = INTEGRATOR
+        self.integrator_substeps = INTEGRATOR_SUBSTEPS
+        if self.integrator_name == 'solve_ivp':
+            self.integrator = None
+            self.state_buffer = None
+        else:
+            self.integrator = make_integrator(self.integrator_name, self.model_state.shape)
+            self.state_buffer = np.zeros(self.model_state.shape)
 
         # Set if a car is allowed to leave track or not
         self.allow_off_track = allow_off_track
@@ -148,21 +192,7 @@ class car_model:
         # logger.debug('updating model with dt={:.1f}ms'.format(dt_sec*1000))
 
         # Update model state:
-
-        # Set server message TODO: write what it is for
-        self.car_state.server_msg = ''
-
-        # Check command coming from client
-        command = self.car_state.command
-
-        # If client wants to reset the car, reset the car
-        # if command.reset_car: self.reset()  # handled by "restart_car" command to server now
-
-        # Go from driver input to commanded steering and acceleration
-        accel, steer_vel_rad_per_sec = self.external_to_model_input(command)
-        # u0 = steering angle velocity of front wheels
-        # u1 = longitudinal acceleration
-        self.u = np.array([float(steer_vel_rad_per_sec), float(accel)], dtype='double')
+        command, accel = self.prepare_update()
 
         calculations_time_start = timer()  # start counting time required to update the car model
 
@@ -178,36 +208,86 @@ class car_model:
         n_eval_start = self.n_eval_total
 
         # Integrate equations
-        self.solver = solve_ivp(fun=model_func,
-                                t_span=[self.time, self.time + dt_sec],
-                                method=SOLVER,
-                                y0=self.model_state,
-                                atol=ATOL,
-                                rtol=RTOL)
+        if self.integrator is None:
+            self.solver = solve_ivp(fun=model_func,
+                                    t_span=[self.time, self.time + dt_sec],
+                                    method=SOLVER,
+                                    y0=self.model_state,
+                                    atol=ATOL,
+                                    rtol=RTOL)
+            t_simulated_end = self.solver.t[-1]  # True time on the car's clock at the end of the model update
+            # Save the results of model update to model_state variable
+            self.model_state = self.solver.y[:, -1]
+        else:
+            # fixed-step integration in place in the preallocated buffer, model_func counts the evals in n_eval_total
+            np.copyto(self.state_buffer, self.model_state)
+            self.integrator.integrate(lambda y: model_func(self.time, y), self.state_buffer, dt_sec, self.integrator_substeps)
+            t_simulated_end = self.time + dt_sec
+            self.model_state = self.state_buffer
 
         # This flag changes to True if it was not possible to perform real-time update of car model
         too_slow = timer() > calculations_time_start + 0.8 * dt_sec
 
-        t_simulated_end = self.solver.t[-1]  # True time on the car's clock at the end of the model update
-
-
         # Calculate the difference on the "car's clock" during this model update
         t_simulated = t_simulated_end - self.time
 
-        # Save the results of model update to model_state variable
-        self.model_state = self.solver.y[:, -1]
-
         calculations_time_end = timer()  # stop counting time required to update the model
 
 
         # Calculate how much time was needed to perform the requested update of the model
         calculations_time = calculations_time_end - calculations_time_start
+
+        self.finish_update(dt_sec=dt_sec, command=command, accel=accel,
+                           calculations_time=calculations_time,
+                           n_eval_diff=self.n_eval_total - n_eval_start,
+                           t_simulated=t_simulated,
+                           too_slow=too_slow)
+
+    def prepare_update(self):
+        """
+        First part of a model update: computes the model input self.u from the command the client sent.
+        Call it before integrating self.model_state, then call finish_update().
+
+        :returns: (command, accel) - the car_command that was applied and the commanded longitudinal acceleration
+        """
+        # Set server message TODO: write what it is for
+        self.car_state.server_msg = ''
+
+        # Check command coming from client
+        command = self.car_state.command
+
+        # If client wants to reset the car, reset the car
+        # if command.reset_car: self.reset()  # handled by "restart_car" command to server now
+
+        # Go from driver input to commanded steering and acceleration
+        accel, steer_vel_rad_per_sec = self.external_to_model_input(command)
+        # u0 = steering angle velocity of front wheels
+        # u1 = longitudinal acceleration
+        self.u = np.array([float(steer_vel_rad_per_sec), float(accel)], dtype='double')
+        return command, accel
+
+    def finish_update(self, dt_sec, command, accel, calculations_time, n_eval_diff, t_simulated, too_slow)->None:
+        """
+        Second part of a model update, after self.model_state was integrated:
+        applies the track constraints and updates the car_state seen by drivers.
+
+        :param dt_sec: time advance in seconds
+        :param command: the command returned by prepare_update()
+        :param accel: the acceleration returned by prepare_update()
+        :param calculations_time: wall time in seconds it took to integrate the model
+        :param n_eval_diff: number of evaluations of the model function during the integration
+        :param t_simulated: advance of the car's clock in seconds by the integration
+        :param too_slow: True if the integration could not keep up with real time
+        """
+        self.last_n_eval = n_eval_diff
+        self.last_calculations_time = calculations_time
+        self.last_too_slow = too_slow
+
         # Compare the time required for calculations (calculations_time)
         # with the advance of time on the car's clock (t_simulated)
         if calculations_time > 0.0001:
-            n_eval_stop = self.n_eval_total
-            n_eval_diff = n_eval_stop - n_eval_start
-            s = '{} took {} evals in {:.1f}ms for timestep {:.1f}ms to advance {:.1f}ms {}'.format(self.model.__name__,
+            s = '{}/{} took {} evals in {:.1f}ms for timestep {:.1f}ms to advance {:.1f}ms {}'.format(self.model.__name__,
+                                                                                                   self.integrator_name,
                                                                                                    n_eval_diff,
                                                                                                    calculations_time * 1000,
                                                                                                    dt_sec * 1000,
@@ -245,10 +325,15 @@ class car_model:
 
         self.cycle_count += 1
 
-    def choose_initial_position(self):
-        # Randomly choose initial position
+    def choose_initial_position(self, start_position=None):
+        # Randomly choose initial position, unless start_position is given as 1 or 2
         positions = ['position_1', 'position_2']
-        position = random.choice(positions)
+        if start_position is None:
+            position = self.rng.choice(positions)
+        elif start_position in (1, 2):
+            position = positions[start_position - 1]
+        else:
+            raise ValueError('start_position must be 1, 2 or None, got {}'.format(start_position))
         if position == 'position_1':
             (x_start, y_start) = self.track.start_position_1 * M_PER_PIXEL
         else:
@@ -277,7 +362,11 @@ class car_model:
 
     def restart(self):
         logger.info('restarting car named {}'.format(self.car_name()))
-        self.__init__(track=self.track,car_name=self.car_name(),client_ip=self.car_state.static_info.client_ip)
+        car_id = self.car_state.static_info.car_id
+        self.__init__(track=self.track, car_name=self.car_name(), client_ip=self.car_state.static_info.client_ip,
+                      allow_off_track=self.allow_off_track, model=self.model, parameters=self.parameters_func,
+                      start_position=self.start_position, rng=self.rng)
+        self.car_state.static_info.car_id = car_id  # clients know the car by this id
 
     def external_to_model_input(self, command):
         # Compute commanded longitudinal acceleration from throttle and brake input
@@ -397,3 +486,19 @@ class car_model:
         f = vehicleDynamics_MB(x, u, p)
         self.n_eval_total += 1
         return f
+
+    # compiled counterparts; p is ignored, the kernels use the packed self.parameters_array
+    def func_KS_jit(self, t, x, u, p):
+        f = vehicleDynamics_KS_jit(x, u, self.parameters_array)
+        self.n_eval_total += 1
+        return f
+
+    def func_ST_jit(self, t, x, u, p):
+        f = vehicleDynamics_ST_jit(x, u, self.parameters_array)
+        self.n_eval_total += 1
+        return f
+
+    def func_MB_jit(self, t, x, u, p):
+        f = vehicleDynamics_MB_jit(x, u, self.parameters_array)
+        self.n_eval_total += 1
+        return f
@@ -0,0 +1,230 @@
+# batched update of all the car models on one track, run on server
+# The model_state vectors of all cars are stacked into one 2-D array (one row per car) and advanced together
+# with a fixed-step integrator, so the per-tick cost grows with the number of solver steps instead of with
+# number of cars times the python overhead of solve_ivp.
+from typing import List, Dict, Tuple, Optional
+from timeit import default_timer as timer
+
+import numpy as np
+
+from src.globals import KS_TO_ST_SPEED_M_PER_SEC
+from src.integrators import fixed_step_integrator, make_integrator
+from src.l2race_utils import my_logger
+from src.car_model import car_model, INTEGRATOR, INTEGRATOR_SUBSTEPS
+from commonroad.vehicleDynamics_KS import vehicleDynamics_KS
+from commonroad.vehicleDynamics_ST import vehicleDynamics_ST
+from commonroad.vehicleDynamics_MB import vehicleDynamics_MB
+from commonroad.vehicleDynamics_jit import vehicleDynamics_KS_batch_jit, vehicleDynamics_ST_batch_jit, vehicleDynamics_MB_batch_jit
+
+logger = my_logger(__name__)
+
+# the batch uses the integrator configured by car_model.INTEGRATOR and INTEGRATOR_SUBSTEPS; solve_ivp has adaptive
+# steps that differ per car, so it cannot advance the cars together and the batch uses BATCH_FALLBACK_METHOD instead
+BATCH_FALLBACK_METHOD = 'rk4'  # fixed-step integrator used when car_model.INTEGRATOR is 'solve_ivp'
+
+
+def steeringConstraints_batch(steeringAngle: np.ndarray, steeringVelocity: np.ndarray, p) -> np.ndarray:
+    """
+    Vectorized version of commonroad.steeringConstraints over a column of cars.
+
+    :param steeringAngle: steering angles of front wheels in rad, shape (N,)
+    :param steeringVelocity: commanded steering velocities in rad/s, shape (N,)
+    :param p: steering parameter structure
+    :returns: constrained steering velocities, shape (N,)
+    """
+    v = np.clip(steeringVelocity, p.v_min, p.v_max)
+    limit_reached = ((steeringAngle <= p.min) & (steeringVelocity <= 0)) | ((steeringAngle >= p.max) & (steeringVelocity >= 0))
+    v[limit_reached] = 0
+    return v
+
+
+def accelerationConstraints_batch(velocity: np.ndarray, acceleration: np.ndarray, p) -> np.ndarray:
+    """
+    Vectorized version of commonroad.accelerationConstraints over a column of cars.
+
+    :param velocity: velocities in driving direction m/s, shape (N,)
+    :param acceleration: commanded accelerations in driving direction m/s^2, shape (N,)
+    :param p: longitudinal parameter structure
+    :returns: constrained accelerations, shape (N,)
+    """
+    # positive acceleration limit
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pos_limit = np.where(velocity > p.v_switch, p.a_max * p.v_switch / velocity, p.a_max)
+    a = np.minimum(np.maximum(acceleration, -p.a_max), pos_limit)
+    limit_reached = ((velocity <= p.v_min) & (acceleration <= 0)) | ((velocity >= p.v_max) & (acceleration >= 0))
+    a[limit_reached] = 0
+    return a
+
+
+def vehicleDynamics_KS_batch(x: np.ndarray, u_init: np.ndarray, p) -> np.ndarray:
+    """
+    Vectorized version of commonroad.vehicleDynamics_KS.
+
+    :param x: stacked KS states, shape (N,5) (or more columns, only the first 5 are used)
+    :param u_init: stacked inputs [steering velocity, acceleration], shape (N,2)
+    :param p: vehicle parameters
+    :returns: right hand side, shape (N,5)
+    """
+    l = p.a + p.b
+    u0 = steeringConstraints_batch(x[:, 2], u_init[:, 0], p.steering)
+    u1 = accelerationConstraints_batch(x[:, 3], u_init[:, 1], p.longitudinal)
+    f = np.empty((x.shape[0], 5))
+    f[:, 0] = x[:, 3] * np.cos(x[:, 4])
+    f[:, 1] = x[:, 3] * np.sin(x[:, 4])
+    f[:, 2] = u0
+    f[:, 3] = u1
+    f[:, 4] = x[:, 3] / l * np.tan(x[:, 2])
+    return f
+
+
+def vehicleDynamics_ST_batch(x: np.ndarray, u_init: np.ndarray, p) -> np.ndarray:
+    """
+    Vectorized version of commonroad.vehicleDynamics_ST, including the switch to the kinematic model
+    below KS_TO_ST_SPEED_M_PER_SEC and the friction steering constraint.
+
+    :param x: stacked ST states, shape (N,7)
+    :param u_init: stacked inputs [steering velocity, acceleration], shape (N,2)
+    :param p: vehicle parameters
+    :returns: right hand side, shape (N,7)
+    """
+    g = 9.81  # [m/s^2]
+
+    # create equivalent bicycle parameters
+    mu = p.tire.p_dy1
+    C_Sf = -p.tire.p_ky1 / p.tire.p_dy1
+    C_Sr = -p.tire.p_ky1 / p.tire.p_dy1
+    lf = p.a
+    lr = p.b
+    h = p.h_s
+    m = p.m
+    I = p.I_z
+    lwb = p.a + p.b
+
+    u0 = steeringConstraints_batch(x[:, 2], u_init[:, 0], p.steering)
+    u1 = accelerationConstraints_batch(x[:, 3], u_init[:, 1], p.longitudinal)
+
+    v = x[:, 3]
+    ks = v < KS_TO_ST_SPEED_M_PER_SEC
+    v_st = np.where(ks, 1., v)  # keeps the ST terms finite in rows that use the KS model
+
+    # friction_steering_constraint, with the same arguments as in vehicleDynamics_ST
+    yaw_rate_max = (p.longitudinal.a_max ** 2 - u1 ** 2) / (v_st ** 2)
+    u0 = np.where((~ks) & (x[:, 5] ** 2 >= yaw_rate_max) & (u0 * x[:, 4] > 0), 0., u0)
+
+    f = np.empty((x.shape[0], 7))
+    f[:, 2] = u0
+    f[:, 3] = u1
+    f[:, 0] = np.where(ks, v * np.cos(x[:, 4]), v * np.cos(x[:, 6] + x[:, 4]))
+    f[:, 1] = np.where(ks, v * np.sin(x[:, 4]), v * np.sin(x[:, 6] + x[:, 4]))
+    f[:, 4] = np.where(ks, v / lwb * np.tan(x[:, 2]), x[:, 5])
+
+    f_ks_5 = u1 / lwb * np.tan(x[:, 2]) + v / (lwb * np.cos(x[:, 2]) ** 2) * u0
+    f_st_5 = -mu * m / (v_st * I * (lr + lf)) * (lf ** 2 * C_Sf * (g * lr - u1 * h) + lr ** 2 * C_Sr * (g * lf + u1 * h)) * x[:, 5] \
+             + mu * m / (I * (lr + lf)) * (lr * C_Sr * (g * lf + u1 * h) - lf * C_Sf * (g * lr - u1 * h)) * x[:, 6] \
+             + mu * m / (I * (lr + lf)) * lf * C_Sf * (g * lr - u1 * h) * x[:, 2]
+    f_st_6 = (mu / (v_st ** 2 * (lr + lf)) * (C_Sr * (g * lf + u1 * h) * lr - C_Sf * (g * lr - u1 * h) * lf) - 1) * x[:, 5] \
+             - mu / (v_st * (lr + lf)) * (C_Sr * (g * lf + u1 * h) + C_Sf * (g * lr - u1 * h)) * x[:, 6] \
+             + mu / (v_st * (lr + lf)) * (C_Sf * (g * lr - u1 * h)) * x[:, 2]
+    f[:, 5] = np.where(ks, f_ks_5, f_st_5)
+    f[:, 6] = np.where(ks, 0., f_st_6)
+    return f
+
+
+def vehicleDynamics_MB_batch(x: np.ndarray, u_init: np.ndarray, p) -> np.ndarray:
+    """
+    Row by row evaluation of commonroad.vehicleDynamics_MB; the multibody model is not vectorized.
+
+    :param x: stacked MB states, shape (N,29)
+    :param u_init: stacked inputs [steering velocity, acceleration], shape (N,2)
+    :param p: vehicle parameters
+    :returns: right hand side, shape (N,29)
+    """
+    f = np.empty_like(x)
+    for i in range(x.shape[0]):
+        f[i] = vehicleDynamics_MB(x[i], u_init[i], p)
+    return f
+
+
+# maps the per-car model function selected in car_model to its batched counterpart
+BATCH_MODELS = {
+    vehicleDynamics_KS: vehicleDynamics_KS_batch,
+    vehicleDynamics_ST: vehicleDynamics_ST_batch,
+    vehicleDynamics_MB: vehicleDynamics_MB_batch,
+}
+
+# same for car_model.compiled_kernels, these take the packed car_model.parameters_array
+BATCH_MODELS_JIT = {
+    vehicleDynamics_KS: vehicleDynamics_KS_batch_jit,
+    vehicleDynamics_ST: vehicleDynamics_ST_batch_jit,
+    vehicleDynamics_MB: vehicleDynamics_MB_batch_jit,
+}
+
+
+class car_model_batch:
+    """
+    Updates a group of car_model instances together, hidden from participants, used on server.
+    Cars are grouped by vehicle model and parameters; each group is integrated as one (N,n) array.
+    """
+
+    def __init__(self, n_substeps: int = INTEGRATOR_SUBSTEPS, method: Optional[str] = None):
+        """
+        Makes a new batched updater.
+
+        :param n_substeps: number of fixed steps per update, default car_model.INTEGRATOR_SUBSTEPS
+        :param method: name of the fixed-step integrator, see src.integrators.INTEGRATORS; None for car_model.INTEGRATOR,
+            or BATCH_FALLBACK_METHOD if that is 'solve_ivp'
+        """
+        if method is None:
+            method = INTEGRATOR if INTEGRATOR != 'solve_ivp' else BATCH_FALLBACK_METHOD
+        self.n_substeps = n_substeps
+        self.method = method
+        self.integrators: Dict[Tuple, fixed_step_integrator] = dict()  # preallocated integrators by group key, reallocated if number of cars changes
+
+    def update(self, models: List[car_model], dt_sec: float) -> None:
+        """
+        Advances all models by dt_sec. Each model's car_state is updated as by car_model.update().
+
+        :param models: the car models to update
+        :param dt_sec: time advance in seconds
+        """
+        groups: Dict[Tuple, List[car_model]] = dict()
+        for m in models:
+            groups.setdefault((m.model, m.parameters_func, m.compiled_kernels), []).append(m)
+        for key, group in groups.items():
+            self.update_group(key, group, dt_sec)
+
+    def update_group(self, key: Tuple, group: List[car_model], dt_sec: float) -> None:
+        model, parameters_func, compiled_kernels = key
+        if compiled_kernels:
+            batch_func = BATCH_MODELS_JIT[model]
+            p = group[0].parameters_array
+        else:
+            batch_func = BATCH_MODELS[model]
+            p = group[0].parameters
+
+        inputs = [m.prepare_update() for m in group]  # (command, accel) for each car
+
+        calculations_time_start = timer()
+        x = np.array([m.model_state for m in group], dtype=float)
+        u = np.array([m.u for m in group], dtype=float)
+        integrator = self.integrators.get(key)
+        if integrator is None or integrator.shape != x.shape:
+            integrator = make_integrator(self.method, x.shape)
+            self.integrators[key] = integrator
+
+        def rhs(xx):
+            return batch_func(xx, u, p)
+
+        n_evals = integrator.integrate(rhs, x, dt_sec, self.n_substeps)
+        calculations_time = timer() - calculations_time_start
+        too_slow = calculations_time > 0.8 * dt_sec
+
+        for i, m in enumerate(group):
+            m.model_state = x[i]
+            m.n_eval_total += n_evals
+            command, accel = inputs[i]
+            m.finish_update(dt_sec=dt_sec, command=command, accel=accel,
+                            calculations_time=calculations_time / len(group),  # share of the batch
+                            n_eval_diff=n_evals,
+                            t_simulated=dt_sec,
+                            too_slow=too_slow)
@@ -13,6 +13,14 @@ VERSION='1.1'
 # 1.0, car_name was in header, each row had length_m and width_m
 # 1.1 car_name, length_m, width_m moved to car_state.static_into and are now printed to header here
 
+def record_tuple_to_csvrow(l) -> str:
+    """
+    :param l: the values of car_state.get_record_tuple()
+    :return: row of CSV file
+    """
+    return ','.join(['{}'.format(v) for v in l[:-1]] + ['{:f}'.format(l[-1])])
+
+
 class car_state:
     """
     Complete state of car. Updated by hidden model based on control input.
@@ -21,14 +29,16 @@ class car_state:
 
     class static_info:
         """
-        stuff that doesn't change, but is needed for rendering the car - name, client_ip, and dimensions
+        stuff that doesn't change, but is needed for rendering the car - name, client_ip, and dimensions,
+        plus the car_id the track server uses to refer to the car in 'state' messages
 
         """
-        def __init__(self, name:str, client_ip:Tuple[str,int], length_m:float, width_m:float):
+        def __init__(self, name:str, client_ip:Tuple[str,int], length_m:float, width_m:float, car_id:Optional[int]=None):
             self.name:str=name
             self.client_ip:Tuple[str,int] = client_ip
             self.length_m:float = length_m # length in meters
             self.width_m:float = width_m # width in meters
+            self.car_id:Optional[int] = car_id # assigned by track server when car is added
 
 
     def __init__(self, name:str='l2racer', client_ip:Tuple[str,int]=None, length_m:float=4., width_m:float=2.,
@@ -140,12 +150,11 @@ class car_state:
         header+=h[-1]
         return header
 
-    def get_record_csvrow(self):
+    def get_record_tuple(self):
         """
-
-        :return: row of CSV file
+        :return: the values of a recording row, in the order of the CSV header and of src.recording.RECORD
         """
-        l=[
+        return (
             self.time,
             1 if self.command.autodrive_enabled else 0,
             self.command.steering,
@@ -163,11 +172,13 @@ class car_state:
             self.body_angle_deg,
             self.yaw_rate_deg_per_sec,
             self.drift_angle_deg,
-        ]
-        s=''
-        for v in l[:-1]:
-            s=s+('{},'.format(v))
-        s=s+('{:f}'.format(l[-1]))
-        return s
+        )
+
+    def get_record_csvrow(self):
+        """
+
+        :return: row of CSV file
+        """
+        return record_tuple_to_csvrow(self.get_record_tuple())
 
 
@@ -7,32 +7,33 @@ from typing import Tuple, List, Optional, Dict
 import argparse
 import argcomplete as argcomplete
 import select
-from pandas import DataFrame
 from pygame.math import Vector2
 import pygame.freetype  # Import the freetype module.
-import pickle
 import socket
 import time
 import pygame
 import sys
 import atexit
-import pandas as pd
-import re
 import timeit
 
 from src.car_state import car_state
 from src.data_recorder import data_recorder
+from src.replay import replay_engine, find_recording, FIELD_INDEX
 from src.l2race_utils import find_unbound_port_in_range, open_ports, loop_timer
 from src.globals import *
 from src.track import track
 from src.car import car
 from src.my_args import client_args, write_args_info
 from src.l2race_utils import my_logger
+from src.protocol import encode_message, decode_message, protocol_error, record_to_car_state, car_state_from_info, \
+    state_decoder, split_message, reassembler, RECV_BUFFER_BYTES
 from src.controllers.pid_next_waypoint_car_controller import pid_next_waypoint_car_controller
 from src.keyboard_and_joystick_input import keyboard_and_joystick_input
 
 logger = my_logger(__name__)
 
+CAR_INFO_RETRY_S = 1.0  # ask the server again for the 'car_info' of a car if it has not arrived this long after asking
+
 
 # logger.setLevel(logging.DEBUG) # uncomment to debug
 
@@ -81,7 +82,8 @@ class client:
                  timeout_s: float = SERVER_TIMEOUT_SEC,
                  record: Optional[str] = None,
                  replay_file_list: Optional[List[str]] = None,
-                 lidar: float = None
+                 lidar: float = None,
+                 record_format: str = 'csv'
                  ):
         """
         Makes a new instance of client that users use to run a car on a track.
@@ -99,6 +101,8 @@ class client:
         :param timeout_s: socket read timeout for blocking reads (main loop uses nonblocking reads)
         :param record: set it None to not record. Set it to a string to add note for this recording to file name to record data for all cars to CSV files
         :param replay_file_list: None for normal live mode, or List[str] of filenames to play back a set of car recordings together
+        :param lidar: draw the point where the car would hit the track edge, None to not draw it
+        :param record_format: 'csv' or 'bin' (binary columnar format of src.recording) for the recordings
         """
 
         pygame.init()
@@ -129,6 +133,7 @@ class client:
         self.recording_enabled: bool = not record is None
         self.record_note: Optional[str] = record if not record is None else None
         self.data_recorders: Optional[List[data_recorder]] = None
+        self.record_format: str = record_format
         self.replay_file_list: Optional[List[str]] = replay_file_list
         self.track_name: str = track_name
         self.car_name: str = car_name
@@ -147,6 +152,10 @@ class client:
         self.track_instance: track = track(track_name=self.track_name)
         self.spectate_cars: Dict[
             str, car] = dict()  # dict of other cars (NOT including ourselves) on the track, by name of the car. Each entry is a car() that we make here. For spectators, the list contains all cars. The cars contain the car_state. The complete list of all cars is this dict plus self.car
+        self.reassembler = reassembler()  # puts together messages that the server sent in chunks
+        self.state_decoder = state_decoder()  # decodes the delta compressed 'state' messages, keeps the seq we acknowledge
+        self.remote_states: Dict[int, car_state] = dict()  # car_state of each car on the track by static_info.car_id, made from 'car_info' messages and updated by 'state'
+        self.car_info_requests: Dict[int, float] = dict()  # time.time() we last asked for the 'car_info' of each car_id that has not arrived yet
         self.autodrive_controller = controller  # automatic self driving controller specified in constructor
 
         self.lidar = lidar # variable controlling if to show lidar mini and with what precission
@@ -253,12 +262,13 @@ class client:
             self.send_to_server(self.serverStartAddr, cmd, payload)
 
             try:
-                # now get the game port as a response
-                logger.info('pausing for server track process to start (if not running already)')
-                time.sleep(
-                    2)  # it takes significant time to start the track process. To avoid timeout, wait a bit here before checking
+                # now get the game port as a response, the server sends it once the track is running
                 logger.info('receiving game_port message from server')
-                msg, payload = self.receive_from_server()
+                self.sock.settimeout(TRACK_START_TIMEOUT_S + self.server_timeout_s)
+                try:
+                    msg, payload = self.receive_from_server(blocking=True)
+                finally:
+                    self.sock.settimeout(self.server_timeout_s)
                 if msg != 'game_port':
                     logger.warning(
                         "got response (msg,command)=({},{}) but expected ('game_port',port_number); will try again in {}s".format(
@@ -272,6 +282,9 @@ class client:
                 continue
             port = int(payload)
             self.gotServer = True
+            self.remote_states.clear()
+            self.car_info_requests.clear()
+            self.state_decoder = state_decoder()
             self.gameSockAddr: Tuple[str, int] = (self.server_host, port)
             logger.info('got game_port message from server telling us to use address {} to talk with server'.format(
                 self.gameSockAddr))
@@ -280,7 +293,7 @@ class client:
                                client_ip=self.gameSockAddr)
                 if self.recording_enabled:
                     if self.data_recorders is None:  # todo add other cars to data_recorders as we get them from server
-                        self.data_recorders = [data_recorder(car=self.car)]
+                        self.data_recorders = [data_recorder(car=self.car, note=self.record_note, record_format=self.record_format)]
                         try:
                             self.data_recorders[0].open_new_recording()
                         except RuntimeError as e:
@@ -346,11 +359,12 @@ class client:
             # TODO move to method that uses select to check for response if any
             # expect to get new car state
             try:
-                cmd, payload = self.receive_from_server(blocking=False)
-                if cmd is None:
+                messages = self.receive_latest_from_server()
+                if not messages:
                     continue
 
-                self.handle_message(cmd, payload)
+                for cmd, payload in messages:
+                    self.handle_message(cmd, payload)
                 if self.data_recorders:
                     for r in self.data_recorders:
                         r.write_sample()
@@ -358,8 +372,8 @@ class client:
             except socket.timeout:
                 logger.warning('Timeout on socket receive from server, using previous car state. '
                                'Check server to make sure it is still running')
-            except pickle.UnpicklingError as err:
-                logger.warning('{}: could not unpickle the response from server'.format(err))
+            except protocol_error as err:
+                logger.warning('{}: could not decode the response from server'.format(err))
             except TypeError as te:
                 logger.warning(str(te) + ": ignoring and waiting for next state")
             except ConnectionResetError:
@@ -406,24 +420,48 @@ class client:
                     self.data_recorders = None
 
             # send control to server
-            self.send_to_server(self.gameSockAddr, 'command', command)
+            self.send_to_server(self.gameSockAddr, 'command', (command, self.state_decoder.last_seq))
         else:
-            self.send_to_server(self.gameSockAddr, 'send_states', None)
+            self.send_to_server(self.gameSockAddr, 'send_states', self.state_decoder.last_seq)
 
     def receive_from_server(self, blocking=False) -> Tuple[Optional[str], Optional[object]]:
         ''' attempt to receive msg from server
         :param blocking - set true for blocking receive. If false, returns None,None if there is nothing for us
         :returns (cmd,payload), or None,None if nonblocking and nothing is ready
         '''
-        if not blocking:
-            inputready, o, e = select.select([self.sock], [], [], 0.0)
-            if len(inputready) == 0: return None, None  # nothing for us now
-        data, server_addr = self.sock.recvfrom(
-            8192)  # todo check if large enough for payload inclding all other car state
-        (cmd, payload) = pickle.loads(data)
+        while True:
+            if not blocking:
+                inputready, o, e = select.select([self.sock], [], [], 0.0)
+                if len(inputready) == 0: return None, None  # nothing for us now
+            data, server_addr = self.sock.recvfrom(RECV_BUFFER_BYTES)
+            data = self.reassembler.add(data, server_addr)
+            if data is not None:
+                break  # else it was a chunk of a longer message, get the rest
+        (cmd, payload) = decode_message(data)
         logger.debug('got message {} with payload {} from server {}'.format(cmd, payload, server_addr))
         return cmd, payload
 
+    def receive_latest_from_server(self) -> List[Tuple[str, object]]:
+        """
+        Drains all the messages that are waiting from the server, without blocking.
+        Of several 'state' messages only the latest is kept, so we never fall behind the server.
+
+        :returns: list of (cmd,payload) in order of arrival, empty if nothing was ready
+        """
+        messages = []
+        latest_state = None
+        while True:
+            cmd, payload = self.receive_from_server(blocking=False)
+            if cmd is None:
+                break
+            if cmd == 'state':
+                latest_state = payload
+            else:
+                messages.append((cmd, payload))
+        if latest_state is not None:
+            messages.append(('state', latest_state))
+        return messages
+
     def send_to_server(self, addr: Tuple[str, int], msg: str, payload: object):
         """
         Send msg,payload to server at specified (ip,port)
@@ -439,8 +477,8 @@ class client:
             logger.warning('no socket to send message {} with payload {}'.format(msg, payload))
             return
         logger.debug('sending msg {} with payload {} to {}'.format(msg, payload, addr))
-        p = pickle.dumps((msg, payload))
-        self.sock.sendto(p, addr)
+        for p in split_message(encode_message(msg, payload)):
+            self.sock.sendto(p, addr)
 
     def process_top_ten_list(self, payload):
         pass
@@ -456,7 +494,7 @@ class client:
             while True:
                 inputready, o, e = select.select(sock_input, [], [], 0.0)
                 if len(inputready) == 0: break
-                for s in inputready: s.recv(8192)
+                for s in inputready: s.recv(RECV_BUFFER_BYTES)
         except Exception as e:
             logger.warning('caught {} when draining received UDP port messaages'.format(e))
 
@@ -505,10 +543,8 @@ class client:
             y_track = self.car.car_state.position_m.y
             x_map = self.track_instance.meters2pixels(x_track)
             y_map = self.track_instance.meters2pixels(y_track)
-            hit_pos = self.track_instance.find_hit_position(angle=self.car.car_state.body_angle_deg,
-                                                            pos=(x_map, y_map),
-                                                            track_map=self.track_instance.map_lidar,
-                                                            dl=self.lidar)
+            hit_pos = self.track_instance.find_hit_position_exact(angle=self.car.car_state.body_angle_deg,
+                                                                  pos=(x_map, y_map))
             if hit_pos is not None:
                 pygame.draw.line(self.screen, (0, 0, 255), (x_map, y_map), hit_pos)
                 pygame.draw.circle(self.screen, (0, 255, 0), hit_pos, 3)
@@ -538,14 +574,14 @@ class client:
         to_remove: List[str] = [x for x in dict_car_names if x not in current_state_car_names]
         dr_to_remove = []
         for r in to_remove:
-            del self.spectate_cars[r]
-            for dr in self.data_recorders:
+            self.spectate_cars.pop(r, None)  # our own car is not in spectate_cars
+            for dr in (self.data_recorders or []):
                 if dr.car.name() == r:
                     logger.debug('closing data recorder for lost car {}'.format(r))
                     dr.close_recording()
                     dr_to_remove.append(dr)
         for d in dr_to_remove:
-            del self.data_recorders[d]
+            self.data_recorders.remove(d)
         for s in all_states:
             name = s.static_info.name  # get the car name from the remote state
             if name == self.car_name:
@@ -576,7 +612,7 @@ class client:
                 sc = self.spectate_cars[c]
                 if sc.car_state.hostname() == self.car.car_state.hostname():
                     continue  # don't record other cars running also from us
-                dr = data_recorder(car=sc)
+                dr = data_recorder(car=sc, note=self.record_note, record_format=self.record_format)
                 self.data_recorders.append(dr)
                 try:
                     dr.open_new_recording()
@@ -584,6 +620,30 @@ class client:
                     logger.warning('Could not open data recorder for car {}: caught exception {}'.format(sc, e))
         # logger.debug('After update, have own car {} and other cars {}'.format(self.car.car_state.static_info.name if self.car else 'None', self.spectate_cars.keys()))
 
+    def states_from_records(self, records) -> List[car_state]:
+        """
+        Updates the car states of all cars from the records of a 'state' message.
+        Asks the server for the 'car_info' of cars we do not know yet; these are skipped until it arrives.
+        A request is repeated only if its reply has not arrived within CAR_INFO_RETRY_S.
+
+        :param records: array of src.protocol.STATE_RECORD
+        :return: the list of states of all known cars in the message
+        """
+        states = []
+        now = time.time()
+        for r in records:
+            car_id = int(r['car_id'])
+            s = self.remote_states.get(car_id)
+            if s is None:
+                t = self.car_info_requests.get(car_id)
+                if t is None or now - t > CAR_INFO_RETRY_S:
+                    self.car_info_requests[car_id] = now
+                    self.send_to_server(self.gameSockAddr, 'send_car_info', car_id)
+                continue
+            record_to_car_state(r, s)
+            states.append(s)
+        return states
+
     def handle_message(self, msg: str, payload: object):
         """
         Handle message from model server.
@@ -593,7 +653,17 @@ class client:
         :return: None
         """
         if msg == 'state':
-            self.update_state(payload)  # assumes that payload is List[car_state]
+            records = self.state_decoder.decode(payload)  # array of src.protocol.STATE_RECORD
+            if records is None:
+                return  # lost the state it is based on, the server sends a keyframe when it sees our acknowledgement
+            self.update_state(self.states_from_records(records))
+        elif msg == 'car_info':
+            s = car_state_from_info(payload)
+            self.remote_states[s.static_info.car_id] = s
+            self.car_info_requests.pop(s.static_info.car_id, None)
+        elif msg == 'server_msg':
+            if self.car:
+                self.car.car_state.server_msg = payload
         elif msg == 'game_port':
             self.gameSockAddr = (self.server_host, payload)
         elif msg == 'track_shutdown':
@@ -610,90 +680,53 @@ class client:
 
     def replay(self) -> bool:
         """
-        Replays the self.replay_file_list recordings. It will immediately return False if it cannot find the file to play. Otherwise
-        it will start a loop that runs over the entire file to play it, and finally return True.
-
-        :returns: False if it cannot find the file to play, True at the end of playing the entire recording.
-        """
-        # Load data
-        file_path = None
-        filename = None
-        # Find the right file
-        if (self.replay_file_list is not None) and (self.replay_file_list is not 'last'):
-
-            if isinstance(self.replay_file_list, List) and len(self.replay_file_list) > 1:
-                filename = self.replay_file_list[0]
-                raise NotImplemented('Replaying more than one recording is not yet implemented')
-
-            if isinstance(self.replay_file_list, str):
-                filename = self.replay_file_list
+        Replays the self.replay_file_list recordings together. It will immediately return False if it cannot find or load
+        the files to play. Otherwise it will start a loop that plays the recordings, and finally return True.
 
-            if not filename.endswith('.csv'):
-                filename = filename + '.csv'
+        The steering input sets the playback rate: to the right plays faster forwards, to the left plays backwards.
+        The restart car input jumps back to the start.
 
-            # if filename is a path, then use the path, otherwise, look for file at starting folder and in DATA_FOLDER_NAME folder
-            if os.sep in filename:
-                # treat as local or DATA_FOLDER filename
-                file_path = filename
-                if not os.path.isfile(filename):
-                    logger.error('Cannot replay: There is no race recording file with name {}'.format(filename))
-                    return False
-            else:
-                # check if file found in DATA_FOLDER_NAME or at local starting point
-                if not os.path.isfile(filename):
-                    file_path = os.path.join(DATA_FOLDER_NAME, filename)
-                    if not os.path.isfile(file_path):
-                        logger.error(
-                            'Cannot replay: There is no race recording file with name {} at local folder or in {}'.format(
-                                file_path, DATA_FOLDER_NAME))
-                        return False
-                else:
-                    file_path = filename
-
-        elif self.replay_file_list == 'last':
-            try:
-                import glob
-                list_of_files = glob.glob(DATA_FOLDER_NAME + '/*.csv')
-                file_path = max(list_of_files, key=os.path.getctime)
-            except FileNotFoundError:
-                logger.error('Cannot replay: No race recording found in data folder ' + DATA_FOLDER_NAME)
-                return False
+        :returns: False if it cannot find or load the files to play, True at the end of playing.
+        """
+        # Find the right files
+        if isinstance(self.replay_file_list, str):
+            filenames = [self.replay_file_list]
         else:
-            logger.error('Cannot replay: filename is None')
-            return False
+            filenames = list(self.replay_file_list) or ['last']  # --replay without files plays the last one
+        file_paths = []
+        for filename in filenames:
+            file_path = find_recording(filename)
+            if file_path is None:
+                logger.error('Cannot replay: There is no race recording file with name {} at local folder or in {}'
+                             .format(filename, DATA_FOLDER_NAME))
+                return False
+            file_paths.append(file_path)
 
-        # Get race recording
-        logger.info('Replaying file {}'.format(file_path))
+        # Get race recordings
+        logger.info('Replaying files {}'.format(file_paths))
         try:
-            data: DataFrame = pd.read_csv(file_path, comment='#')  # skip comment lines starting with #
+            engine = replay_engine(file_paths)
         except Exception as e:
-            logger.error('Cannot replay: Caught {} trying to read CSV file {}'.format(e, file_path))
+            logger.error('Cannot replay: Caught {} trying to read recordings {}'.format(e, file_paths))
             return False
 
-        # Get used car name
-        s = str(pd.read_csv(file_path, skiprows=5, nrows=1))
-        self.track_name = re.search('"(.*)"', s).group(1)
-        logger.debug(self.track_name)
-
-        # Get used track
-        s = str(pd.read_csv(file_path, skiprows=6, nrows=1))
-        self.car_name = re.search('"(.*)"', s).group(1)
-        logger.debug(self.car_name)
-
-        # print(file_path)
-        # print(data.head())
-
-        # Define car and track
+        # Define cars and track; the first recording is drawn as our own car
+        self.track_name = engine.track_name
         self.track_instance = track(self.track_name)
-        self.car = car(name=self.car_name, our_track=self.track_instance, screen=self.screen)
-
-        # decimate data to make it play faster
-        # data = data.iloc[::4, :]
+        cars: List[car] = []
+        for i, r in enumerate(engine.recordings):
+            c = car(name=r.car_name, our_track=self.track_instance, screen=self.screen,
+                    image_name='car_red' if i == 0 else 'car_other')
+            cars.append(c)
+            if i == 0:
+                self.car_name = r.car_name
+                self.car = c
+            else:
+                self.spectate_cars[r.car_name + '-{}'.format(i)] = c
+        logger.debug('replaying track {} with cars {}'.format(self.track_name, [r.car_name for r in engine.recordings]))
 
-        # Run a loop to print data
-        n_rows = data.shape[0]
-        r = 0
-        step = 1
+        # Run a loop to draw the cars at playback time t
+        t = engine.t_start
         scale = 10
         looper = loop_timer(rate_hz=self.fps)
         while not self.exit:
@@ -709,28 +742,14 @@ class client:
                 continue
             playback_speed = car_command.steering
 
-            row = data.iloc[
-                r]  # position based indexing of DataFrame https://pythonhow.com/accessing-dataframe-columns-rows-and-cells/
-            # for index, row in data.iterrows():
-            self.car.car_state.command.autodrive_enabled = row['cmd.auto']
-            self.car.car_state.command.steering = row['cmd.steering']
-            self.car.car_state.command.throttle = row['cmd.throttle']
-            self.car.car_state.command.brake = row['cmd.brake']
-            self.car.car_state.command.reverse = row['cmd.reverse']
-
-            self.car.car_state.time = row['time']
-            self.car.car_state.position_m = Vector2(row['pos.x'], row['pos.y'])
-            self.car.car_state.velocity_m_per_sec = Vector2(row['vel.x'], row['vel.y'])
-            self.car.car_state.speed_m_per_sec = row['speed']
-            self.car.car_state.accel_m_per_sec_2 = Vector2(row['accel.x'], row['accel.y'])
-            self.car.car_state.steering_angle_deg = row['steering_angle']
-            self.car.car_state.body_angle_deg = row['body_angle']
-            self.car.car_state.yaw_rate_deg_per_sec = row['yaw_rate']
-            self.car.car_state.drift_angle_deg = row['drift_angle']
+            for c, r, row in zip(cars, engine.recordings, engine.sample(t)):
+                if row is None:
+                    continue  # not recorded at this time, keep the car where it was
+                self.set_car_state_from_replay(c.car_state, row, r.car_time_at(t))
 
             # Drawing
             self.draw()
-            frac = float(r) / n_rows
+            frac = (t - engine.t_start) / engine.duration if engine.duration > 0 else 1.
             w = frac * (self.screen.get_width() - 10)
             pygame.draw.rect(self.screen, [200, 200, 200], [10, self.screen.get_height() - 20, w, 10], True)
 
@@ -741,18 +760,40 @@ class client:
                 break
 
             if user_input.restart_car:
-                r = 0
-            if playback_speed >= -0.05:  # offset from zero to handle joysticks that have negative offset
-                r = r + step if r < n_rows - step else n_rows
-                if r > n_rows - 1: r = n_rows - 1
-            else:
-                r = r - step if r > 0 else 0
-            step = int(abs(playback_speed) * scale)
-            step = 1 if step < 1 else step
-            # speedup is factor times normal speed, limited by rendering rate
-            looper.rate_hz = self.fps * (1 + abs(scale * playback_speed))
+                t = engine.t_start
+            # speedup is factor times normal speed, backwards for negative playback_speed
+            rate = 1 + abs(scale * playback_speed)
+            if playback_speed < -0.05:  # offset from zero to handle joysticks that have negative offset
+                rate = -rate
+            t = engine.clamp(t + rate / self.fps)
         return True
 
+    @staticmethod
+    def set_car_state_from_replay(s: car_state, row, car_time: float) -> None:
+        """
+        Sets a car state from a row of src.replay.REPLAY_FIELDS.
+
+        :param s: the car state to set
+        :param row: the row, as returned by replay_engine.sample()
+        :param car_time: the time on the car's clock
+        """
+        f = FIELD_INDEX
+        s.command.autodrive_enabled = bool(row[f['cmd.auto']])
+        s.command.steering = row[f['cmd.steering']]
+        s.command.throttle = row[f['cmd.throttle']]
+        s.command.brake = row[f['cmd.brake']]
+        s.command.reverse = bool(row[f['cmd.reverse']])
+
+        s.time = car_time
+        s.position_m = Vector2(row[f['pos.x']], row[f['pos.y']])
+        s.velocity_m_per_sec = Vector2(row[f['vel.x']], row[f['vel.y']])
+        s.speed_m_per_sec = row[f['speed']]
+        s.accel_m_per_sec_2 = Vector2(row[f['accel.x']], row[f['accel.y']])
+        s.steering_angle_deg = row[f['steering_angle']]
+        s.body_angle_deg = row[f['body_angle']]
+        s.yaw_rate_deg_per_sec = row[f['yaw_rate']]
+        s.drift_angle_deg = row[f['drift_angle']]
+
     def restart_car(self, message: str = None):
         """
         Request server to restart the car.
@@ -833,7 +874,8 @@ def define_game(gui=True,  # set to False to prevent gooey dialog
                       timeout_s=args.timeout_s,
                       record=args.record,
                       replay_file_list=args.replay,
-                      lidar=args.lidar)
+                      lidar=args.lidar,
+                      record_format=args.record_format)
     else:
 
         IGNORE_COMMAND = '--ignore-gooey'
@@ -889,6 +931,7 @@ def define_game(gui=True,  # set to False to prevent gooey dialog
                       timeout_s=timeout_s,
                       record=args.record,
                       replay_file_list=args.replay,
-                      lidar=args.lidar)
+                      lidar=args.lidar,
+                      record_format=args.record_format)
 
     return game
@@ -1,26 +1,154 @@
 # records data from l2race car
+# The game loop only takes a snapshot of the car_state values of each sample and puts it in a bounded queue. The single
+# recording_writer thread batches the samples of all recorders, formats them and writes and flushes the files, so
+# formatting and disk writes do not add to the frame time. If the writer falls behind, samples are dropped and counted.
 import os
+import time
+import getpass
+import threading
 from collections import OrderedDict
+from queue import Queue, Empty, Full
+from typing import Optional, Dict, List
+
+import numpy as np
 
 from src.car import car
 
+from src.car_state import VERSION, record_tuple_to_csvrow
 from src.globals import DATA_FILENAME_BASE, DATA_FOLDER_NAME
 from src.l2race_utils import my_logger
+from src.recording import recording_suffix, write_sidecar, RECORD, WRITE_CHUNK_RECORDS
 import atexit
 
 logger = my_logger(__name__)
 
+RECORDING_QUEUE_SIZE = 4096  # samples of all recorders waiting for the writer thread, more are dropped
+RECORDING_FLUSH_INTERVAL_S = 1.0  # the writer flushes the files at least this often
+RECORDING_CLOSE_TIMEOUT_S = 5.0  # close_recording waits at most this long for the writer to write the rest
+
+
+class recording_writer:
+    """
+    The background thread that formats and writes the samples of all data_recorders.
+    """
+
+    def __init__(self, queue_size: int = RECORDING_QUEUE_SIZE):
+        """
+        Starts the writer thread.
+
+        :param queue_size: samples that can wait for the writer before they are dropped
+        """
+        self.queue: Queue = Queue(maxsize=queue_size)  # (data_recorder, sample tuple), or (data_recorder, None) to close it
+        self.num_dropped = 0  # samples dropped because the queue was full, of all recorders
+        self.thread = threading.Thread(target=self._run, name='recording_writer', daemon=True)
+        self.thread.start()
+
+    def put(self, recorder: 'data_recorder', sample: tuple) -> bool:
+        """
+        Queues a sample without blocking.
+
+        :param recorder: the recorder of the sample
+        :param sample: the values of car_state.get_record_tuple()
+        :returns: False if the queue is full and the sample was dropped
+        """
+        try:
+            self.queue.put_nowait((recorder, sample))
+            return True
+        except Full:
+            self.num_dropped += 1
+            return False
+
+    def close(self, recorder: 'data_recorder') -> bool:
+        """
+        Writes the queued samples of recorder, then closes its file.
+
+        :param recorder: the recorder to close
+        :returns: False if the writer did not finish within RECORDING_CLOSE_TIMEOUT_S; it still closes the file when
+            it gets to it
+        """
+        done = threading.Event()
+        recorder.closed_event = done
+        try:
+            self.queue.put_nowait((recorder, None))
+        except Full:  # queue the close from another thread, so the caller waits at most RECORDING_CLOSE_TIMEOUT_S
+            threading.Thread(target=self.queue.put, args=((recorder, None),), name='recording_close', daemon=True).start()
+        return done.wait(RECORDING_CLOSE_TIMEOUT_S)
+
+    def _run(self):
+        to_flush = set()
+        last_flush_time = time.time()
+        while True:
+            items = []
+            try:
+                items.append(self.queue.get(timeout=RECORDING_FLUSH_INTERVAL_S))
+                while len(items) < WRITE_CHUNK_RECORDS:
+                    items.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            batches: Dict[data_recorder, List[tuple]] = OrderedDict()
+            for (recorder, sample) in items:
+                if sample is None:  # write what we have so far, then close
+                    self._write(recorder, batches.pop(recorder, []))
+                    to_flush.discard(recorder)
+                    recorder._close_file()
+                    continue
+                batches.setdefault(recorder, []).append(sample)
+            for recorder, samples in batches.items():
+                self._write(recorder, samples)
+                to_flush.add(recorder)
+            if time.time() - last_flush_time > RECORDING_FLUSH_INTERVAL_S:
+                for recorder in to_flush:
+                    if recorder.file:
+                        recorder.file.flush()
+                to_flush.clear()
+                last_flush_time = time.time()
+
+    def _write(self, recorder: 'data_recorder', samples: List[tuple]):
+        if not samples or recorder.file is None:
+            return
+        try:
+            if recorder.record_format == 'csv':
+                recorder.file.write('\n'.join(record_tuple_to_csvrow(s) for s in samples) + '\n')
+            else:
+                np.array(samples, dtype=RECORD).tofile(recorder.file)
+            recorder.num_written += len(samples)
+        except (OSError, ValueError) as e:
+            logger.warning('could not write {} samples to {}: {}'.format(len(samples), recorder.filename, e))
+
+
+_writer: Optional[recording_writer] = None
+
+
+def get_recording_writer() -> recording_writer:
+    """ :returns: the recording_writer shared by all data_recorders, started when it is first needed """
+    global _writer
+    if _writer is None:
+        _writer = recording_writer()
+    return _writer
+
 
 class data_recorder:
 
-    def __init__(self, car:car,  note:str=None, filebase:str=DATA_FILENAME_BASE):
+    def __init__(self, car:car,  note:str=None, filebase:str=DATA_FILENAME_BASE, record_format:str='csv'):
+        """
+        :param car: the car to record
+        :param note: optional note added to the filename
+        :param filebase: start of the filename
+        :param record_format: 'csv' for CSV text or 'bin' for the binary columnar format of src.recording
+        """
         self.car:car=car
         self.filebase:str=filebase
         self.filename=None
         self.file=None
-        self.num_records=0
+        self.num_records=0  # samples given to the writer
+        self.num_written=0  # samples written by the writer thread
+        self.num_dropped=0  # samples dropped because the writer was behind
         self.first_record_written=False
         self.note=note
+        self.record_format=record_format
+        self.info=None  # header information of a binary recording, written to its sidecar
+        self.writer:Optional[recording_writer]=None
+        self.closed_event:Optional[threading.Event]=None  # set by the writer when it closed the file
 
     def open_new_recording(self)->None:
         """
@@ -33,24 +161,44 @@ class data_recorder:
             logger.warning('recording {} is already open, close it and open a new one'.format(self.filename))
             return
 
-        import time
         timestr = time.strftime("%Y%m%d-%H%M%S") # e.g. '20200819-1601'
         if not os.path.exists(DATA_FOLDER_NAME):
             logger.info('creating output folder {}'.format(DATA_FOLDER_NAME))
             os.makedirs(DATA_FOLDER_NAME)
 
+        suffix=recording_suffix(self.record_format)
         namestring=str.split(self.car.name(),'-')[0]
         if self.note!='' and not self.note is None:
-            self.filename='{}-{}-{}-{}-{}.csv'.format(DATA_FILENAME_BASE,  namestring, self.car.track.name, self.note, timestr)
+            self.filename='{}-{}-{}-{}-{}{}'.format(DATA_FILENAME_BASE,  namestring, self.car.track.name, self.note, timestr, suffix)
         else:
-            self.filename='{}-{}-{}-{}.csv'.format(DATA_FILENAME_BASE, namestring, self.car.track.name, timestr)
+            self.filename='{}-{}-{}-{}{}'.format(DATA_FILENAME_BASE, namestring, self.car.track.name, timestr, suffix)
         self.filename=os.path.join(DATA_FOLDER_NAME, self.filename)
 
         try:
-            self.file=open(self.filename,'w')
-            print(self.car.car_state.get_record_headers(self.car), file=self.file)
+            if self.record_format=='csv':
+                self.file=open(self.filename,'w')
+                print(self.car.car_state.get_record_headers(self.car), file=self.file)
+            else:
+                self.file=open(self.filename,'wb')
+                static_info=self.car.car_state.static_info
+                self.info=OrderedDict([
+                    ('format_version', VERSION),
+                    ('creation_time', time.strftime('%I:%M%p %B %d %Y')),
+                    ('creation_time_epoch_ms', int(time.time() * 1000.)),
+                    ('username', getpass.getuser()),
+                    ('track_name', self.car.track.name),
+                    ('car_name', static_info.name),
+                    ('length_m', static_info.length_m),
+                    ('width_m', static_info.width_m),
+                    ('note', self.note),
+                    ('num_records', 0),
+                ])
+                write_sidecar(self.filename, self.info)
+            self.writer=get_recording_writer()
             atexit.register(self.close_recording)
             self.num_records=0
+            self.num_written=0
+            self.num_dropped=0
             self.first_record_written=False
             logger.info('created new recording {}'.format(self.filename))
         except Exception as ex:
@@ -60,19 +208,41 @@ class data_recorder:
 
     def close_recording(self):
         if self.file:
-            logger.info('closing recording {} with {} records'.format(self.filename, self.num_records))
-            self.file.close()
-            self.file=None
+            if not self.writer.close(self):  # only the writer thread touches the file, it closes it when it gets to it
+                logger.warning('writer did not finish recording {} within {}s, it will close it when it is done'.format(self.filename, RECORDING_CLOSE_TIMEOUT_S))
+                return
+            logger.info('closed recording {} with {} records, dropped {}'.format(self.filename, self.num_written, self.num_dropped))
         else:
             logger.warning('no recording {} to close, maybe never opened?'.format(self.filename))
 
     def write_sample(self):
+        """ queues the current car_state for the writer thread; never blocks """
         if self.file is None:
             logger.warning('there is no output file open to record to')
             return
-        print(self.car.car_state.get_record_csvrow(), file=self.file)
-        self.first_record_written=True
-        self.num_records+=1
-
-        pass
+        if self.writer.put(self, self.car.car_state.get_record_tuple()):
+            self.first_record_written=True
+            self.num_records+=1
+        else:
+            self.num_dropped+=1
+            if self.num_dropped==1 or self.num_dropped%1000==0:
+                logger.warning('recording writer is behind, dropped {} samples of {}'.format(self.num_dropped, self.filename))
 
+    def _close_file(self):
+        """ closes the file, called by the writer thread after it wrote all queued samples """
+        f=self.file
+        if f is None:  # closed already, e.g. by a close_recording that timed out
+            if self.closed_event:
+                self.closed_event.set()
+            return
+        self.file=None
+        try:
+            if self.record_format!='csv':
+                self.info['num_records']=self.num_written
+                self.info['num_dropped']=self.num_dropped
+                write_sidecar(self.filename, self.info)
+            f.close()
+        except OSError as e:
+            logger.warning('could not close recording {}: {}'.format(self.filename, e))
+        if self.closed_event:
+            self.closed_event.set()
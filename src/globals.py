@@ -74,6 +74,7 @@ CLIENT_PORT_RANGE='50010-50020' # range of ports used for client that server use
     # client needs to open/forward this port range for receiving state from server and sending commands to server
     # The ENABLE_UPNP flag turns on automatic forwarding but it does not work with all routers.
 KILL_ZOMBIE_TRACK_TIMEOUT_S=10 # if track process gets no input for this long, it terminates itself
+TRACK_START_TIMEOUT_S=5 # server waits this long for a worker to start a track before telling client the game_port; client waits this plus its socket timeout for game_port
 FRICTION_FACTOR = .5 # overall friction parameter multiplier for some models
 SAND_SLOWDOWN = 0.975  # If in sand, at every update the resulting velocity is multiplied by the slowdown factor
 REVERSE_TO_FORWARD_GEAR = 0.5  # You get less acceleration on reverse gear than while moving forwards.
@@ -0,0 +1,217 @@
+# headless simulation of a car on a track, for controller tuning and making datasets
+# The car_model is stepped with a fixed dt as fast as the CPU allows: there are no sockets, no server, no loop_timer
+# and no pygame window. A controller drives the car exactly as it does in the client, through its read() method.
+# Each run returns the trajectory as arrays, with the rows in the RECORD layout of the recordings from src.recording,
+# so trajectories can be saved as binary recordings and used by the replay and modeling tools.
+import random
+import time
+import getpass
+from collections import OrderedDict
+from timeit import default_timer as timer
+from typing import Optional, List, Dict
+
+import numpy as np
+
+from src.car_command import car_command
+from src.car_model import car_model
+from src.car_model_batch import car_model_batch
+from src.car_state import VERSION
+from src.globals import MODEL_UPDATE_RATE_HZ
+from src.l2race_utils import my_logger
+from src.recording import RECORD, write_sidecar
+from src.track_geometry import track_geometry
+
+logger = my_logger(__name__)
+
+HEADLESS_DT_S = 1. / MODEL_UPDATE_RATE_HZ  # default fixed time step, the same as the server
+HEADLESS_BATCH_INTEGRATOR = True  # True to step with car_model_batch as the server does, False for car_model.update with car_model.INTEGRATOR
+HEADLESS_CAR_NAME = 'headless'
+
+
+class headless_car:
+    """
+    What a controller sees of the car: its car_state and track, like src.car.car but without pygame.
+    """
+
+    def __init__(self, model: car_model):
+        """
+        :param model: the simulated car
+        """
+        self.model = model
+
+    @property
+    def car_state(self):
+        return self.model.car_state  # car_model.restart makes a new car_state
+
+    @property
+    def track(self):
+        return self.model.track
+
+    def name(self) -> str:
+        return self.model.car_name()
+
+
+class trajectory:
+    """
+    The result of one run of headless_simulator.
+    """
+
+    def __init__(self, records: np.ndarray, model_states: np.ndarray, lap_times: List[float], info: Dict):
+        """
+        :param records: one RECORD row per step, the car_state after the step
+        :param model_states: (steps, model state length) array, the car_model.model_state after each step
+        :param lap_times: duration in seconds of each completed lap
+        :param info: header information of the run: track_name, car_name, model, parameters, dt, ...
+        """
+        self.records = records
+        self.model_states = model_states
+        self.lap_times = lap_times
+        self.info = info
+
+    def __len__(self):
+        return len(self.records)
+
+    def save(self, filename: str) -> None:
+        """
+        Saves the records as a binary recording with its sidecar, see src.recording.load_recording().
+
+        :param filename: the file, it should end with src.recording.BINARY_SUFFIX
+        """
+        self.records.tofile(filename)
+        info = dict(self.info)
+        info['num_records'] = len(self.records)
+        write_sidecar(filename, info)
+
+
+class headless_simulator:
+    """
+    Runs one car_model on a track with a controller, faster than real time.
+    """
+
+    def __init__(self, track_name: str, controller: Optional[object] = None, model=None, parameters=None,
+                 dt: float = HEADLESS_DT_S, allow_off_track: bool = False, car_name: str = HEADLESS_CAR_NAME,
+                 track: Optional[track_geometry] = None, start_position: Optional[int] = None,
+                 seed: Optional[int] = None):
+        """
+        Makes the simulator and its car.
+
+        :param track_name: name of the track, e.g. track_1
+        :param controller: controller with a read() method returning a car_command or a (car_command, user_input)
+            tuple, e.g. a pid_next_waypoint_car_controller; its car is set to the simulated car. Default is
+            pid_next_waypoint_car_controller
+        :param model: vehicle dynamics function, see car_model; None for the default
+        :param parameters: vehicle parameters function, see car_model; None for the default
+        :param dt: fixed time step in seconds
+        :param allow_off_track: True to let the car leave the track without slowing down
+        :param car_name: name of the car
+        :param track: an already loaded track_geometry of track_name, to share it between simulators
+        :param start_position: 1 or 2 to always start at that start position of the track, None to choose at random
+        :param seed: seed of the random start positions; with a seed and a deterministic controller every run is the same
+        """
+        if controller is None:
+            from src.controllers.pid_next_waypoint_car_controller import pid_next_waypoint_car_controller
+            controller = pid_next_waypoint_car_controller()
+        self.track_name = track_name
+        self.track = track if track is not None else track_geometry(track_name)
+        self.dt = dt
+        self.model = car_model(track=self.track, car_name=car_name, allow_off_track=allow_off_track,
+                               model=model, parameters=parameters, start_position=start_position,
+                               rng=random.Random(seed) if seed is not None else None)
+        self.model.car_state.static_info.car_id = 0
+        self.car = headless_car(self.model)
+        self.controller = controller
+        self.controller.car = self.car
+        self.batch = car_model_batch() if HEADLESS_BATCH_INTEGRATOR else None
+
+    def reset(self) -> None:
+        """ Puts the car back at the start, as the restart_car command of the server does. """
+        self.model.restart()
+        self.model.car_state.static_info.car_id = 0
+
+    def step(self, command: Optional[car_command] = None) -> None:
+        """
+        Advances the car by one time step.
+
+        :param command: the command to apply, None to ask the controller for it
+        """
+        if command is None:
+            command = self.controller.read()
+            if isinstance(command, tuple):  # (car_command, user_input) controllers
+                command = command[0]
+        self.model.car_state.command = command
+        if self.batch:
+            self.batch.update([self.model], self.dt)
+        else:
+            self.model.update(self.dt)
+        self.model.time += self.dt
+
+    def laps_completed(self) -> int:
+        """ :returns: number of laps completed; crossing the start line the first time starts the first lap """
+        return max(self.model.round_num - 1, 0)
+
+    def run(self, duration_s: float, max_laps: Optional[int] = None, reset: bool = True) -> trajectory:
+        """
+        Drives the car with the controller.
+
+        :param duration_s: simulated time to drive in seconds
+        :param max_laps: stop earlier when this many laps are completed, None to drive for duration_s
+        :param reset: True to start from the start line, False to continue from where the last run stopped
+        :returns: the trajectory of the run
+        """
+        if reset:
+            self.reset()
+        n_steps = int(round(duration_s / self.dt))
+        records = np.empty(n_steps, dtype=RECORD)
+        model_states = np.empty((n_steps, len(self.model.model_state)))
+        start_time = timer()
+        n = 0
+        while n < n_steps:
+            self.step()
+            records[n] = self.model.car_state.get_record_tuple()
+            model_states[n] = self.model.model_state
+            n += 1
+            if max_laps is not None and self.laps_completed() >= max_laps:
+                break
+        elapsed = timer() - start_time
+        results = self.model.car_state.time_results
+        lap_times = [t1 - t0 for t0, t1 in zip(results[:-1], results[1:])]
+        logger.info('simulated {} steps ({:.1f}s) on {} in {:.2f}s, {:.0f}x real time, {} laps'.format(
+            n, n * self.dt, self.track_name, elapsed, n * self.dt / elapsed if elapsed > 0 else float('inf'), len(lap_times)))
+        return trajectory(records[:n], model_states[:n], lap_times, self.info())
+
+    def info(self) -> Dict:
+        """ :returns: header information of a run, for the sidecar of a saved trajectory """
+        static_info = self.model.car_state.static_info
+        return OrderedDict([
+            ('format_version', VERSION),
+            ('creation_time', time.strftime('%I:%M%p %B %d %Y')),
+            ('creation_time_epoch_ms', int(time.time() * 1000.)),
+            ('username', getpass.getuser()),
+            ('track_name', self.track_name),
+            ('car_name', static_info.name),
+            ('length_m', static_info.length_m),
+            ('width_m', static_info.width_m),
+            ('note', 'headless'),
+            ('model', self.model.model.__name__),
+            ('parameters', self.model.parameters_func.__name__),
+            ('controller', type(self.controller).__name__),
+            ('dt', self.dt),
+        ])
+
+
+if __name__ == '__main__':
+    # drives some laps of a track with the default controller and prints the lap times
+    import argparse
+    parser = argparse.ArgumentParser(description='l2race headless simulator: drives laps with the PID waypoint controller.')
+    parser.add_argument('--track_name', type=str, default='track_1', help='name of the track')
+    parser.add_argument('--laps', type=int, default=3, help='number of laps to drive')
+    parser.add_argument('--duration', type=float, default=600, help='maximum simulated time in seconds')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the random start position')
+    parser.add_argument('--save', type=str, default=None, help='save the trajectory to this binary recording (.rec)')
+    args = parser.parse_args()
+    sim = headless_simulator(args.track_name, seed=args.seed)
+    traj = sim.run(args.duration, max_laps=args.laps)
+    for i, t in enumerate(traj.lap_times):
+        print('lap {}: {:.2f}s'.format(i + 1, t))
+    if args.save:
+        traj.save(args.save)
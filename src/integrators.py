@@ -0,0 +1,166 @@
+# fixed-step ODE integrators used to advance the car models
+# These avoid constructing a scipy OdeSolver/OdeResult on every model update; the work buffers are allocated once
+# and reused as long as the shape of the state does not change.
+# The state x can be a single model_state vector (n,) or a stack of model_states of several cars (N,n).
+from typing import Callable
+
+import numpy as np
+
+
+class fixed_step_integrator:
+    """
+    Base class of the fixed-step integrators. Subclasses implement step().
+    """
+    name = None
+    n_evals_per_step = 1  # number of evaluations of the right hand side for each (sub)step
+
+    def __init__(self, shape):
+        """
+        Makes a new integrator with preallocated work buffers.
+
+        :param shape: shape of the state that will be integrated, e.g. (n,) or (N,n)
+        """
+        self.shape = tuple(shape)
+        self.tmp = np.zeros(self.shape)
+        self.acc = np.zeros(self.shape)
+
+    def step(self, f: Callable[[np.ndarray], np.ndarray], x: np.ndarray, h: float) -> None:
+        """
+        Advances x in place by one step.
+
+        :param f: right hand side f(x) of dx/dt=f(x)
+        :param x: the state, modified in place
+        :param h: step size in seconds
+        """
+        raise NotImplementedError()
+
+    def integrate(self, f: Callable[[np.ndarray], np.ndarray], x: np.ndarray, dt: float, n_substeps: int = 1) -> int:
+        """
+        Advances x in place by dt using n_substeps equal steps.
+
+        :param f: right hand side f(x) of dx/dt=f(x)
+        :param x: the state, modified in place
+        :param dt: time advance in seconds
+        :param n_substeps: number of steps to split dt into
+        :returns: number of evaluations of f that were made
+        """
+        h = dt / n_substeps
+        for i in range(n_substeps):
+            self.step(f, x, h)
+        return n_substeps * self.n_evals_per_step
+
+
+class rk4_integrator(fixed_step_integrator):
+    """
+    Classical explicit 4th order Runge-Kutta.
+    """
+    name = 'rk4'
+    n_evals_per_step = 4
+
+    def step(self, f, x, h):
+        k = np.asarray(f(x))
+        np.copyto(self.acc, k)
+        np.multiply(k, 0.5 * h, out=self.tmp)
+        self.tmp += x
+        k = np.asarray(f(self.tmp))
+        self.acc += 2 * k
+        np.multiply(k, 0.5 * h, out=self.tmp)
+        self.tmp += x
+        k = np.asarray(f(self.tmp))
+        self.acc += 2 * k
+        np.multiply(k, h, out=self.tmp)
+        self.tmp += x
+        k = np.asarray(f(self.tmp))
+        self.acc += k
+        self.acc *= h / 6.
+        x += self.acc
+
+
+class heun_integrator(fixed_step_integrator):
+    """
+    Explicit 2nd order Heun method (trapezoidal predictor-corrector).
+    """
+    name = 'heun'
+    n_evals_per_step = 2
+
+    def step(self, f, x, h):
+        k = np.asarray(f(x))
+        np.copyto(self.acc, k)
+        np.multiply(k, h, out=self.tmp)
+        self.tmp += x
+        k = np.asarray(f(self.tmp))
+        self.acc += k
+        self.acc *= 0.5 * h
+        x += self.acc
+
+
+class semi_implicit_euler_integrator(fixed_step_integrator):
+    """
+    Linearly implicit (semi-implicit) Euler: x += h*(I-h*J)^-1*f(x), for stiff models such as MB.
+
+    The Jacobian J is estimated by forward differences once per integrate() call and reused for all its substeps,
+    which costs n extra evaluations for a state of length n. For a stack of states (N,n) the rows are assumed
+    independent, so the n perturbations are made for all rows at once.
+    """
+    name = 'semi_implicit_euler'
+    n_evals_per_step = 1
+    EPS = 1e-6  # relative perturbation for the finite difference Jacobian
+
+    def __init__(self, shape):
+        super(semi_implicit_euler_integrator, self).__init__(shape)
+        n = self.shape[-1]
+        self.x_stack = np.atleast_2d(np.zeros(self.shape))  # (N,n) views of the state
+        self.jac = np.zeros((self.x_stack.shape[0], n, n))
+        self.eye = np.eye(n)
+        self.lhs = np.zeros_like(self.jac)
+
+    def jacobian(self, f, x):
+        """ Estimates the Jacobian at x into self.jac and returns f(x) and the number of evaluations made."""
+        f0 = np.atleast_2d(np.asarray(f(x)))
+        x2 = np.atleast_2d(x)
+        n = self.shape[-1]
+        for j in range(n):
+            np.copyto(self.x_stack, x2)
+            dx = self.EPS * np.maximum(np.abs(x2[:, j]), 1.)
+            self.x_stack[:, j] += dx
+            fj = np.atleast_2d(np.asarray(f(self.x_stack.reshape(self.shape))))
+            self.jac[:, :, j] = (fj - f0) / dx[:, None]
+        return f0, n + 1
+
+    def step(self, f, x, h, f0=None):
+        if f0 is None:
+            f0 = np.atleast_2d(np.asarray(f(x)))
+        np.multiply(self.jac, -h, out=self.lhs)
+        self.lhs += self.eye
+        dx = np.linalg.solve(self.lhs, f0[:, :, None])[:, :, 0]
+        x += h * dx.reshape(self.shape)
+
+    def integrate(self, f, x, dt, n_substeps=1):
+        h = dt / n_substeps
+        f0, n_evals = self.jacobian(f, x)
+        for i in range(n_substeps):
+            self.step(f, x, h, f0=f0 if i == 0 else None)
+        return n_evals + n_substeps - 1
+
+
+# the available fixed-step integrators by name
+INTEGRATORS = {
+    rk4_integrator.name: rk4_integrator,
+    heun_integrator.name: heun_integrator,
+    semi_implicit_euler_integrator.name: semi_implicit_euler_integrator,
+}
+
+
+def make_integrator(name: str, shape) -> fixed_step_integrator:
+    """
+    Makes a fixed-step integrator by name.
+
+    :param name: one of the keys of INTEGRATORS, 'rk4', 'heun' or 'semi_implicit_euler'
+    :param shape: shape of the state that will be integrated
+    :returns: the integrator
+    :raises ValueError: if there is no integrator with this name
+    """
+    c = INTEGRATORS.get(name)
+    if c is None:
+        raise ValueError('unknown integrator {}, choices are {}'.format(name, list(INTEGRATORS.keys())))
+    return c(shape)
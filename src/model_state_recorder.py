@@ -0,0 +1,191 @@
+# records the ground truth model state of all cars on a track, run on server
+# Each model update of each car is appended as a MODEL_STATE_RECORD to a preallocated block of records. Full blocks are
+# handed to a background writer thread that appends them to a raw binary file, so the track loop never waits for the disk.
+# A JSON sidecar next to the file describes the record layout and the cars; load_model_state_recording() reads both.
+import json
+import os
+import threading
+import time
+from queue import Queue, Empty, Full
+from typing import List, Dict, Tuple, Optional
+
+import numpy as np
+
+from src.car_model import car_model
+from src.globals import DATA_FILENAME_BASE, DATA_FOLDER_NAME
+from src.l2race_utils import my_logger
+
+logger = my_logger(__name__)
+
+MODEL_STATE_RECORDING_VERSION = 1  # increment on any change of MODEL_STATE_RECORD
+MODEL_STATE_LEN = 29  # length of the MB model_state; the shorter KS and ST states are padded with NaN
+BLOCK_RECORDS = 4096  # records per preallocated block, about 7s of 6 cars at MODEL_UPDATE_RATE_HZ=100
+MAX_BLOCKS = 8  # blocks allocated at most; if the writer falls this far behind, records are dropped and counted
+
+MODEL_STATE_RECORD = np.dtype([
+    ('time', '<f8'),  # car_model.time after the update
+    ('car_id', '<u2'),
+    ('dt', '<f4'),  # time step of the update
+    ('model_state', '<f8', (MODEL_STATE_LEN,)),  # after the update
+    ('u', '<f8', (2,)),  # model input applied during the update: steering angle velocity, longitudinal acceleration
+    ('cmd_steering', '<f4'),
+    ('cmd_throttle', '<f4'),
+    ('cmd_brake', '<f4'),
+    ('cmd_reverse', 'u1'),
+    ('n_eval', '<u4'),  # evaluations of the model function
+    ('calculations_time', '<f4'),  # wall time of the update in seconds
+    ('too_slow', 'u1'),
+])
+
+
+class model_state_recorder:
+    """
+    Records the model_state, input and solver statistics of every car on one track at every model update.
+    """
+
+    def __init__(self, track_name: str, folder: str = DATA_FOLDER_NAME):
+        """
+        Opens a new recording <DATA_FILENAME_BASE>-model-state-<track_name>-<time>.bin with its .json sidecar
+        and starts the writer thread.
+
+        :param track_name: name of the track
+        :param folder: folder for the recording
+        :raises OSError: if the file cannot be opened
+        """
+        self.track_name = track_name
+        if not os.path.exists(folder):
+            logger.info('creating output folder {}'.format(folder))
+            os.makedirs(folder, exist_ok=True)
+        timestr = time.strftime("%Y%m%d-%H%M%S")
+        self.filename = os.path.join(folder, '{}-model-state-{}-{}.bin'.format(DATA_FILENAME_BASE, track_name, timestr))
+        self.file = open(self.filename, 'wb')
+        self.cars: Dict[int, Dict] = dict()  # sidecar information of each car_id that was recorded
+        self.num_records = 0
+        self.num_dropped = 0
+        self.num_blocks = 1
+        self.block = np.empty(BLOCK_RECORDS, dtype=MODEL_STATE_RECORD)
+        self.n = 0  # records in self.block
+        self.free_blocks: Queue = Queue()  # blocks that were written and can be filled again
+        self.full_blocks: Queue = Queue(maxsize=MAX_BLOCKS)  # (block, number of records) to write, None to stop the writer
+        self.writer = threading.Thread(target=self._write_blocks, name='model_state_recorder-{}'.format(track_name), daemon=True)
+        self.writer.start()
+        self._write_sidecar()
+        logger.info('recording model states of track {} to {}'.format(track_name, self.filename))
+
+    def record(self, models: List[car_model], dt: float) -> None:
+        """
+        Appends a record of each model, call it after the models were updated.
+
+        :param models: the car models
+        :param dt: the time step of the update in seconds
+        """
+        for m in models:
+            if self.block is None:
+                self.block = self._next_block()
+                if self.block is None:
+                    self.num_records += 1
+                    self.num_dropped += 1
+                    continue
+            car_id = m.car_state.static_info.car_id
+            if car_id not in self.cars:
+                self._add_car(car_id, m)
+            b = self.block
+            i = self.n
+            c = m.car_state.command
+            n_state = min(len(m.model_state), MODEL_STATE_LEN)
+            b['time'][i] = m.time
+            b['car_id'][i] = car_id
+            b['dt'][i] = dt
+            b['model_state'][i, :n_state] = m.model_state[:n_state]
+            b['model_state'][i, n_state:] = np.nan
+            b['u'][i] = m.u
+            b['cmd_steering'][i] = c.steering
+            b['cmd_throttle'][i] = c.throttle
+            b['cmd_brake'][i] = c.brake
+            b['cmd_reverse'][i] = c.reverse
+            b['n_eval'][i] = m.last_n_eval
+            b['calculations_time'][i] = m.last_calculations_time
+            b['too_slow'][i] = m.last_too_slow
+            self.n += 1
+            self.num_records += 1
+            if self.n == BLOCK_RECORDS:
+                self._hand_over_block()
+
+    def close(self) -> None:
+        """ Writes the rest of the records, stops the writer and closes the recording. """
+        if self.file is None:
+            return
+        if self.block is not None and self.n > 0:
+            self._hand_over_block()
+        self.full_blocks.put(None)
+        self.writer.join()
+        self.file.close()
+        self.file = None
+        self._write_sidecar()
+        logger.info('closed recording {} with {} records, dropped {}'.format(self.filename, self.num_records - self.num_dropped, self.num_dropped))
+
+    def _hand_over_block(self):
+        try:
+            self.full_blocks.put_nowait((self.block, self.n))
+        except Full:
+            self.num_dropped += self.n
+            logger.warning('model state writer of track {} is behind, dropped {} records'.format(self.track_name, self.n))
+            self.free_blocks.put(self.block)
+        self.block = None
+        self.n = 0
+
+    def _next_block(self) -> Optional[np.ndarray]:
+        try:
+            return self.free_blocks.get_nowait()
+        except Empty:
+            pass
+        if self.num_blocks < MAX_BLOCKS:
+            self.num_blocks += 1
+            return np.empty(BLOCK_RECORDS, dtype=MODEL_STATE_RECORD)
+        return None
+
+    def _write_blocks(self):
+        """ runs in the writer thread """
+        while True:
+            item = self.full_blocks.get()
+            if item is None:
+                break
+            (block, n) = item
+            try:
+                block[:n].tofile(self.file)
+            except OSError as e:
+                logger.error('could not write to recording {}: {}'.format(self.filename, e))
+            self.free_blocks.put(block)
+
+    def _add_car(self, car_id, m: car_model):
+        self.cars[car_id] = {'name': m.car_name(), 'model': m.model.__name__, 'parameters': m.parameters_func.__name__,
+                             'integrator': m.integrator_name, 'model_state_len': len(m.model_state)}
+        self._write_sidecar()
+
+    def _write_sidecar(self):
+        info = {'version': MODEL_STATE_RECORDING_VERSION, 'track_name': self.track_name,
+                'dtype': str(MODEL_STATE_RECORD.descr),  # for other tools, load_model_state_recording uses MODEL_STATE_RECORD
+                'cars': {str(k): v for k, v in self.cars.items()},
+                'num_records': self.num_records - self.num_dropped, 'num_dropped': self.num_dropped}
+        try:
+            with open(os.path.splitext(self.filename)[0] + '.json', 'w') as f:
+                json.dump(info, f, indent=1)
+        except OSError as e:
+            logger.warning('could not write sidecar of recording {}: {}'.format(self.filename, e))
+
+
+def load_model_state_recording(filename: str) -> Tuple[np.ndarray, Dict]:
+    """
+    Loads a recording made by model_state_recorder.
+
+    :param filename: the .bin file of the recording
+    :returns: (records, info) - records is an array of MODEL_STATE_RECORD (memory-mapped), info is the sidecar dict
+    :raises ValueError: if the recording has a different version
+    """
+    with open(os.path.splitext(filename)[0] + '.json', 'r') as f:
+        info = json.load(f)
+    if info.get('version') != MODEL_STATE_RECORDING_VERSION:
+        raise ValueError('{} has version {}, expected {}'.format(filename, info.get('version'), MODEL_STATE_RECORDING_VERSION))
+    if os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype=MODEL_STATE_RECORD), info
+    return np.memmap(filename, dtype=MODEL_STATE_RECORD, mode='r'), info
@@ -1,10 +1,12 @@
 # arguments for l2race client and server
 import os
+import multiprocessing as mp
 
 from src.globals import *
 import logging
 
-from src.track import list_tracks
+from src.track_geometry import list_tracks
+from src.recording import RECORDING_FORMATS
 
 logger = logging.getLogger(__name__)
 
@@ -23,11 +25,13 @@ def client_args(parser):
 
     clientOutputGroup = parser.add_argument_group('Output/Replay options:')
     clientOutputGroup.add_argument("--record", nargs='?',const='',  type=str, help="Record data to date-stamped filename with optional <note>, e.g. --record will write datestamped files named '{}-<track_name>-<car_name>-<note>-TTT.csv' in folder '{}, where note is optional note and TTT is a date/timestamp\'.".format(DATA_FILENAME_BASE, DATA_FOLDER_NAME))
-    clientOutputGroup.add_argument("--replay", nargs='?', const='last', type=str, help="Replay one or more CSV recordings. If 'last' or no file is supplied, play the most recent recording in the '{}' folder.".format(DATA_FOLDER_NAME))
+    clientOutputGroup.add_argument("--record_format", type=str, default='csv', choices=RECORDING_FORMATS, help="Format of recordings: 'csv' text, or 'bin' binary columnar rows (.rec) with a .json header sidecar, which load much faster for replay and modeling.")
+    clientOutputGroup.add_argument("--replay", nargs='*', type=str, help="Replay one or more CSV or binary recordings together, e.g. all the cars of a race. If 'last' or no file is supplied, play the most recent recording in the '{}' folder. Steer right to play faster, left to play backwards.".format(DATA_FOLDER_NAME))
 
     clientServerGroup.add_argument("--lidar", type=float, nargs='?', default=None, const=5.0,
                                    help="Draw the point at which car would hit the track edge if moving on a straight line. "
-                                        "The numerical value gives precision in pixels with which this point is found.")
+                                        "The point is found exactly by sphere tracing on the track distance transform; "
+                                        "the optional numerical value (formerly the precision in pixels) is ignored.")
 
     clientTrackCarMode = parser.add_argument_group('Track car/spectate options:')
     try:
@@ -55,6 +59,11 @@ def server_args(parser):
     serverGroup.add_argument("--allow_off_track", action='store_true', help="ignore when car goes off track (for testing car dynamics more easily)")
     serverGroup.add_argument('--log',type=str,default=str(logging.getLevelName(LOGGING_LEVEL)),help='Set logging level. From most to least verbose, choices are "DEBUG", "INFO", "WARNING".')
     serverGroup.add_argument("--port", type=int, default=SERVER_PORT, help="Server port address for initiating connections from clients.")
+    serverGroup.add_argument("--workers", type=int, default=mp.cpu_count(), help="Number of track worker processes, started with the server. Each worker runs several tracks in one loop, new tracks go to the least loaded worker.")
+    serverGroup.add_argument("--record_model_state", type=str, nargs='?', const=DATA_FOLDER_NAME, default=None, metavar='FOLDER', help="Record the full model_state, model input and solver statistics of every car at every model update to FOLDER (default '{}'). See src.model_state_recorder.".format(DATA_FOLDER_NAME))
+    serverGroup.add_argument("--lockstep", action='store_true', help="Deterministic lockstep mode: each tick advances the models by a fixed dt, and only once every car on the track sent its command for that tick. Runs depend on the commands and --seed, not on timing or network latency.")
+    serverGroup.add_argument("--seed", type=int, default=None, help="Seed of the random start positions of the cars on each track, for reproducible runs.")
+    serverGroup.add_argument("--preload_tracks", nargs='*', type=str, default=[], choices=list_tracks(), help="Tracks to start with the server, so the first clients do not wait for them to load. They keep running without clients.")
     # serverGroup.add_argument("--timeout_s", type=int, default=CLIENT_TIMEOUT_SEC, help="server timeout in seconds before it ends thread for handling a car model")
     # serverGroup.add_argument("--model", type=str, default=src.car_model.MODEL, help="server timeout in seconds before it ends thread for handling a car model")
 
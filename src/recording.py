@@ -0,0 +1,148 @@
+# formats of the car recordings written by data_recorder, and loading them for replay and modeling
+# A recording is either a CSV file with # comment header lines, or a binary columnar recording: a raw file of RECORD rows
+# (suffix BINARY_SUFFIX) plus a JSON sidecar with the header information. The binary rows are loaded as a read-only
+# memory map, so even long recordings load without parsing. This module does not need pygame.
+import json
+import os
+import re
+import glob
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from src.globals import DATA_FOLDER_NAME
+from src.l2race_utils import my_logger
+
+logger = my_logger(__name__)
+
+RECORDING_FORMATS = ('csv', 'bin')  # choices of the --record_format client argument
+CSV_SUFFIX = '.csv'
+BINARY_SUFFIX = '.rec'  # rows of RECORD
+SIDECAR_SUFFIX = '.json'  # header information of a binary recording, next to it
+BINARY_RECORDING_VERSION = 1  # increment on any change of RECORD
+WRITE_CHUNK_RECORDS = 256  # the recording writer thread formats and writes up to this many samples at a time
+
+# one row of a recording; the field names are the CSV column names, see car_state.get_record_headers()
+RECORD = np.dtype([
+    ('time', '<f8'),
+    ('cmd.auto', 'u1'),
+    ('cmd.steering', '<f8'),
+    ('cmd.throttle', '<f8'),
+    ('cmd.brake', '<f8'),
+    ('cmd.reverse', 'u1'),
+    ('pos.x', '<f8'),
+    ('pos.y', '<f8'),
+    ('vel.x', '<f8'),
+    ('vel.y', '<f8'),
+    ('speed', '<f8'),
+    ('accel.x', '<f8'),
+    ('accel.y', '<f8'),
+    ('steering_angle', '<f8'),
+    ('body_angle', '<f8'),
+    ('yaw_rate', '<f8'),
+    ('drift_angle', '<f8'),
+])
+
+
+def recording_suffix(record_format: str) -> str:
+    """
+    :param record_format: one of RECORDING_FORMATS
+    :returns: the file suffix of recordings in this format
+    """
+    if record_format == 'csv':
+        return CSV_SUFFIX
+    elif record_format == 'bin':
+        return BINARY_SUFFIX
+    raise ValueError('unknown recording format {}, choices are {}'.format(record_format, RECORDING_FORMATS))
+
+
+def list_recordings(folder: str = DATA_FOLDER_NAME) -> List[str]:
+    """
+    :param folder: folder to look in
+    :returns: paths of the CSV and binary recordings in folder
+    """
+    return glob.glob(os.path.join(folder, '*' + CSV_SUFFIX)) + glob.glob(os.path.join(folder, '*' + BINARY_SUFFIX))
+
+
+def write_sidecar(filename: str, info: Dict) -> None:
+    """
+    Writes the header information of a binary recording to its sidecar.
+
+    :param filename: the binary recording
+    :param info: the header information, see data_recorder
+    """
+    info = dict(info)
+    info['version'] = BINARY_RECORDING_VERSION
+    info['fields'] = list(RECORD.names)
+    with open(os.path.splitext(filename)[0] + SIDECAR_SUFFIX, 'w') as f:
+        json.dump(info, f, indent=1)
+
+
+def _read_csv_header(filename) -> Dict:
+    """ parses the # key="value" comment lines at the start of a CSV recording """
+    info = dict()
+    with open(filename, 'r') as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            m = re.match(r'#\s*([\w ]+?)\s*(?:="(.*)"(.*)|:\s*(.*))$', line.rstrip('\n'))
+            if m is None:
+                continue
+            key = m.group(1).strip().lower().replace(' ', '_')
+            if m.group(2) is not None:
+                if 'epoch ms' in m.group(3):
+                    key += '_epoch_ms'
+                info[key] = m.group(2)
+            else:
+                info[key] = m.group(4)
+    for k in ('length_m', 'width_m'):
+        if k in info:
+            info[k] = float(info[k])
+    return info
+
+
+def load_recording(filename: str) -> Tuple[np.ndarray, Dict]:
+    """
+    Loads a CSV or binary recording.
+
+    :param filename: path of the recording
+    :returns: (data, info) - data is a structured array with the CSV column names as fields,
+        memory-mapped for a binary recording; info is the header information, with at least track_name and car_name
+    :raises OSError: if the recording cannot be read
+    :raises ValueError: if it is a binary recording of another version
+    """
+    if filename.endswith(BINARY_SUFFIX):
+        with open(os.path.splitext(filename)[0] + SIDECAR_SUFFIX, 'r') as f:
+            info = json.load(f)
+        if info.get('version') != BINARY_RECORDING_VERSION:
+            raise ValueError('{} has version {}, expected {}'.format(filename, info.get('version'), BINARY_RECORDING_VERSION))
+        n = os.path.getsize(filename) // RECORD.itemsize  # ignores a partly written last row
+        if n == 0:
+            return np.zeros(0, dtype=RECORD), info
+        return np.memmap(filename, dtype=RECORD, mode='r', shape=(n,)), info
+    import pandas as pd
+    info = _read_csv_header(filename)
+    data = pd.read_csv(filename, comment='#').to_records(index=False)  # skip comment lines starting with #
+    return data, info
+
+
+def recording_columns(data: np.ndarray, names: List[str]) -> np.ndarray:
+    """
+    :param data: data of load_recording()
+    :param names: column names
+    :returns: the columns as a 2-D float array, one column per name
+    """
+    if len(names) == 0:
+        return np.zeros((len(data), 0))
+    return np.stack([np.asarray(data[n], dtype=float) for n in names], axis=1)
+
+
+def drop_duplicate_times(data: np.ndarray) -> np.ndarray:
+    """
+    :param data: data of load_recording()
+    :returns: data without the rows that repeat the time of an earlier row
+    """
+    _, idx = np.unique(data['time'], return_index=True)
+    if len(idx) == len(data):
+        return data
+    return data[np.sort(idx)]
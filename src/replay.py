@@ -0,0 +1,151 @@
+# replay engine for one or more car recordings
+# The recordings are loaded once into float arrays, one row per sample, with their times on a common time line.
+# Finding the samples around any time is a binary search (np.searchsorted), and the state in between is linearly
+# interpolated, so playback can run at any rate, forwards or backwards, and jump to any time. This module does not need pygame.
+import os
+from typing import List, Optional, Dict
+
+import numpy as np
+
+from src.globals import DATA_FOLDER_NAME
+from src.l2race_utils import my_logger
+from src.recording import load_recording, list_recordings, recording_columns, drop_duplicate_times, RECORD, \
+    CSV_SUFFIX, BINARY_SUFFIX
+
+logger = my_logger(__name__)
+
+REPLAY_FIELDS = [f for f in RECORD.names if f != 'time']  # columns of the sampled rows
+STEP_FIELDS = ('cmd.auto', 'cmd.reverse')  # flags, these take the value of the sample before instead of being interpolated
+FIELD_INDEX: Dict[str, int] = {f: i for i, f in enumerate(REPLAY_FIELDS)}  # column of each field in the sampled rows
+
+
+def find_recording(filename: str) -> Optional[str]:
+    """
+    Finds a recording by filename, with or without suffix (.csv is assumed), as given or in DATA_FOLDER_NAME.
+    'last' finds the newest recording in DATA_FOLDER_NAME.
+
+    :param filename: the filename
+    :returns: the path of the recording, or None if there is none
+    """
+    if filename == 'last':
+        recordings = list_recordings(DATA_FOLDER_NAME)
+        if not recordings:
+            return None
+        return max(recordings, key=os.path.getctime)
+    if not (filename.endswith(CSV_SUFFIX) or filename.endswith(BINARY_SUFFIX)):
+        filename = filename + CSV_SUFFIX
+    if os.path.isfile(filename):
+        return filename
+    if os.sep not in filename:
+        file_path = os.path.join(DATA_FOLDER_NAME, filename)
+        if os.path.isfile(file_path):
+            return file_path
+    return None
+
+
+class replay_recording:
+    """
+    The samples of one recording, ready for sampling at any time.
+    """
+
+    def __init__(self, filename: str):
+        """
+        Loads a recording.
+
+        :param filename: path of the recording
+        :raises OSError: if it cannot be read
+        :raises ValueError: if it has no samples or is of an unknown version
+        """
+        data, info = load_recording(filename)
+        data = drop_duplicate_times(data)
+        if len(data) == 0:
+            raise ValueError('recording {} has no samples'.format(filename))
+        self.filename = filename
+        self.info = info
+        self.car_name: str = info.get('car_name', os.path.basename(filename))
+        self.track_name: str = info.get('track_name')
+        t = np.asarray(data['time'], dtype=float)
+        order = np.argsort(t, kind='stable')
+        self.car_time = t[order]  # time on the car's clock
+        self.values = recording_columns(data[order], REPLAY_FIELDS)  # (n, len(REPLAY_FIELDS))
+        self.step_columns = [FIELD_INDEX[f] for f in STEP_FIELDS]
+        # Cars start their clocks when they join the server, so car times of different cars are not comparable.
+        # The recording is created when its first sample arrives, which places it on the wall clock.
+        epoch_ms = info.get('creation_time_epoch_ms')
+        start = float(epoch_ms) / 1000. if epoch_ms is not None else 0.
+        self.t = self.car_time - self.car_time[0] + start  # times on the common time line
+
+    def __len__(self):
+        return len(self.t)
+
+    def index(self, t: float) -> int:
+        """
+        :param t: time on the common time line
+        :returns: index of the last sample at or before t, -1 if t is before the first sample
+        """
+        return int(np.searchsorted(self.t, t, side='right')) - 1
+
+    def sample(self, t: float) -> Optional[np.ndarray]:
+        """
+        :param t: time on the common time line
+        :returns: the row of REPLAY_FIELDS at t, linearly interpolated between the samples around t,
+            or None if t is outside of the recording
+        """
+        i = self.index(t)
+        if i < 0 or t > self.t[-1]:
+            return None
+        if i == len(self.t) - 1:
+            return self.values[i].copy()
+        t0 = self.t[i]
+        t1 = self.t[i + 1]
+        frac = (t - t0) / (t1 - t0)
+        row = self.values[i] + frac * (self.values[i + 1] - self.values[i])
+        row[self.step_columns] = self.values[i, self.step_columns]
+        return row
+
+    def car_time_at(self, t: float) -> float:
+        """ :returns: the time on the car's clock at time t of the common time line """
+        return t - self.t[0] + self.car_time[0]
+
+
+class replay_engine:
+    """
+    Plays back several recordings together on a common time line.
+    """
+
+    def __init__(self, filenames: List[str]):
+        """
+        Loads the recordings.
+
+        :param filenames: paths of the recordings
+        :raises OSError: if one cannot be read
+        :raises ValueError: if one has no samples, or there are none
+        """
+        if not filenames:
+            raise ValueError('no recordings to replay')
+        self.recordings = [replay_recording(f) for f in filenames]
+        self.track_name = self.recordings[0].track_name
+        for r in self.recordings[1:]:
+            if r.track_name != self.track_name:
+                logger.warning('recording {} is of track {}, not {}; it is drawn on {}'.format(
+                    r.filename, r.track_name, self.track_name, self.track_name))
+        self.t_start = min(r.t[0] for r in self.recordings)
+        self.t_end = max(r.t[-1] for r in self.recordings)
+        logger.info('loaded {} recordings with {} samples spanning {:.1f}s'.format(
+            len(self.recordings), sum(len(r) for r in self.recordings), self.duration))
+
+    @property
+    def duration(self) -> float:
+        """ :returns: length of the common time line in seconds """
+        return self.t_end - self.t_start
+
+    def clamp(self, t: float) -> float:
+        """ :returns: t limited to the common time line """
+        return min(max(t, self.t_start), self.t_end)
+
+    def sample(self, t: float) -> List[Optional[np.ndarray]]:
+        """
+        :param t: time on the common time line
+        :returns: for each recording, its row of REPLAY_FIELDS at t, or None if t is outside of that recording
+        """
+        return [r.sample(t) for r in self.recordings]
@@ -0,0 +1,184 @@
+# parallel evaluation of controllers on many tracks and start positions with the headless simulator
+# The episodes of a sweep are fanned out over a concurrent.futures process pool. Each worker process loads the
+# track_geometry of every track of the sweep once, in its initializer (the track assets are memory-mapped, so the
+# workers share their pages), and then runs episodes with headless_simulator. The result of each episode is sent back
+# as a small dict as soon as it is done, and the summary table of each track and controller is printed at the end.
+import argparse
+import importlib
+import os
+import random
+import time
+from math import radians, degrees
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Iterator
+
+import numpy as np
+
+from src.car_model import car_model, IXPOS, IYPOS, IYAW
+from src.headless_simulator import headless_simulator, HEADLESS_DT_S
+from src.l2race_utils import my_logger
+from src.track_geometry import track_geometry, list_tracks
+
+logger = my_logger(__name__)
+
+# controllers that can be evaluated, by name: module and class, constructed without a car
+CONTROLLERS = {
+    'pid': ('src.controllers.pid_next_waypoint_car_controller', 'pid_next_waypoint_car_controller'),
+    'pure_pursuit': ('src.controllers.pure_pursuit_controller', 'pure_pursuit_controller'),
+}
+START_POSITIONS = (1, 2)  # the start positions of car_model.choose_initial_position
+ROLLOUT_DURATION_S = 120.  # simulated time of an episode, unless it completes its laps before
+ROLLOUT_LAPS = 2  # laps of an episode
+START_JITTER_M = 0.5  # episodes after the first start up to this far from the start position, in x and in y
+START_JITTER_DEG = 5.0  # and with up to this heading error, so repeated episodes of a deterministic controller differ
+OFF_TRACK_SURFACE = 12  # surface types up to this are off the track: water and sand with its boundary lines, see track_geometry.get_surface_type
+
+_worker_tracks: Dict[str, track_geometry] = dict()  # the tracks of this worker process, loaded by _init_worker
+
+
+def make_controller(name: str):
+    """
+    :param name: a key of CONTROLLERS
+    :returns: a new controller
+    """
+    module_name, class_name = CONTROLLERS[name]
+    return getattr(importlib.import_module(module_name), class_name)()
+
+
+def _init_worker(track_names: List[str]) -> None:
+    """ runs once in each worker process, loads the tracks so episodes do not load them again """
+    for name in track_names:
+        _worker_tracks[name] = track_geometry(name)
+
+
+def jitter_start(model: car_model, rng: random.Random) -> None:
+    """
+    Moves a car standing at its start position by a random offset of up to START_JITTER_M and START_JITTER_DEG.
+
+    :param model: the car, just restarted
+    :param rng: random generator of the offset
+    """
+    model.model_state[IXPOS] += rng.uniform(-START_JITTER_M, START_JITTER_M)
+    model.model_state[IYPOS] += rng.uniform(-START_JITTER_M, START_JITTER_M)
+    model.model_state[IYAW] += radians(rng.uniform(-START_JITTER_DEG, START_JITTER_DEG))
+    model.car_state.position_m.x = model.model_state[IXPOS]
+    model.car_state.position_m.y = model.model_state[IYPOS]
+    model.car_state.body_angle_deg = degrees(model.model_state[IYAW])
+
+
+def run_episode(track_name: str, controller_name: str, start_position: int, episode: int,
+                duration_s: float = ROLLOUT_DURATION_S, laps: int = ROLLOUT_LAPS, dt: float = HEADLESS_DT_S) -> Dict:
+    """
+    Runs one episode; called in the worker processes.
+
+    :param track_name: name of the track
+    :param controller_name: a key of CONTROLLERS
+    :param start_position: 1 or 2
+    :param episode: number of the episode; episode 0 starts exactly at the start position, the others with the
+        jitter_start offset seeded by the episode, which is the same for every track and controller
+    :param duration_s: maximum simulated time in seconds
+    :param laps: the episode ends after this many laps
+    :param dt: time step in seconds
+    :returns: dict with the episode parameters, lap_times, off_track (number of times the car left the track),
+        steps, sim_time, cpu_time and the pid of the worker
+    """
+    cpu_start = time.process_time()
+    track = _worker_tracks.get(track_name)
+    if track is None:
+        track = _worker_tracks[track_name] = track_geometry(track_name)
+    sim = headless_simulator(track_name, controller=make_controller(controller_name), dt=dt, track=track,
+                             start_position=start_position, seed=episode)
+    sim.reset()
+    if episode > 0:
+        jitter_start(sim.model, random.Random(episode))
+    traj = sim.run(duration_s, max_laps=laps, reset=False)
+    _, _, _, surface = track.query_batch(traj.records['pos.x'], traj.records['pos.y'])
+    off = surface <= OFF_TRACK_SURFACE
+    off_track = int(np.count_nonzero(off[1:] & ~off[:-1]) + (1 if len(off) > 0 and off[0] else 0))
+    return {'track_name': track_name, 'controller': controller_name, 'start_position': start_position,
+            'episode': episode, 'lap_times': traj.lap_times, 'off_track': off_track, 'steps': len(traj),
+            'sim_time': len(traj) * dt, 'cpu_time': time.process_time() - cpu_start, 'pid': os.getpid()}
+
+
+def run_sweep(track_names: List[str], controller_names: List[str], start_positions=START_POSITIONS,
+              episodes: int = 1, workers: Optional[int] = None, **episode_kwargs) -> Iterator[Dict]:
+    """
+    Runs every combination of track, controller, start position and episode in a process pool.
+
+    :param track_names: the tracks
+    :param controller_names: keys of CONTROLLERS
+    :param start_positions: start positions of each track
+    :param episodes: episodes of each combination
+    :param workers: number of worker processes, None for one per core
+    :param episode_kwargs: duration_s, laps and dt for run_episode
+    :returns: an iterator over the results of run_episode, in the order the episodes finish
+    """
+    tasks = [(t, c, p, e) for t in track_names for c in controller_names for p in start_positions for e in range(episodes)]
+    logger.info('running {} episodes on {} tracks with {} workers'.format(len(tasks), len(track_names), workers or os.cpu_count()))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(track_names,)) as pool:
+        futures = {pool.submit(run_episode, *task, **episode_kwargs): task for task in tasks}
+        for f in as_completed(futures):
+            try:
+                yield f.result()
+            except Exception as e:
+                logger.warning('episode {} failed: {}'.format(futures[f], e))
+
+
+def summarize(results: List[Dict]) -> List[Dict]:
+    """
+    :param results: results of run_episode
+    :returns: one row per track and controller: episodes, laps, best_lap, mean_lap, off_track, cpu_time and sim_time
+    """
+    rows: Dict = dict()
+    for r in results:
+        row = rows.setdefault((r['track_name'], r['controller']), {
+            'track_name': r['track_name'], 'controller': r['controller'], 'episodes': 0, 'lap_times': [],
+            'off_track': 0, 'cpu_time': 0., 'sim_time': 0.})
+        row['episodes'] += 1
+        row['lap_times'] += r['lap_times']
+        row['off_track'] += r['off_track']
+        row['cpu_time'] += r['cpu_time']
+        row['sim_time'] += r['sim_time']
+    summary = []
+    for key in sorted(rows):
+        row = rows[key]
+        laps = row.pop('lap_times')
+        row['laps'] = len(laps)
+        row['best_lap'] = min(laps) if laps else float('nan')
+        row['mean_lap'] = float(np.mean(laps)) if laps else float('nan')
+        summary.append(row)
+    return summary
+
+
+def format_summary(summary: List[Dict]) -> str:
+    """ :returns: the rows of summarize() as a text table """
+    lines = ['{:<16} {:<14} {:>8} {:>5} {:>9} {:>9} {:>9} {:>9} {:>8}'.format(
+        'track', 'controller', 'episodes', 'laps', 'best_lap', 'mean_lap', 'off_track', 'cpu_s', 'speedup')]
+    for r in summary:
+        lines.append('{:<16} {:<14} {:>8} {:>5} {:>9.2f} {:>9.2f} {:>9} {:>9.1f} {:>7.0f}x'.format(
+            r['track_name'], r['controller'], r['episodes'], r['laps'], r['best_lap'], r['mean_lap'], r['off_track'],
+            r['cpu_time'], r['sim_time'] / r['cpu_time'] if r['cpu_time'] > 0 else float('inf')))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='l2race rollout runner: evaluates controllers on tracks in parallel with the headless simulator.')
+    parser.add_argument('--tracks', type=str, nargs='+', default=list_tracks(), choices=list_tracks(), help='tracks to drive, default all')
+    parser.add_argument('--controllers', type=str, nargs='+', default=list(CONTROLLERS), choices=list(CONTROLLERS), help='controllers to evaluate, default all')
+    parser.add_argument('--start_positions', type=int, nargs='+', default=list(START_POSITIONS), choices=START_POSITIONS, help='start positions of each track')
+    parser.add_argument('--episodes', type=int, default=1, help='episodes of each track, controller and start position; episodes after the first start with a small random offset, see START_JITTER_M')
+    parser.add_argument('--laps', type=int, default=ROLLOUT_LAPS, help='laps of each episode')
+    parser.add_argument('--duration', type=float, default=ROLLOUT_DURATION_S, help='maximum simulated time of each episode in seconds')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, default one per core')
+    args = parser.parse_args()
+
+    wall_start = time.time()
+    results = []
+    for r in run_sweep(args.tracks, args.controllers, args.start_positions, args.episodes, args.workers,
+                       duration_s=args.duration, laps=args.laps):
+        results.append(r)
+        print('{} {} start {} episode {}: laps {} off track {} cpu {:.1f}s'.format(
+            r['track_name'], r['controller'], r['start_position'], r['episode'],
+            ' '.join('{:.2f}'.format(t) for t in r['lap_times']) or '-', r['off_track'], r['cpu_time']), flush=True)
+    print(format_summary(summarize(results)))
+    print('{} episodes in {:.1f}s'.format(len(results), time.time() - wall_start))
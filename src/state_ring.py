@@ -0,0 +1,225 @@
+# shared-memory ring buffer of the car states of a track
+# Each track on the server writes the packed states of its cars (protocol.STATE_RECORD) and the statistics of each tick
+# into a file-backed np.memmap in STATE_RING_FOLDER (tmpfs /dev/shm when it exists, so the pages never hit the disk).
+# The rings of a server are in a subfolder named by its server port, so several servers on one host do not share them.
+# Any process on the server host (the main server, monitoring tools, recorders) can open the ring of a track with
+# state_ring_reader and read the latest tick without any message to the track and without slowing its loop.
+# Each slot is guarded by a seqlock: the writer makes the slot seq odd while it writes and even when done, and a reader
+# that sees an odd or changed seq retries. There is one writer per ring and any number of readers.
+import os
+import tempfile
+from typing import List, Optional
+
+import numpy as np
+
+from src.car_state import car_state
+from src.globals import MAX_CARS_PER_TRACK, SERVER_PORT
+from src.l2race_utils import my_logger
+from src.protocol import STATE_RECORD, car_states_to_records
+
+logger = my_logger(__name__)
+
+STATE_RING_FOLDER = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'l2race')  # holds <server_port>/<track_name>.ring
+STATE_RING_SLOTS = 256  # number of ticks kept, 2.56s at MODEL_UPDATE_RATE_HZ=100
+STATE_RING_MAGIC = b'L2RR'
+STATE_RING_VERSION = 1  # increment on any change of the layouts below
+READ_RETRIES = 100  # number of times a reader retries a slot that is being written
+
+RING_HEADER = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('n_slots', '<u4'),
+    ('max_cars', '<u4'),
+    ('pid', '<u4'),  # of the writer
+    ('latest_tick', '<i8'),  # tick of the newest complete slot, -1 before the first
+])
+
+RING_SLOT = np.dtype([
+    ('seq', '<u8'),  # seqlock, 2*tick+1 while the slot is written, 2*tick+2 when it is complete
+    ('tick', '<u8'),
+    ('time', '<f8'),  # timer() of the writer at the tick
+    ('dt', '<f4'),  # simulated time step of the tick in seconds
+    ('tick_duration', '<f4'),  # real time taken to update the cars in seconds
+    ('n_clients', '<u2'),  # cars and spectators
+    ('n_cars', '<u2'),  # number of valid entries in cars
+    ('cars', STATE_RECORD, (MAX_CARS_PER_TRACK,)),
+])
+
+
+def state_ring_path(track_name: str, server_port: int = SERVER_PORT, folder: str = STATE_RING_FOLDER) -> str:
+    """
+    :param track_name: name of track, e.g. track_1
+    :param server_port: the port of the server that runs the track, see server --port
+    :param folder: folder of the rings
+    :returns: the file of the ring of the track
+    """
+    return os.path.join(folder, str(server_port), track_name + '.ring')
+
+
+def list_state_rings(server_port: int = SERVER_PORT, folder: str = STATE_RING_FOLDER) -> List[str]:
+    """
+    :param server_port: the port of the server
+    :param folder: folder of the rings
+    :returns: names of the tracks of the server that have a ring, i.e. are running or did not clean up
+    """
+    folder = os.path.dirname(state_ring_path('', server_port, folder))
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(folder) if f.endswith('.ring'))
+
+
+class state_ring_writer:
+    """
+    Writes the ticks of one track to its ring; used by the track on server.
+    """
+
+    def __init__(self, track_name: str, server_port: int = SERVER_PORT, n_slots: int = STATE_RING_SLOTS,
+                 folder: str = STATE_RING_FOLDER):
+        """
+        Makes the ring file of the track, replacing an old one of the same server.
+
+        :param track_name: name of track
+        :param server_port: the port of our server; it is bound by the server, so no other server uses the same rings
+        :param n_slots: number of ticks kept
+        :param folder: folder of the rings
+        """
+        self.fn = state_ring_path(track_name, server_port, folder)
+        os.makedirs(os.path.dirname(self.fn), exist_ok=True)
+        size = RING_HEADER.itemsize + n_slots * RING_SLOT.itemsize
+        tmp = '{}.{}.tmp'.format(self.fn, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.truncate(size)
+        self.header = np.memmap(tmp, dtype=RING_HEADER, mode='r+', offset=0, shape=(1,))
+        self.slots = np.memmap(tmp, dtype=RING_SLOT, mode='r+', offset=RING_HEADER.itemsize, shape=(n_slots,))
+        self.header[0] = (STATE_RING_MAGIC, STATE_RING_VERSION, n_slots, MAX_CARS_PER_TRACK, os.getpid(), -1)
+        os.replace(tmp, self.fn)  # readers never see a ring without header
+        self.n_slots = n_slots
+        self.tick = -1
+
+    def write(self, states: List[car_state], time: float, dt: float, tick_duration: float, n_clients: int,
+              records: Optional[np.ndarray] = None) -> None:
+        """
+        Writes the next tick.
+
+        :param states: the car states, each with static_info.car_id set; only the first MAX_CARS_PER_TRACK are kept
+        :param time: timer() at the tick
+        :param dt: simulated time step in seconds
+        :param tick_duration: real time taken by the tick in seconds
+        :param n_clients: number of cars and spectators
+        :param records: the states already packed by protocol.car_states_to_records, to not pack them again
+        """
+        if records is None:
+            records = car_states_to_records(states)
+        n = min(len(records), MAX_CARS_PER_TRACK)
+        self.tick += 1
+        i = self.tick % self.n_slots
+        slots = self.slots
+        slots['seq'][i] = 2 * self.tick + 1
+        slots['tick'][i] = self.tick
+        slots['time'][i] = time
+        slots['dt'][i] = dt
+        slots['tick_duration'][i] = tick_duration
+        slots['n_clients'][i] = n_clients
+        slots['n_cars'][i] = n
+        slots['cars'][i, :n] = records[:n]
+        slots['seq'][i] = 2 * self.tick + 2
+        self.header['latest_tick'][0] = self.tick
+
+    def close(self) -> None:
+        """ Removes the ring file unless another writer replaced it since; readers that have it open keep their mapping. """
+        self.header = None
+        self.slots = None
+        try:
+            if int(np.fromfile(self.fn, dtype=RING_HEADER, count=1)[0]['pid']) == os.getpid():
+                os.remove(self.fn)
+        except (OSError, IndexError):
+            pass
+
+
+class state_ring_reader:
+    """
+    Reads the ring of one track, from any process on the server host.
+    """
+
+    def __init__(self, track_name: str, server_port: int = SERVER_PORT, folder: str = STATE_RING_FOLDER):
+        """
+        Opens the ring of a track read only.
+
+        :param track_name: name of track
+        :param server_port: the port of the server that runs the track
+        :param folder: folder of the rings
+        :raises FileNotFoundError: if the track has no ring
+        :raises ValueError: if the ring has a different layout
+        """
+        self.fn = state_ring_path(track_name, server_port, folder)
+        self.header = np.memmap(self.fn, dtype=RING_HEADER, mode='r', offset=0, shape=(1,))
+        h = self.header[0]
+        if h['magic'] != STATE_RING_MAGIC or h['version'] != STATE_RING_VERSION or h['max_cars'] != MAX_CARS_PER_TRACK:
+            raise ValueError('{} is not a state ring of version {} with {} cars'.format(self.fn, STATE_RING_VERSION, MAX_CARS_PER_TRACK))
+        self.n_slots = int(h['n_slots'])
+        self.slots = np.memmap(self.fn, dtype=RING_SLOT, mode='r', offset=RING_HEADER.itemsize, shape=(self.n_slots,))
+
+    @property
+    def latest_tick(self) -> int:
+        """ :returns: the newest complete tick, -1 if there is none yet """
+        return int(self.header['latest_tick'][0])
+
+    def read(self, tick: int) -> Optional[np.void]:
+        """
+        Copies a tick out of the ring.
+
+        :param tick: the tick to read
+        :returns: the RING_SLOT of the tick, or None if it was overwritten or not written yet.
+            The valid states are slot['cars'][:slot['n_cars']]
+        """
+        if tick < 0:
+            return None
+        i = tick % self.n_slots
+        seqs = self.slots['seq']
+        complete = 2 * tick + 2
+        for _ in range(READ_RETRIES):
+            seq = int(seqs[i])
+            if seq != complete:
+                if seq > complete:
+                    return None  # overwritten by a newer tick
+                continue  # being written
+            copy = np.array(self.slots[i:i + 1])[0]
+            if int(seqs[i]) == seq:
+                return copy
+        return None
+
+    def read_latest(self) -> Optional[np.void]:
+        """
+        :returns: the RING_SLOT of the newest tick, or None if there is none yet
+        """
+        for i in range(READ_RETRIES):
+            tick = self.latest_tick
+            if tick < 0:
+                return None
+            slot = self.read(tick)
+            if slot is not None:
+                return slot
+        return None
+
+
+if __name__ == '__main__':
+    # prints the latest tick of all running tracks of a server
+    import argparse
+    parser = argparse.ArgumentParser(description='prints the latest tick of all running tracks of a server on this host')
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help='port of the server')
+    args = parser.parse_args()
+    for name in list_state_rings(args.port):
+        try:
+            r = state_ring_reader(name, args.port)
+        except (OSError, ValueError) as e:
+            print('{}: {}'.format(name, e))
+            continue
+        s = r.read_latest()
+        if s is None:
+            print('{}: no tick yet'.format(name))
+            continue
+        print('{}: tick {} dt={:.1f}ms tick_duration={:.2f}ms clients={} cars={}'.format(
+            name, s['tick'], s['dt'] * 1000, s['tick_duration'] * 1000, s['n_clients'], s['n_cars']))
+        for c in s['cars'][:s['n_cars']]:
+            print('    car {} pos=({:.1f},{:.1f})m speed={:.1f}m/s laps={}'.format(
+                c['car_id'], c['pos_x'], c['pos_y'], c['speed'], c['lap_count']))
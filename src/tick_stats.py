@@ -0,0 +1,193 @@
+# per-tick timing statistics of a track on the server
+# Each track keeps a preallocated ring of TICK_STATS rows, one per tick: the time its models took to integrate, the
+# model function evaluations, the track queries, the time spent receiving and handling client messages and encoding
+# and sending states since the tick before, and the slack the worker slept. Filling a row costs a few float stores, so
+# it is always on. A local client can ask a track for a summary with the 'get_stats' message (see query_tick_stats) and
+# have it dump the ring to a .npy file, to see where the tick budget of 1/MODEL_UPDATE_RATE_HZ goes under load.
+import json
+import os
+import socket
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from src.globals import DATA_FOLDER_NAME, DATA_FILENAME_BASE
+from src.l2race_utils import my_logger
+from src.protocol import encode_message, decode_message, split_message, reassembler, RECV_BUFFER_BYTES
+
+logger = my_logger(__name__)
+
+TICK_STATS_SLOTS = 6000  # ticks kept, 60s at MODEL_UPDATE_RATE_HZ=100
+LOCAL_HOSTS = ('127.0.0.1', '::1', 'localhost')  # only clients on these addresses may ask for the stats
+
+TICK_STATS = np.dtype([
+    ('tick', '<u8'),
+    ('time', '<f8'),  # timer() at the start of the tick
+    ('dt', '<f4'),  # simulated time step in seconds
+    ('n_cars', '<u2'),
+    ('update_time', '<f4'),  # wall time of the model update of all cars, including track constraints, in seconds
+    ('integrate_time', '<f4'),  # sum over the cars of their integration time, car_model.last_calculations_time
+    ('integrate_time_max', '<f4'),  # integration time of the slowest car
+    ('n_eval', '<u4'),  # model function evaluations of all cars, car_model.last_n_eval
+    ('track_queries', '<u4'),  # track_geometry queries since the tick before, see track_geometry.query_count
+    ('n_msgs', '<u4'),  # client messages received since the tick before
+    ('receive_time', '<f4'),  # time receiving and handling them
+    ('send_time', '<f4'),  # time encoding and sending states since the tick before
+    ('tick_time', '<f4'),  # wall time of the whole tick, including recording and the state ring
+    ('slack', '<f4'),  # time the worker waited for messages or the next tick since the tick before
+])
+
+
+class tick_stats:
+    """
+    The ring of TICK_STATS of one track. The track adds to the counters of the current tick between ticks
+    and writes the row of the tick with end_tick().
+    """
+
+    def __init__(self, n_slots: int = TICK_STATS_SLOTS):
+        """
+        :param n_slots: ticks kept
+        """
+        self.rows = np.zeros(n_slots, dtype=TICK_STATS)
+        self.n_slots = n_slots
+        self.tick = -1  # newest complete row
+        self.n_msgs = 0
+        self.receive_time = 0.
+        self.send_time = 0.
+        self.slack = 0.
+        self.last_query_count = 0
+
+    def add_receive(self, n_msgs: int, seconds: float) -> None:
+        """ adds the messages received and the time it took to receive and handle them """
+        self.n_msgs += n_msgs
+        self.receive_time += seconds
+
+    def add_send(self, seconds: float) -> None:
+        """ adds the time it took to encode and send states """
+        self.send_time += seconds
+
+    def add_slack(self, seconds: float) -> None:
+        """ adds the time the worker slept """
+        self.slack += seconds
+
+    def end_tick(self, now: float, dt: float, models, update_time: float, tick_time: float, query_count: int) -> None:
+        """
+        Writes the row of a tick and starts the counters of the next one.
+
+        :param now: timer() at the start of the tick
+        :param dt: simulated time step in seconds
+        :param models: the car_models that were updated
+        :param update_time: wall time of the model update in seconds
+        :param tick_time: wall time of the tick in seconds
+        :param query_count: track_geometry.query_count after the tick
+        """
+        self.tick += 1
+        i = self.tick % self.n_slots
+        r = self.rows
+        integrate_times = [m.last_calculations_time for m in models]
+        r['tick'][i] = self.tick
+        r['time'][i] = now
+        r['dt'][i] = dt
+        r['n_cars'][i] = len(models)
+        r['update_time'][i] = update_time
+        r['integrate_time'][i] = sum(integrate_times)
+        r['integrate_time_max'][i] = max(integrate_times) if integrate_times else 0.
+        r['n_eval'][i] = sum(m.last_n_eval for m in models)
+        r['track_queries'][i] = query_count - self.last_query_count
+        r['n_msgs'][i] = self.n_msgs
+        r['receive_time'][i] = self.receive_time
+        r['send_time'][i] = self.send_time
+        r['tick_time'][i] = tick_time
+        r['slack'][i] = self.slack
+        self.last_query_count = query_count
+        self.n_msgs = 0
+        self.receive_time = 0.
+        self.send_time = 0.
+        self.slack = 0.
+
+    def latest(self) -> np.ndarray:
+        """ :returns: copy of the rows that were written, oldest first """
+        n = min(self.tick + 1, self.n_slots)
+        return self.rows[np.arange(self.tick + 1 - n, self.tick + 1) % self.n_slots]
+
+    def summary(self) -> Dict:
+        """
+        :returns: for each timing and count field, its mean, 50th, 99th percentile and max over the kept ticks,
+            in milliseconds for times; plus the number of ticks and the tick rate
+        """
+        rows = self.latest()
+        s = {'ticks': int(self.tick + 1), 'kept': len(rows)}
+        if len(rows) == 0:
+            return s
+        span = rows['time'][-1] - rows['time'][0]
+        s['rate_hz'] = float((len(rows) - 1) / span) if span > 0 else None
+        for f in TICK_STATS.names:
+            if f in ('tick', 'time'):
+                continue
+            v = rows[f].astype(float)
+            if f.endswith('time') or f.endswith('time_max') or f in ('dt', 'slack'):
+                v = v * 1000.
+                f += '_ms'
+            s[f] = {'mean': float(np.mean(v)), 'p50': float(np.percentile(v, 50)), 'p99': float(np.percentile(v, 99)),
+                    'max': float(np.max(v))}
+        return s
+
+    def dump(self, track_name: str, folder: str = DATA_FOLDER_NAME) -> str:
+        """
+        Saves the kept rows to <folder>/<DATA_FILENAME_BASE>-tick-stats-<track_name>-<time>.npy, load with np.load.
+
+        :param track_name: name of the track
+        :param folder: the folder
+        :returns: the filename
+        :raises OSError: if it cannot be written
+        """
+        os.makedirs(folder, exist_ok=True)
+        fn = os.path.join(folder, '{}-tick-stats-{}-{}.npy'.format(DATA_FILENAME_BASE, track_name, time.strftime("%Y%m%d-%H%M%S")))
+        np.save(fn, self.latest())
+        return fn
+
+
+def is_local_client(client: Tuple[str, int]) -> bool:
+    """ :returns: True if the client address is on this host """
+    return client[0] in LOCAL_HOSTS
+
+
+def query_tick_stats(port: int, dump: bool = False, host: str = '127.0.0.1', timeout_s: float = 2.) -> Optional[Dict]:
+    """
+    Asks the track on port for its tick statistics, from a process on the server host.
+
+    :param port: the UDP port of the track, logged by the server when it starts the track
+    :param dump: True to also have the track dump its ring to a file, whose name is in the 'dump' entry of the reply
+    :param host: the server host, it must be this host
+    :param timeout_s: how long to wait for the reply
+    :returns: the summary of tick_stats.summary(), or None if the track did not answer
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(timeout_s)
+    r = reassembler()
+    try:
+        for p in split_message(encode_message('get_stats', {'dump': dump})):
+            sock.sendto(p, (host, port))
+        while True:
+            p, addr = sock.recvfrom(RECV_BUFFER_BYTES)
+            p = r.add(p, addr)
+            if p is None:
+                continue
+            msg, payload = decode_message(p)
+            if msg == 'stats':
+                return payload
+    except socket.timeout:
+        return None
+    finally:
+        sock.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='prints the tick statistics of a track running on this host')
+    parser.add_argument('port', type=int, help='UDP port of the track, see the server log')
+    parser.add_argument('--dump', action='store_true', help='also have the track dump its ring of tick statistics to a .npy file')
+    args = parser.parse_args()
+    stats = query_tick_stats(args.port, dump=args.dump)
+    print(json.dumps(stats, indent=1) if stats is not None else 'no answer from port {}'.format(args.port))
@@ -0,0 +1,239 @@
+# compiled, memory-mapped track assets
+# The pickled <track_name>_map.npy and <track_name>_info.npy made by Track_Preparation are compiled once into plain
+# (non-pickled) .npy files in TRACKS_FOLDER/compiled/<track_name>/. These are opened with np.load(mmap_mode='r'),
+# so all track processes and clients on one host share a single read-only copy through the OS page cache,
+# and starting a track process only maps the files instead of loading, copying and deriving the arrays.
+# Run this module (python -m src.track_assets) to compile all tracks ahead of time; otherwise a track is compiled
+# when it is first loaded, or when its source files changed.
+import json
+import os
+from typing import Dict, Optional
+
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+
+from src.globals import M_PER_PIXEL, TRACKS_FOLDER
+from src.l2race_utils import my_logger
+
+logger = my_logger(__name__)
+
+COMPILED_FOLDER_NAME = 'compiled'  # subfolder of the tracks folder holding the compiled assets
+ASSETS_VERSION = 2  # increment when the compiled layout changes, forces recompilation
+MANIFEST_FILE = 'manifest.json'  # written last, its presence marks a complete compilation
+WAYPOINTS_MAGNIFICATION = 1  # magnification of the precompiled waypoint_mask, the default waypoints_visible of track
+
+# derived arrays of the compiled assets, each stored as <name>.npy and indexed [y,x] like the map
+ASSET_ARRAYS = (
+    'map',  # surface type codes, uint8
+    'map_lidar',  # non-zero only in the sand, for find_hit_position
+    'boundary_distance',  # Euclidean distance transform of map_lidar in pixels, float32, for sphere tracing
+    'waypoint_mask',  # 1 at the (magnified) waypoints, for drawing
+    'nearest_waypoint_idx',  # index of nearest waypoint, int32
+    'distance_to_segment',  # signed distance to the nearest segment in meters, float32
+    'segment_angle',  # angle of the nearest segment in degrees, float32
+)
+
+
+def compute_query_grid(waypoints_x, waypoints_y, angle_next_segment_east, shape):
+    """
+    Computes the dense per-pixel lookup tables used by track queries.
+    For every pixel (x,y) of the map it finds the nearest waypoint, the signed distance to the "nearest segment"
+    (see track.get_distance_to_nearest_segment) and the angle of that segment.
+
+    :param waypoints_x: x coordinates of the waypoints in map units (pixels)
+    :param waypoints_y: y coordinates of the waypoints in map units (pixels)
+    :param angle_next_segment_east: the angle of each segment (TrackInfo['AngleNextSegmentEast'])
+    :param shape: (height,width) of the map
+    :return: nearest_waypoint_idx (int32), distance_to_segment (float32, in meters), segment_angle (float32, degrees),
+            all with shape (height,width) and indexed [y,x] like track_map
+    """
+    from scipy.spatial import cKDTree
+    (h, w) = shape
+    waypoints_x = np.asarray(waypoints_x, dtype=float)
+    waypoints_y = np.asarray(waypoints_y, dtype=float)
+    n = len(waypoints_x)
+    yy, xx = np.mgrid[0:h, 0:w]
+    px = xx.ravel().astype(float)
+    py = yy.ravel().astype(float)
+
+    tree = cKDTree(np.stack((waypoints_x, waypoints_y), axis=1))
+    _, idx = tree.query(np.stack((px, py), axis=1))
+
+    # segment from the waypoint before to the waypoint after the nearest one
+    p1x = waypoints_x[(idx - 1) % n]
+    p1y = waypoints_y[(idx - 1) % n]
+    p2x = waypoints_x[(idx + 1) % n]
+    p2y = waypoints_y[(idx + 1) % n]
+    sx = p2x - p1x
+    sy = p2y - p1y
+    cross = (px - p1x) * sy - (py - p1y) * sx
+    d = np.abs(cross) / np.hypot(sx, sy) * M_PER_PIXEL
+    d = np.where(cross > 0, -d, d)
+
+    nearest_waypoint_idx = idx.reshape(h, w).astype(np.int32)
+    distance_to_segment = d.reshape(h, w).astype(np.float32)
+    segment_angle = np.asarray(angle_next_segment_east, dtype=np.float32)[nearest_waypoint_idx]
+    return nearest_waypoint_idx, distance_to_segment, segment_angle
+
+
+def compute_waypoint_mask(track_map, magnification=1):
+    """
+    Computes the mask of the waypoints (value 40 in the map), grown by magnification pixels in all 8 directions
+    to make them better visible; same result as the neighbour loop of the original track.create_waypoints_surface.
+
+    :param track_map: the track map
+    :param magnification: number of times to grow the waypoints by their neighbours
+    :return: uint8 array like track_map, 1 at the waypoints, 0 elsewhere
+    """
+    m = np.asarray(track_map) == 40
+    for i in range(magnification):
+        d = m.copy()
+        d[1:, :] |= m[:-1, :]
+        d[:-1, :] |= m[1:, :]
+        d[:, 1:] |= m[:, :-1]
+        d[:, :-1] |= m[:, 1:]
+        d[1:, 1:] |= m[:-1, :-1]
+        d[1:, :-1] |= m[:-1, 1:]
+        d[:-1, 1:] |= m[1:, :-1]
+        d[:-1, :-1] |= m[1:, 1:]
+        m = d
+    return m.astype(np.uint8)
+
+
+def compiled_track_folder(track_name: str, media_folder_path: str = TRACKS_FOLDER) -> str:
+    """
+    :param track_name: name of track without suffix, e.g. track_1
+    :param media_folder_path: folder holding the track files
+    :return: the folder of the compiled assets of this track
+    """
+    return os.path.join(media_folder_path, COMPILED_FOLDER_NAME, track_name)
+
+
+def _source_files(track_name, media_folder_path):
+    return [media_folder_path + track_name + '_map.npy', media_folder_path + track_name + '_info.npy']
+
+
+def _read_manifest(folder) -> Optional[dict]:
+    try:
+        with open(os.path.join(folder, MANIFEST_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def is_compiled(track_name: str, media_folder_path: str = TRACKS_FOLDER) -> bool:
+    """
+    :param track_name: name of track without suffix
+    :param media_folder_path: folder holding the track files
+    :return: True if the compiled assets exist, have the current ASSETS_VERSION and are newer than the source files
+    """
+    folder = compiled_track_folder(track_name, media_folder_path)
+    manifest = _read_manifest(folder)
+    if manifest is None or manifest.get('version') != ASSETS_VERSION:
+        return False
+    t_compiled = os.path.getmtime(os.path.join(folder, MANIFEST_FILE))
+    return all(os.path.getmtime(f) <= t_compiled for f in _source_files(track_name, media_folder_path))
+
+
+def _save_atomic(fn, a):
+    """ Saves a to fn through a temporary file, so concurrent readers never see a partially written file."""
+    tmp = '{}.{}.tmp'.format(fn, os.getpid())
+    with open(tmp, 'wb') as f:
+        np.save(f, np.ascontiguousarray(a), allow_pickle=False)
+    os.replace(tmp, fn)
+
+
+def compile_track_assets(track_name: str, media_folder_path: str = TRACKS_FOLDER) -> None:
+    """
+    Compiles the assets of a track from its pickled _map.npy and _info.npy files.
+
+    :param track_name: name of track without suffix, e.g. track_1
+    :param media_folder_path: folder holding the track files
+    :raises FileNotFoundError: if track_name is not a plain name or its source files do not exist; nothing is created then
+    """
+    sources = _source_files(track_name, media_folder_path)
+    if os.path.basename(track_name) != track_name or not all(os.path.isfile(f) for f in sources):
+        raise FileNotFoundError('no track named {} in {}'.format(track_name, media_folder_path))
+    folder = compiled_track_folder(track_name, media_folder_path)
+    logger.info('compiling assets of track {} to {}'.format(track_name, folder))
+    os.makedirs(folder, exist_ok=True)
+    track_map = np.load(sources[0], allow_pickle=True)
+    track_info = np.load(sources[1], allow_pickle=True).item()
+
+    arrays = dict()
+    arrays['map'] = np.asarray(track_map).astype(np.uint8)
+    map_lidar = np.copy(arrays['map'])
+    map_lidar[map_lidar != 10] = 0
+    arrays['map_lidar'] = map_lidar
+    arrays['boundary_distance'] = distance_transform_edt(map_lidar == 0).astype(np.float32)
+    arrays['waypoint_mask'] = compute_waypoint_mask(arrays['map'], WAYPOINTS_MAGNIFICATION)
+    arrays['nearest_waypoint_idx'], arrays['distance_to_segment'], arrays['segment_angle'] = \
+        compute_query_grid(track_info['waypoint_x'], track_info['waypoint_y'], track_info['AngleNextSegmentEast'],
+                           arrays['map'].shape)
+    for name in ASSET_ARRAYS:
+        _save_atomic(os.path.join(folder, name + '.npy'), arrays[name])
+
+    info_keys = []
+    info_scalars = dict()
+    for k, v in track_info.items():
+        a = np.asarray(v)
+        if a.dtype == object:
+            logger.warning('track {} info {} is not numeric, it is not compiled'.format(track_name, k))
+        elif a.ndim == 0:
+            info_scalars[k] = a.item()
+        else:
+            _save_atomic(os.path.join(folder, 'info_' + k + '.npy'), a)
+            info_keys.append(k)
+
+    manifest = {'version': ASSETS_VERSION, 'track_name': track_name, 'arrays': list(ASSET_ARRAYS),
+                'info_keys': info_keys, 'info_scalars': info_scalars,
+                'waypoints_magnification': WAYPOINTS_MAGNIFICATION}
+    tmp = os.path.join(folder, '{}.{}.tmp'.format(MANIFEST_FILE, os.getpid()))
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(folder, MANIFEST_FILE))
+
+
+class track_assets:
+    """
+    The read-only, memory-mapped arrays of one track. Attributes are named as in ASSET_ARRAYS;
+    info is the TrackInfo dict with its arrays memory-mapped as well.
+    """
+
+    def __init__(self, track_name: str, media_folder_path: str = TRACKS_FOLDER):
+        """
+        Opens the compiled assets of a track; use load_track_assets() to compile them if needed.
+
+        :param track_name: name of track without suffix, e.g. track_1
+        :param media_folder_path: folder holding the track files
+        """
+        self.track_name = track_name
+        folder = compiled_track_folder(track_name, media_folder_path)
+        manifest = _read_manifest(folder)
+        if manifest is None:
+            raise FileNotFoundError('no compiled assets for track {} in {}'.format(track_name, folder))
+        self.waypoints_magnification = manifest['waypoints_magnification']
+        for name in manifest['arrays']:
+            setattr(self, name, np.load(os.path.join(folder, name + '.npy'), mmap_mode='r'))
+        self.info: Dict = dict(manifest['info_scalars'])
+        for k in manifest['info_keys']:
+            self.info[k] = np.load(os.path.join(folder, 'info_' + k + '.npy'), mmap_mode='r')
+
+
+def load_track_assets(track_name: str, media_folder_path: str = TRACKS_FOLDER) -> track_assets:
+    """
+    Opens the compiled assets of a track, compiling them first if they are missing or stale.
+
+    :param track_name: name of track without suffix, e.g. track_1
+    :param media_folder_path: folder holding the track files
+    :return: the track_assets
+    """
+    if not is_compiled(track_name, media_folder_path):
+        compile_track_assets(track_name, media_folder_path)
+    return track_assets(track_name, media_folder_path)
+
+
+if __name__ == '__main__':
+    from src.track_geometry import list_tracks
+    for name in list_tracks():
+        compile_track_assets(name)
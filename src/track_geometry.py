@@ -0,0 +1,816 @@
+# pygame-free core of the track: surface types, waypoints, start line and lap counting
+# Used by the server and batch tools, which never draw the track; src.track.track adds the image and drawing for the client.
+import logging
+from typing import List, Tuple, Optional
+
+import logging
+# import svglib
+# from svglib.svglib import svg2rlg
+import cmath
+import numpy as np
+from src.globals import SCREEN_WIDTH_PIXELS, SCREEN_HEIGHT_PIXELS, M_PER_PIXEL, TRACKS_FOLDER
+from timeit import default_timer as timer
+from src.track_assets import load_track_assets, compute_query_grid
+
+# Functions for finding hit position
+from scipy.special import tandg, cotdg, cosdg, sindg
+
+logger = logging.getLogger(__name__)
+
+LIDAR_NUM_BEAMS = 64  # default number of beams of track_geometry.lidar_scan
+LIDAR_FOV_DEG = 360.0  # default field of view of track_geometry.lidar_scan, centered on the car heading
+SPHERE_TRACE_MAX_ITERATIONS = 32  # maximum jumps of sphere_trace_rays before finishing a beam by grid traversal
+SQRT2 = np.sqrt(2.)
+
+
+def list_tracks()->List[str]:
+    """list all available tracks as list(str)
+
+    :returns: List of track names
+    """
+    from os import listdir
+
+    def list_files(directory, extension):
+        """
+        Returns the list of files having extension given by "extension" argument
+            and being included in directory given by "directory" argument
+        :param directory: Directory which content should be listed
+        :param extension: Only files with this extension will be included on the list
+        :return: List of files in the directory with the predefined extension
+        """
+        return (f for f in listdir(directory) if f.endswith('.' + extension))
+
+    # Create empty list to keep all the track names
+    tr = list()
+    # Give the name of the directory in which we want to look for the available tracks
+    directory = 'media/tracks'
+    # Find all the png files in the directory - these are the pictures of available tracks
+    files = list_files(directory, "png")
+    # For every found png file
+    for f in files:
+        # ...strip the .png suffix from its name to get track name and append to the list of all track names
+        tr.append(f.strip('.png'))
+    # Return track names list
+    return tr
+
+
+
+def get_position_on_map(car_state=None, x=None, y=None) -> Optional[Tuple[float,float]]:
+    """
+    The function converts the physical position (meters) to the position on the map (pixels).
+    As the ..._map.npy is a discrete map the position is rounded down to the nearest integer after conversion.
+    :param: One can provide either full car state (car_state), in which case the function will extract position from it,
+            Or one can provide x-y coordinates of the car directly. The last option allows to convert to map units
+            an arbitrary position, not only the instantaneous position of the car
+    :return: position (x,y) of the car in map units (pixels) or None if not enough parameters were supplied
+    """
+    if car_state is not None:
+        x_map = int(car_state.position_m.x / M_PER_PIXEL)
+        y_map = int(car_state.position_m.y / M_PER_PIXEL)
+    elif (x is not None) and (y is not None):
+        x_map = int(x / M_PER_PIXEL)
+        y_map = int(y / M_PER_PIXEL)
+    else:
+        logger.info('To little data to calculate car_position. Return None.')
+        return None
+
+    return x_map, y_map
+
+
+def pixels2meters(x_map: float):
+    """
+    The function converts a value in the map units (pixels) to the physical units (meters).
+    It is suitable to convert position, velocity or acceleration.
+    :param x_map: value in map units (pixels, not necessarily integer)
+    :return x_track: Value converted to physical units (meters)
+    """
+    x_track = x_map*M_PER_PIXEL
+    return x_track
+
+
+def meters2pixels(x_track: float):
+    """
+    The function converts a value in the map units (pixels) to the physical units (meters).
+    In contrast to get_position_on_map() it DOES NOT round the results down to nearest integer.
+    It is suitable to convert position, velocity or acceleration.
+    :param x_track: Value converted to physical units (meters)
+    :return x_map: Value in map units (pixels, not necessarily integer!)
+    """
+    x_map = x_track/M_PER_PIXEL
+    return x_map
+
+
+def closest_node(x, y, x_vector, y_vector):
+    '''
+    The function finds the nearest target point, from target point list (normally a waypoints list)
+    to a reference point (normally a car position)
+
+    :param x: Position (its x and y coordinates) of the reference point (normally of the car) in map units (pixels)
+    :param y: Position (its x and y coordinates) of the reference point (normally of the car) in map units (pixels)
+    :param x_vector, y_vector: List of positions of target points in map units
+    :return: Index of the nearest target point
+    '''
+    dist_2 = (x_vector - x) ** 2 + (y_vector - y) ** 2
+    return np.argmin(dist_2)
+
+
+def get_neighbours(p_ref, ref_array):
+    """
+    Given a reference point p_ref = (i,j) (array cell) and the 2D array it is part of
+    return the list of its neighbours (bu providing their rows and columns)
+    :param p_ref: Tuple giving a row and column of the reference point p_ref
+    :param ref_array: The 2D array p_ref is part of
+    :return: The list of neighbours of p_ref in the form: [(i0,j0),(i1,j1),(i2,j2),...]
+    """
+    (i, j) = p_ref
+    (h, w) = ref_array.shape
+
+    neighbours = []
+
+    if i > 0:
+        neighbours.append((i - 1, j))
+        if j > 0:
+            neighbours.append((i - 1, j - 1))
+        if j < (w-1):
+            neighbours.append((i - 1, j + 1))
+
+    if i < (h-1):
+        neighbours.append((i + 1, j))
+        if j > 0:
+            neighbours.append((i + 1, j - 1))
+        if j < (w-1):
+            neighbours.append((i + 1, j + 1))
+
+    if j > 0:
+        neighbours.append((i, j - 1))
+
+    if j < (w-1):
+        neighbours.append((i, j + 1))
+
+    return neighbours
+
+
+def make_rect(left, top, width, height) -> Tuple[int, int, int, int]:
+    """
+    Makes an axis aligned rectangle in map units, truncated to integers like pygame.Rect.
+
+    :param left: x of left edge
+    :param top: y of top edge (y points down)
+    :param width: width
+    :param height: height
+    :return: the rectangle (left, top, width, height)
+    """
+    return int(left), int(top), int(width), int(height)
+
+
+def rect_collidepoint(rect, x, y) -> bool:
+    """
+    Tests if a point is inside a rectangle, with the same convention as pygame.Rect.collidepoint:
+    the left and top edges are inside, the right and bottom edges are outside.
+
+    :param rect: rectangle (left, top, width, height), see make_rect()
+    :param x: x of point
+    :param y: y of point
+    :return: True if (x,y) is inside rect
+    """
+    (left, top, width, height) = rect
+    return left <= x < left + width and top <= y < top + height
+
+
+def _traverse_grid(x0, y0, dx, dy, track_map, max_range=None) -> np.ndarray:
+    """
+    Exact grid traversal (DDA, Amanatides & Woo) of many beams at once, see cast_rays().
+
+    :param x0: x of the start point of each beam in pixels, shape (N,)
+    :param y0: y of the start point of each beam in pixels, shape (N,)
+    :param dx: x component of the unit direction of each beam, shape (N,)
+    :param dy: y component of the unit direction of each beam, shape (N,)
+    :param track_map: the map, beams stop when they enter a non zero cell
+    :param max_range: optional maximum distance in pixels
+    :return: distance along each beam to the first non zero cell, np.inf if there is none, shape (N,)
+    """
+    (h, w) = track_map.shape
+    n = dx.shape[0]
+    distances = np.full(n, np.inf)
+    beams = np.arange(n)  # the beams that are still traversing
+    cx = np.floor(x0).astype(int)
+    cy = np.floor(y0).astype(int)
+    step_x = np.sign(dx).astype(int)
+    step_y = np.sign(dy).astype(int)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # distance along the beam between two vertical (x) or horizontal (y) grid lines
+        t_delta_x = np.where(dx != 0, np.abs(1. / dx), np.inf)
+        t_delta_y = np.where(dy != 0, np.abs(1. / dy), np.inf)
+        # distance along the beam to the first vertical (x) or horizontal (y) grid line
+        t_max_x = np.where(dx > 0, (cx + 1 - x0) / dx, np.where(dx < 0, (cx - x0) / dx, np.inf))
+        t_max_y = np.where(dy > 0, (cy + 1 - y0) / dy, np.where(dy < 0, (cy - y0) / dy, np.inf))
+    t = np.zeros(n)  # distance at which each beam entered its current cell
+
+    while beams.size > 0:
+        inside = (cx >= 0) & (cx < w) & (cy >= 0) & (cy < h)
+        hit = np.zeros_like(inside)
+        hit[inside] = track_map[cy[inside], cx[inside]] > 0
+        distances[beams[hit]] = t[hit]
+        keep = inside & ~hit
+        if max_range is not None:
+            keep &= t <= max_range
+        if not keep.all():
+            beams, cx, cy, t = beams[keep], cx[keep], cy[keep], t[keep]
+            step_x, step_y = step_x[keep], step_y[keep]
+            t_max_x, t_max_y, t_delta_x, t_delta_y = t_max_x[keep], t_max_y[keep], t_delta_x[keep], t_delta_y[keep]
+        # move each beam to the next cell, across the nearer of the next vertical and horizontal grid lines
+        cross_x = t_max_x < t_max_y
+        t = np.where(cross_x, t_max_x, t_max_y)
+        cx = cx + np.where(cross_x, step_x, 0)
+        cy = cy + np.where(cross_x, 0, step_y)
+        t_max_x = np.where(cross_x, t_max_x + t_delta_x, t_max_x)
+        t_max_y = np.where(cross_x, t_max_y, t_max_y + t_delta_y)
+
+    if max_range is not None:
+        distances[distances > max_range] = np.inf
+    return distances
+
+
+def cast_rays(pos, angles, track_map, max_range=None) -> np.ndarray:
+    """
+    Casts many beams at once from pos and returns the distance at which each beam first enters a non zero cell of
+    track_map. Uses exact grid traversal (DDA, Amanatides & Woo), vectorized over the beams: in every iteration each
+    beam that has not hit yet moves to the next cell it crosses, so no cell is skipped and no precision has to be chosen.
+
+    :param pos: point ((x,y) in pixels) where the beams start, e.g. position of the car
+    :param angles: angles (deg) of the beams, same convention as find_hit_position, array-like of shape (N,)
+    :param track_map: a SPECIAL map which is non-zero in sand region and zero on track. Use map_lidar for it.
+    :param max_range: optional maximum distance in pixels, beams are not followed further
+    :return: distances in pixels to the boundary along each beam, shape (N,), np.inf for beams that leave the map
+                or exceed max_range without a hit. The hit position of beam i is pos+d[i]*(cosdg(angles[i]),sindg(angles[i])).
+    """
+    angles = np.atleast_1d(np.asarray(angles, dtype=float))
+    n = angles.shape[0]
+    return _traverse_grid(np.full(n, float(pos[0])), np.full(n, float(pos[1])), cosdg(angles), sindg(angles),
+                          track_map, max_range=max_range)
+
+
+def sphere_trace_rays(pos, angles, track_map, distance_map, max_range=None,
+                      max_iterations=SPHERE_TRACE_MAX_ITERATIONS) -> np.ndarray:
+    """
+    Same as cast_rays(), but the beams jump through free space using a precomputed distance transform of the map:
+    at each point a beam can safely advance by the distance to the nearest non zero cell, less the pixel
+    discretization (sqrt(2) pixels). When this is less than a pixel the beam is finished by exact grid traversal,
+    so the distances are the same as those of cast_rays(), found in a few iterations per beam for any distance.
+
+    :param pos: point ((x,y) in pixels) where the beams start, e.g. position of the car; or (x,y) arrays of shape (N,)
+                with the start point of each beam, to trace the beams of many cars at once
+    :param angles: angles (deg) of the beams, array-like of shape (N,)
+    :param track_map: a SPECIAL map which is non-zero in sand region and zero on track. Use map_lidar for it.
+    :param distance_map: Euclidean distance transform of track_map, i.e. for each cell the distance in pixels to the nearest
+                non zero cell. Use boundary_distance of the track for it.
+    :param max_range: optional maximum distance in pixels
+    :param max_iterations: maximum number of jumps per beam before switching to grid traversal
+    :return: distances in pixels to the boundary along each beam, shape (N,), np.inf for beams that leave the map
+                or exceed max_range without a hit
+    """
+    (h, w) = track_map.shape
+    angles = np.atleast_1d(np.asarray(angles, dtype=float))
+    n = angles.shape[0]
+    dx = cosdg(angles)
+    dy = sindg(angles)
+    x = np.broadcast_to(np.asarray(pos[0], dtype=float), (n,)).copy()
+    y = np.broadcast_to(np.asarray(pos[1], dtype=float), (n,)).copy()
+    t = np.zeros(n)
+    distances = np.full(n, np.inf)
+    tracing = np.arange(n)  # the beams still jumping
+    finishing = []  # the beams to finish by grid traversal
+    for i in range(max_iterations):
+        if tracing.size == 0:
+            break
+        cx = np.floor(x[tracing]).astype(int)
+        cy = np.floor(y[tracing]).astype(int)
+        inside = (cx >= 0) & (cx < w) & (cy >= 0) & (cy < h)
+        if max_range is not None:
+            inside &= t[tracing] <= max_range
+        tracing, cx, cy = tracing[inside], cx[inside], cy[inside]  # the others left the map without a hit
+        step = distance_map[cy, cx] - SQRT2
+        near = step < 1.
+        finishing.append(tracing[near])
+        tracing, step = tracing[~near], step[~near]
+        t[tracing] += step
+        x[tracing] += step * dx[tracing]
+        y[tracing] += step * dy[tracing]
+    finishing.append(tracing)
+    finishing = np.concatenate(finishing)
+    if finishing.size > 0:
+        d = _traverse_grid(x[finishing], y[finishing], dx[finishing], dy[finishing], track_map, max_range=max_range)
+        d += t[finishing]
+        if max_range is not None:
+            d[d > max_range] = np.inf
+        distances[finishing] = d
+    return distances
+
+
+def find_hit_position(angle, pos, track_map, dl=1.0):
+    """
+    This function returns the point at which
+        a beam coming from point pos at angle given by angle variable
+         for the first time crosses a non zero point on the map
+         Timing at Marcin computer: dl = 5.0 -> about max 0.4 ms;
+         It is roughly valid: dl/n -> time*n
+     :param angle: angle (deg) in which the beam is going, e.g the body angle of the car
+     :param pos: point ((x,y) in pixels) where the beam starts, e.g. position of the car
+     :param track_map: a SPECIAL map which is non-zero in sand region and zero on track. Use map_lidar for it.
+     :param dl: determines the precision of the collision point determination
+                - the algorithm moves along the beam and checks every dl pixels (does not need to be integer)
+                if it left the track
+     :return the point on the track boundary which the beam first hits ((x,y) in pixels)
+                    (e.g. which the car would hit if it would go on a straight line)
+    """
+    (h, w) = track_map.shape
+    found = False
+
+    # x = meters2pixels(pos[0])
+    # y = meters2pixels(pos[1])
+
+    x = pos[0]
+    y = pos[1]
+
+    # Depending on direction we take y = ax+b or x = ay+b
+    if (45.0 < angle < 135.0) or (225.0 < angle < 315.0):
+        # x = ay+b
+
+        dy = dl * sindg(angle)
+        # dy = dl
+        a = cotdg(angle)
+        b = x - a * y
+
+        while 0 < x < w and 0 < y < h:
+            if track_map[int(y), int(x)] > 0:
+                found = True
+                break
+            else:
+                y = y + dy
+                x = a * y + b
+
+
+    else:
+        # dx = dl
+        dx = dl * cosdg(angle)
+        a = tandg(angle)
+        b = y - a * x
+
+        while 0 < x < w and 0 < y < h:
+            if track_map[int(y), int(x)] > 0:
+                found = True
+                break
+            else:
+                x = x + dx
+                y = a * x + b
+
+    if found:
+        hit_pos = (x, y)
+    else:
+        hit_pos = None
+
+    return hit_pos
+
+
+class track_geometry:
+    def __init__(self, track_name='track', media_folder_path=TRACKS_FOLDER):
+        """
+        Constructs a new headless track instance, without the track image and drawing surfaces.
+
+        :param track_name: name of track without suffix, e.g. track_1
+        :param media_folder_path: optional media folder path
+        """
+        self.name = track_name
+        # read-only arrays shared by all processes on this host, see src.track_assets
+        self.assets = load_track_assets(track_name, media_folder_path)
+        self.track_map = self.assets.map
+        self.TrackInfo = self.assets.info
+        self.waypoints_x = self.TrackInfo['waypoint_x']
+        self.waypoints_y = self.TrackInfo['waypoint_y']
+        self.num_waypoints = len(self.waypoints_x)
+
+        self.angle_next_segment_east = self.TrackInfo['AngleNextSegmentEast']
+        self.angle_next_waypoint = self.TrackInfo['AngleNextCheckpointEast']
+
+        if track_name == 'oval_easy':
+            self.waypoints_search_radius = 160
+            dy = 140
+        else:
+            self.waypoints_search_radius = 80
+            dy = 70
+
+        self.starting_line_rect = make_rect(self.waypoints_x[0], self.waypoints_y[0]-dy, 100, 2*dy)
+        # This is a rectangle (left, top, width, height) to automatically check if you passed the starting line
+        # take for it +/-dy = 52 in map units
+        self.anti_cheat_rect = make_rect(self.waypoints_x[self.num_waypoints//2], self.waypoints_y[self.num_waypoints//2]-60, 120, 120)
+
+        self.start_angle = self.angle_next_segment_east[0]
+        if self.waypoints_y[0] > max(self.waypoints_y)/2:  # Remember y points down, Here I am down
+            self.start_position_1 = np.array((self.waypoints_x[0], self.waypoints_y[0]+20))  # out
+            self.start_position_2 = np.array((self.waypoints_x[0]+40, self.waypoints_y[0]-20))    # in
+        else:  # Here I am up
+            self.start_position_1 = np.array((self.waypoints_x[0], self.waypoints_y[0]-20))  # out
+            self.start_position_2 = np.array((self.waypoints_x[0]-40, self.waypoints_y[0]+20))  # in
+
+        self.map_lidar = self.assets.map_lidar
+        # distance in pixels from each cell to the nearest non zero cell of map_lidar, for sphere_trace_rays
+        self.boundary_distance = self.assets.boundary_distance
+
+        # dense per-pixel lookup tables for nearest waypoint, distance and angle queries, indexed [y,x]
+        self.nearest_waypoint_idx_map = self.assets.nearest_waypoint_idx
+        self.distance_to_segment_map = self.assets.distance_to_segment
+        self.segment_angle_map = self.assets.segment_angle
+
+        self.query_count = 0  # number of queries of the track, read by the tick statistics of the server
+
+    def is_on_map(self, x_map, y_map):
+        """
+        :param x_map: x in map units (pixels)
+        :param y_map: y in map units (pixels)
+        :return: True if (x_map,y_map) is inside the map
+        """
+        return 0 <= x_map < self.track_map.shape[1] and 0 <= y_map < self.track_map.shape[0]
+
+
+
+    def get_surface_type(self, car_state=None, x=None, y=None):
+        """
+        This function returns the number corresponding to the surface type at the position of the car given in car_state
+        OR at the position given by x,y arguments. The numbers maps to surface type according the following key:
+            0 - water (out of track, now forward movement possible, possible to go back on reverse gear)
+            10 - sand (8 - left and 12 - right boundary) (out of track, only slow movement possible)
+            20 - asphalt (18 - left and 22 - right boundary) (normal car dynamics)
+            30 - middle line (normal car dynamics)
+            40 - waypoints (normal car dynamics)
+
+        :param car_state: car_state from which coordinates of the point of interest (car postion) can me extracted
+        :param x: x-coordinate of point of interest in meter (usually the car position)
+        :param y: y_car: y-coordinate of point of interest in meter (usually the car position)
+        :return: A value corresponding to the surface type at the point of interest, 0 if out of map.
+        """
+        self.query_count += 1
+
+        # Getting x,y coordinates of the point of interest in the map units (pixels)
+        x, y = get_position_on_map(car_state=car_state, x=x, y=y)
+        # Checking if the point of interest lays on the map.
+        # If not return 0
+        if x < 0 or x >= self.track_map.shape[1] or y < 0 or y > self.track_map.shape[0]:
+            return 0
+        # if yes check on track_map what kind of surface is at the point of interest
+        return self.track_map[y, x]
+
+    def get_nearest_waypoint_idx(self, car_state=None, x=None, y=None):
+        """
+        Function returns the index of the nearest waypoint to the point of reference.
+        The coordinates of the point of reference may be either read from car_state (car position),
+        OR they can be provided as as a x,y coordinates
+        :param car_state: car_state from which coordinates of the point of interest (car postion) can me extracted
+        :param x: x-coordinate of point of reference in meter (usually the car position)
+        :param y: y-coordinate of point of reference in meter (usually the car position)
+
+        :return: closest waypoint
+        """
+        self.query_count += 1
+        x_map, y_map = get_position_on_map(car_state=car_state, x=x, y=y)
+
+        if self.nearest_waypoint_idx_map is not None and self.is_on_map(x_map, y_map):
+            return int(self.nearest_waypoint_idx_map[y_map, x_map])
+        return self.search_nearest_waypoint_idx(x_map, y_map)
+
+    def search_nearest_waypoint_idx(self, x_map, y_map):
+        """
+        Searches the waypoint list for the nearest waypoint; used for points outside the query grid.
+
+        :param x_map: x-coordinate of point of reference in map units (pixels)
+        :param y_map: y-coordinate of point of reference in map units (pixels)
+        :return: closest waypoint
+        """
+        # https://codereview.stackexchange.com/questions/28207/finding-the-closest-point-to-a-list-of-points
+        waypoints_idx_considered = np.where((self.waypoints_x > x_map - self.waypoints_search_radius)
+                                            & (self.waypoints_x < x_map + self.waypoints_search_radius)
+                                            & (self.waypoints_y > y_map - self.waypoints_search_radius)
+                                            & (self.waypoints_y < y_map + self.waypoints_search_radius))
+
+        waypoints_idx_considered = np.atleast_1d(np.array(waypoints_idx_considered).squeeze())
+
+        if len(waypoints_idx_considered) == 0:
+            waypoints_idx_considered = range(len(self.waypoints_x))
+
+
+        idx = closest_node(x=x_map,
+                           y=y_map,
+                           x_vector=self.waypoints_x[waypoints_idx_considered],
+                           y_vector=self.waypoints_y[waypoints_idx_considered])
+
+        closest_waypoint = waypoints_idx_considered[idx]
+
+        return closest_waypoint
+
+    def get_current_angle_to_road(self, car_state=None,
+                                  angle_car=None,
+                                  x=None,
+                                  y=None,
+                                  nearest_waypoint_idx=None):
+        """
+        Returns the angle to the "nearest segment" of the road from the point of reference (usually the car).
+
+        Def: nearest segment
+           is a line segment connecting the next waypoint before and the next waypoint after the nearest waypoint
+
+        Assuming the car goes clockwise (which is the orientation of our tracks)
+            negative distance means that the driver goes counterclockwise (=to the left)
+
+        One can either supply the car_state or x,y coordinates of the point of reference
+
+        :param car_state: car_state from which coordinates of the point of reference (car postion) can me extracted.
+        :param x: x-coordinate of point of reference (usually the car position).
+        :param y: y-coordinate of point of reference (usually the car position).
+        :param angle_car: Angle of car in degrees with east 0 and increasing clockwise.
+        :param nearest_waypoint_idx: Optional. Index of the nearest waypoint.
+                If not provided or None it will be calculated in this function;
+                if previously calculated it may be provided to save calculation time
+
+        :return: Angle to the nearest segment
+        """
+        self.query_count += 1
+
+        x_map, y_map = get_position_on_map(car_state=car_state, x=x, y=y)
+
+        segment_angle = None
+        if nearest_waypoint_idx is None:
+            if self.segment_angle_map is not None and self.is_on_map(x_map, y_map):
+                segment_angle = self.segment_angle_map[y_map, x_map]
+            else:
+                nearest_waypoint_idx = self.get_nearest_waypoint_idx(car_state=car_state, x=x_map, y=y_map)
+        if segment_angle is None:
+            segment_angle = self.angle_next_segment_east[nearest_waypoint_idx]
+
+        if angle_car is None:
+            if car_state is not None:
+                angle_car = car_state.body_angle_deg
+            else:
+                logger.warning("Error! Car angle for track.get_current_angle not provided")
+                return None
+
+        # angle_car = angle_car - 360.0 * np.rint(angle_car / 360.0)
+        # print('angle car: {}'.format(angle_car))
+        # print('angle segment: {}'.format(self.angle_next_segment_east[nearest_waypoint_idx]))
+
+        angle_to_road = angle_car - segment_angle
+        angle_to_road = angle_to_road - 360.0 * np.rint(angle_to_road / 360.0)
+        # print('angle_to_road: {}'.format(angle_to_road))
+        # logger.info(angele_to_road)
+        return angle_to_road
+
+    def get_distance_to_nearest_segment(self,
+                                        car_state=None,
+                                        x_car=None,
+                                        y_car=None,
+                                        nearest_waypoint_idx=None):
+        """
+        Returns the signed distance to the "nearest segment" of the road from the point of reference (usually the car).
+
+        Def: nearest segment
+           is a line segment connecting the next waypoint before and the next waypoint after the nearest waypoint
+
+        Assuming the car goes clockwise (which is the orientation of our tracks)
+            negative distance means that the driver has this segment on his right-hand side (it is on the left side of the road)
+
+        One can either supply the car_state or x,y coordinates of the point of reference
+
+        :param car_state: car_state from which coordinates of the point of reference (car postion) can me extracted
+        :param x_car: x-coordinate of point of reference (usually the car position)
+        :param y_car: y-coordinate of point of reference (usually the car position)
+        :param nearest_waypoint_idx: Optional. Index of the nearest waypoint.
+                If not provided or None it will be calculated in this function;
+                if previously calculated it may be provided to save calculation time
+        :return: Signed distance from the nearest segment
+        """
+        self.query_count += 1
+
+
+        x_map, y_map = get_position_on_map(car_state=car_state, x=x_car, y=y_car)
+
+        if nearest_waypoint_idx is None:
+            if self.distance_to_segment_map is not None and self.is_on_map(x_map, y_map):
+                return float(self.distance_to_segment_map[y_map, x_map])
+            nearest_waypoint_idx = self.get_nearest_waypoint_idx(car_state=car_state, x=x_map, y=y_map)
+
+        p_car = np.array((x_map, y_map))
+        if nearest_waypoint_idx == 0:
+            p1 = np.array((self.waypoints_x[-1], self.waypoints_y[-1]))
+        else:
+            p1 = np.array((self.waypoints_x[nearest_waypoint_idx - 1], self.waypoints_y[nearest_waypoint_idx - 1]))
+
+        if nearest_waypoint_idx == len(self.waypoints_x) - 1:
+            p2 = np.array((self.waypoints_x[0], self.waypoints_y[0]))
+        else:
+            p2 = np.array((self.waypoints_x[nearest_waypoint_idx + 1], self.waypoints_y[nearest_waypoint_idx + 1]))
+
+        d = np.linalg.norm(np.cross(p2 - p1, p1 - p_car)) / np.linalg.norm(p2 - p1)
+
+        d = d * M_PER_PIXEL
+
+        v1 = (p_car-p1)/np.linalg.norm(p_car-p1)
+        v2 = (p2-p1)/np.linalg.norm(p2-p1)
+
+        if v1[0] * v2[1] - v1[1] * v2[0] > 0:
+            d = -d
+
+        return d
+
+    def car_completed_round(self, car_model):
+        """
+        Determines if car crossed starting line and completed laps.
+        If yes, saves the time result
+            and provides a information about completed round which should be printed on the screen through server message
+        This function can be called only on server as it requires car_model which is unavailable for client,
+            and also not a part of the track class.
+
+        :param car_model: the car model
+
+        :returns: string: Information about completed round to be displayed on the screen.
+        """
+        s = None
+        x_map = int(car_model.car_state.position_m.x / M_PER_PIXEL)
+        y_map = int(car_model.car_state.position_m.y / M_PER_PIXEL)
+
+        if rect_collidepoint(self.anti_cheat_rect, x_map, y_map):
+            car_model.passed_anti_cheat_rect = True
+
+        if rect_collidepoint(self.starting_line_rect, x_map, y_map):
+            if car_model.passed_anti_cheat_rect:
+
+                car_model.passed_anti_cheat_rect = False
+                current_time_car = car_model.time
+                car_model.car_state.time_results.append(current_time_car)
+                if car_model.round_num == 0:
+                    s = 'Start! '
+                    logger.info('Car crossed start line and is starting lap at {}s ***************************************************'.format(car_model.time))
+                elif car_model.round_num == 1:
+                    s0 = 'Car completed lap number {} at {}'.format(str(car_model.round_num), car_model.time)
+                    logger.info(s0)
+                    s1 = 'Your time in the last lap was  {:.2f}s'\
+                        .format(current_time_car-car_model.car_state.time_results[car_model.round_num-1])
+                    logger.info(s1)
+                    s = s0 + '\n' + s1
+                else:
+                    s0 = 'Car completed lap number {} at {}'.format(str(car_model.round_num), car_model.time)
+                    logger.info(s0)
+                    s1 = 'Your time in the last lap was  {:.2f}s'\
+                        .format(current_time_car-car_model.car_state.time_results[car_model.round_num-1])
+                    logger.info(s1)
+                    s = s0 + '\n' + s1
+                car_model.round_num += 1
+
+        else:
+            pass
+
+        return s
+
+    def get_position_on_map(self, car_state=None, x=None, y=None):
+        """
+        The function converts the physical position (meters) to the position on the map (pixels).
+        As the ..._map.npy is a discrete map the position is rounded down to the nearest integer after conversion.
+        :param: One can provide either full car state (car_state), in which case the function will extract position from it,
+                Or one can provide x-y coordinates of the car directly. The last option allows to convert to map units
+                an arbitrary position, not only the instantaneous position of the car
+        :return: position (x,y) of the car in map units (pixels) or None if not enough parameters were supplied
+        """
+        return get_position_on_map(car_state=car_state, x=x, y=y)
+
+    def meters2pixels(self, x_track):
+        """
+        The function converts a value in the map units (pixels) to the physical units (meters).
+        In contrast to get_position_on_map() it DOES NOT round the results down to nearest integer.
+        It is suitable to convert position, velocity or acceleration.
+        :param x_track: Value converted to physical units (meters)
+        :return x_map: Value in map units (pixels, not necessarily integer!)
+        """
+        return meters2pixels(x_track=x_track)
+
+    def pixels2meters(self, x_map):
+        """
+        The function converts a value in the map units (pixels) to the physical units (meters).
+        It is suitable to convert position, velocity or acceleration.
+        :param x_map: value in map units (pixels, not necessarily integer)
+        :return x_track: Value converted to physical units (meters)
+        """
+        return pixels2meters(x_map=x_map)
+
+    def lidar_scan(self, car_state=None, x=None, y=None, angle_deg=None,
+                   num_beams=LIDAR_NUM_BEAMS, fov_deg=LIDAR_FOV_DEG, max_range_m=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Full lidar scan of the track boundary (map_lidar) around the car, all beams cast at once with sphere_trace_rays().
+        The position and heading are taken from car_state, OR given by x, y and angle_deg.
+
+        :param car_state: car_state from which position and body angle of the car are taken
+        :param x: x-coordinate of the lidar in meters
+        :param y: y-coordinate of the lidar in meters
+        :param angle_deg: heading of the lidar in degrees, e.g. the body angle of the car
+        :param num_beams: number of beams, spread evenly over fov_deg
+        :param fov_deg: field of view in degrees centered on the heading; 360 gives a full circle
+        :param max_range_m: optional maximum range in meters
+        :return: beam angles in degrees (absolute, like body_angle_deg), shape (num_beams,),
+                and distances to the boundary in meters (np.inf where nothing is hit), shape (num_beams,)
+        """
+        self.query_count += 1
+        if car_state is not None:
+            x = car_state.position_m.x
+            y = car_state.position_m.y
+            angle_deg = car_state.body_angle_deg
+        if fov_deg >= 360.0:
+            offsets = np.arange(num_beams) * (360.0 / num_beams) - 180.0
+        else:
+            offsets = np.linspace(-fov_deg / 2., fov_deg / 2., num_beams)
+        angles = (angle_deg + offsets) % 360.0
+        max_range = None if max_range_m is None else meters2pixels(max_range_m)
+        d = sphere_trace_rays(pos=(meters2pixels(x), meters2pixels(y)), angles=angles,
+                              track_map=self.map_lidar, distance_map=self.boundary_distance, max_range=max_range)
+        return angles, pixels2meters(d)
+
+    def lidar_scan_batch(self, x: np.ndarray, y: np.ndarray, angle_deg: np.ndarray,
+                         num_beams=LIDAR_NUM_BEAMS, fov_deg=LIDAR_FOV_DEG, max_range_m=None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        lidar_scan() of many cars at once: the beams of all cars are traced together in one sphere_trace_rays().
+
+        :param x: x-coordinates of the lidars in meters, shape (N,)
+        :param y: y-coordinates of the lidars in meters, shape (N,)
+        :param angle_deg: headings of the lidars in degrees, shape (N,)
+        :param num_beams: number of beams of each lidar, spread evenly over fov_deg
+        :param fov_deg: field of view in degrees centered on the heading; 360 gives a full circle
+        :param max_range_m: optional maximum range in meters
+        :return: beam angles in degrees, shape (N,num_beams), and distances to the boundary in meters
+                (np.inf where nothing is hit), shape (N,num_beams)
+        """
+        self.query_count += len(x)
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if fov_deg >= 360.0:
+            offsets = np.arange(num_beams) * (360.0 / num_beams) - 180.0
+        else:
+            offsets = np.linspace(-fov_deg / 2., fov_deg / 2., num_beams)
+        angles = (np.asarray(angle_deg, dtype=float)[:, None] + offsets[None, :]) % 360.0
+        max_range = None if max_range_m is None else meters2pixels(max_range_m)
+        d = sphere_trace_rays(pos=(np.repeat(meters2pixels(x), num_beams), np.repeat(meters2pixels(y), num_beams)),
+                              angles=angles.ravel(), track_map=self.map_lidar, distance_map=self.boundary_distance,
+                              max_range=max_range)
+        return angles, pixels2meters(d).reshape(angles.shape)
+
+    def query_batch(self, x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        The track queries of many points at once, from the dense lookup tables. Points outside the map
+        fall back to get_nearest_waypoint_idx() and get_distance_to_nearest_segment() one by one.
+
+        :param x: x-coordinates in meters, shape (N,)
+        :param y: y-coordinates in meters, shape (N,)
+        :return: nearest waypoint index (int), signed distance to the nearest segment in meters, angle of the nearest
+                segment in degrees and surface type (0 out of map, see get_surface_type()), each of shape (N,)
+        """
+        self.query_count += len(x)
+        x_map = np.floor(np.asarray(x, dtype=float) / M_PER_PIXEL).astype(int)
+        y_map = np.floor(np.asarray(y, dtype=float) / M_PER_PIXEL).astype(int)
+        (h, w) = self.track_map.shape
+        on_map = (x_map >= 0) & (x_map < w) & (y_map >= 0) & (y_map < h)
+        xc = np.clip(x_map, 0, w - 1)
+        yc = np.clip(y_map, 0, h - 1)
+        idx = self.nearest_waypoint_idx_map[yc, xc].astype(int)
+        distance = self.distance_to_segment_map[yc, xc].astype(float)
+        segment_angle = self.segment_angle_map[yc, xc].astype(float)
+        surface = np.where(on_map, self.track_map[yc, xc], 0)
+        for i in np.flatnonzero(~on_map):
+            idx[i] = self.get_nearest_waypoint_idx(x=float(x[i]), y=float(y[i]))
+            distance[i] = self.get_distance_to_nearest_segment(x_car=float(x[i]), y_car=float(y[i]), nearest_waypoint_idx=idx[i])
+            segment_angle[i] = self.angle_next_segment_east[idx[i]]
+        return idx, distance, segment_angle, surface
+
+    def find_hit_position_exact(self, angle, pos):
+        """
+        Same as find_hit_position() on map_lidar, but exact and fast for any distance, using sphere_trace_rays().
+
+        :param angle: angle (deg) in which the beam is going, e.g the body angle of the car
+        :param pos: point ((x,y) in pixels) where the beam starts, e.g. position of the car
+        :return the point on the track boundary which the beam first hits ((x,y) in pixels), or None if there is none
+        """
+        d = sphere_trace_rays(pos=pos, angles=[angle], track_map=self.map_lidar, distance_map=self.boundary_distance)[0]
+        if not np.isfinite(d):
+            return None
+        return pos[0] + d * cosdg(angle), pos[1] + d * sindg(angle)
+
+    def find_hit_position(self, angle, pos, track_map, dl=1.0):
+        """
+        This function returns the point at which
+            a beam coming from point pos at angle given by angle variable
+             for the first time crosses a non zero point on the map
+             Timing at Marcin computer: dl = 5.0 -> about max 0.4 ms;
+             It is roughly valid: dl/n -> time*n
+         :param angle: angle (deg) in which the beam is going, e.g the body angle of the car
+         :param pos: point ((x,y) in pixels) where the beam starts, e.g. position of the car
+         :param track_map: a SPECIAL map which is non-zero in sand region and zero on track. Use map_lidar for it.
+         :param dl: determines the precision of the collision point determination
+                    - the algorithm moves along the beam and checks every dl pixels (does not need to be integer)
+                    if it left the track
+         :return the point on the track boundary which the beam first hits ((x,y) in pixels)
+                        (e.g. which the car would hit if it would go on a straight line)
+        """
+        return find_hit_position(angle=angle, pos=pos, track_map=track_map, dl=dl)
@@ -0,0 +1,171 @@
+# vectorized gym-style environment of many independent cars on one track, for reinforcement learning
+# All N cars are stepped in lockstep with one fixed dt: their model states are integrated together by car_model_batch,
+# and the lidar and track queries of all cars are done in single numpy calls (track_geometry.lidar_scan_batch and
+# query_batch), so the cost per step grows much slower than N. The cars do not see or collide with each other.
+# A car whose episode ends is restarted at once with car_model.restart, and the observation returned for it is
+# that of the new episode; the last observation of the old one is in its info dict, as in gym vector environments.
+import random
+from typing import List, Dict, Optional, Tuple
+
+import numpy as np
+
+from src.car_command import car_command
+from src.car_model import car_model
+from src.car_model_batch import car_model_batch
+from src.globals import MODEL_UPDATE_RATE_HZ
+from src.l2race_utils import my_logger
+from src.track_geometry import track_geometry
+
+logger = my_logger(__name__)
+
+VECTOR_ENV_DT_S = 1. / MODEL_UPDATE_RATE_HZ  # fixed time step of each env step
+VECTOR_ENV_MAX_STEPS = 3000  # steps of an episode before it is truncated, 30s at MODEL_UPDATE_RATE_HZ=100
+VECTOR_ENV_LIDAR_BEAMS = 16  # beams of the lidar in each observation
+VECTOR_ENV_LIDAR_FOV_DEG = 180.0  # field of view of the lidar, centered on the heading of the car
+VECTOR_ENV_LIDAR_RANGE_M = 30.0  # beams that hit nothing within this range read this range
+VECTOR_ENV_OFF_TRACK_PENALTY = 1.0  # subtracted from the reward of a step that ends an episode off track
+
+# columns of the observations; body angle is given as cos and sin so it has no wrap around
+STATE_OBS = ('pos.x', 'pos.y', 'speed', 'steering_angle', 'cos_body_angle', 'sin_body_angle', 'yaw_rate', 'drift_angle')
+TRACK_OBS = ('distance_to_segment', 'angle_to_road', 'progress', 'surface')
+
+
+class car_vector_env:
+    """
+    N independent cars on one track, stepped together.
+    """
+
+    def __init__(self, track_name: str, n_cars: int, model=None, parameters=None, dt: float = VECTOR_ENV_DT_S,
+                 max_steps: int = VECTOR_ENV_MAX_STEPS, allow_off_track: bool = False,
+                 lidar_beams: int = VECTOR_ENV_LIDAR_BEAMS, lidar_fov_deg: float = VECTOR_ENV_LIDAR_FOV_DEG,
+                 lidar_range_m: float = VECTOR_ENV_LIDAR_RANGE_M, seed: Optional[int] = None):
+        """
+        Makes the env and its cars.
+
+        :param track_name: name of the track, e.g. track_1
+        :param n_cars: number of cars N
+        :param model: vehicle dynamics function, see car_model; None for the default
+        :param parameters: vehicle parameters function, see car_model; None for the default
+        :param dt: fixed time step in seconds
+        :param max_steps: steps after which an episode is truncated
+        :param allow_off_track: True to let the cars leave the track; otherwise an episode ends when its car is off the track
+        :param lidar_beams: number of lidar beams in the observation, 0 for no lidar
+        :param lidar_fov_deg: field of view of the lidar in degrees
+        :param lidar_range_m: range of the lidar in meters
+        :param seed: seed of the random start positions of the cars, for reproducible runs
+        """
+        self.track_name = track_name
+        self.track = track_geometry(track_name)
+        self.n_cars = n_cars
+        self.dt = dt
+        self.max_steps = max_steps
+        self.allow_off_track = allow_off_track
+        self.lidar_beams = lidar_beams
+        self.lidar_fov_deg = lidar_fov_deg
+        self.lidar_range_m = lidar_range_m
+        self.rng = random.Random(seed) if seed is not None else None
+        self.models: List[car_model] = [car_model(track=self.track, car_name='car_{}'.format(i),
+                                                  allow_off_track=allow_off_track, model=model, parameters=parameters,
+                                                  rng=self.rng)
+                                        for i in range(n_cars)]
+        for i, m in enumerate(self.models):
+            m.car_state.static_info.car_id = i
+        self.batch = car_model_batch()
+        self.steps = np.zeros(n_cars, dtype=int)  # steps of the current episode of each car
+        self.episode_returns = np.zeros(n_cars)
+        self.obs_names: List[str] = list(STATE_OBS) + ['lidar_{}'.format(i) for i in range(lidar_beams)] + list(TRACK_OBS)
+        self.n_obs = len(self.obs_names)
+        self.observation: np.ndarray = self.observe()
+
+    def reset(self) -> np.ndarray:
+        """
+        Restarts all cars.
+
+        :returns: the observations, shape (N, n_obs)
+        """
+        for i in range(self.n_cars):
+            self.reset_car(i)
+        self.observation = self.observe()
+        return self.observation
+
+    def reset_car(self, i: int) -> None:
+        """ Restarts car i at the start line, like the restart_car command of the server. """
+        self.models[i].restart()  # keeps the car_id
+        self.steps[i] = 0
+        self.episode_returns[i] = 0
+
+    def step(self, actions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, List[Dict]]:
+        """
+        Applies an action to each car and advances all cars by dt.
+
+        :param actions: (N, 3) array of steering (-1 to 1), throttle (0 to 1) and brake (0 to 1), clipped to these ranges
+        :returns: (observations, rewards, dones, infos) - observations of shape (N, n_obs), after the restart for cars
+            whose episode ended; rewards of shape (N,), the distance in meters driven along the track; dones of shape (N,);
+            infos, one dict per car, with 'terminal_observation', 'episode_return', 'episode_steps' and 'off_track' for
+            cars whose episode ended
+        """
+        actions = np.asarray(actions, dtype=float)
+        if actions.shape != (self.n_cars, 3):
+            raise ValueError('actions must have shape ({}, 3), got {}'.format(self.n_cars, actions.shape))
+        steering = np.clip(actions[:, 0], -1., 1.)
+        throttle = np.clip(actions[:, 1], 0., 1.)
+        brake = np.clip(actions[:, 2], 0., 1.)
+        for i, m in enumerate(self.models):
+            c = car_command()
+            c.steering = float(steering[i])
+            c.throttle = float(throttle[i])
+            c.brake = float(brake[i])
+            m.car_state.command = c
+        self.batch.update(self.models, self.dt)
+        for m in self.models:
+            m.time += self.dt
+        self.steps += 1
+
+        obs = self.observe()
+        track_obs = obs[:, -len(TRACK_OBS):]
+        speed = obs[:, STATE_OBS.index('speed')]
+        angle_to_road = track_obs[:, TRACK_OBS.index('angle_to_road')]
+        rewards = speed * np.cos(np.radians(angle_to_road)) * self.dt
+        off_track = track_obs[:, TRACK_OBS.index('surface')] == 0
+        if self.allow_off_track:
+            off_track[:] = False
+        rewards[off_track] -= VECTOR_ENV_OFF_TRACK_PENALTY
+        self.episode_returns += rewards
+        dones = off_track | (self.steps >= self.max_steps)
+
+        infos: List[Dict] = [dict() for _ in range(self.n_cars)]
+        done_cars = np.flatnonzero(dones)
+        for i in done_cars:
+            infos[i] = {'terminal_observation': obs[i].copy(), 'episode_return': float(self.episode_returns[i]),
+                        'episode_steps': int(self.steps[i]), 'off_track': bool(off_track[i])}
+            self.reset_car(i)
+        if len(done_cars) > 0:
+            obs[done_cars] = self.observe(done_cars)
+        self.observation = obs
+        return obs, rewards, dones, infos
+
+    def observe(self, cars: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        :param cars: indexes of the cars to observe, None for all
+        :returns: the observations of the cars, shape (len(cars), n_obs), columns named by self.obs_names
+        """
+        models = self.models if cars is None else [self.models[i] for i in cars]
+        state = np.array([(m.car_state.position_m.x, m.car_state.position_m.y, m.car_state.speed_m_per_sec,
+                           m.car_state.steering_angle_deg, m.car_state.body_angle_deg, m.car_state.yaw_rate_deg_per_sec,
+                           m.car_state.drift_angle_deg) for m in models], dtype=float).reshape(len(models), 7)
+        (x, y, speed, steering_angle, body_angle, yaw_rate, drift_angle) = state.T
+        body_rad = np.radians(body_angle)
+        obs = np.empty((len(models), self.n_obs))
+        obs[:, :len(STATE_OBS)] = np.stack([x, y, speed, steering_angle, np.cos(body_rad), np.sin(body_rad),
+                                            yaw_rate, drift_angle], axis=1)
+        if self.lidar_beams > 0:
+            _, d = self.track.lidar_scan_batch(x, y, body_angle, num_beams=self.lidar_beams, fov_deg=self.lidar_fov_deg,
+                                               max_range_m=self.lidar_range_m)
+            d[~np.isfinite(d)] = self.lidar_range_m
+            obs[:, len(STATE_OBS):len(STATE_OBS) + self.lidar_beams] = d
+        idx, distance, segment_angle, surface = self.track.query_batch(x, y)
+        angle_to_road = body_angle - segment_angle
+        angle_to_road -= 360.0 * np.rint(angle_to_road / 360.0)
+        progress = idx / float(self.track.num_waypoints)  # fraction of the lap at the nearest waypoint
+        obs[:, -len(TRACK_OBS):] = np.stack([distance, angle_to_road, progress, surface], axis=1)
+        return obs